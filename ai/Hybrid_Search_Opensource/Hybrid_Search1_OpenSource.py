@@ -1,18 +1,20 @@
+"""
+Hybrid_Search1_OpenSource.py
+
+Hybrid (BM25 + FAISS) RAG over PDFs in Azure Blob Storage, with OCR.
+
+Heavy dependencies (Azure SDKs, LangChain, pypdf) are imported inside the
+functions that use them and Azure settings are checked only when a client
+is built, so importing this module for its configuration is cheap. cli.py
+drives the individual steps (ingest / query / serve / bench).
+"""
+
 import os
-#import os
-os.environ["OPENAI_OPENAI_API_VERSION"] = "2025-01-01-preview"
-import tempfile
-import pickle
-import numpy as np
-from azure.storage.blob import BlobServiceClient
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
-from rank_bm25 import BM25Okapi
-import faiss
-from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.docstore.document import Document
+from index_snapshot import load_snapshot
+from ocr_cache import OcrCache
+from ocr_selection import OcrPolicy, parse_page_spec
+from embedding_service import EmbeddingCache, EmbeddingService, TokenCounter
+from metrics import metrics
 
 
 # Azure and OpenAI configuration (masked)
@@ -20,143 +22,454 @@ AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 CONTAINER_NAME = os.getenv("CONTAINER_NAME", "ai-search-dummy-data")
 AZURE_FORM_RECOGNIZER_ENDPOINT = os.getenv("AZURE_FORM_RECOGNIZER_ENDPOINT")
 AZURE_FORM_RECOGNIZER_KEY = os.getenv("AZURE_FORM_RECOGNIZER_KEY")
+AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
+LLM_API_VERSION = "2025-01-01-preview"
+os.environ.setdefault("OPENAI_API_TYPE", "azure")
+
+
+def require_env(*names):
+    """
+    Values of the given environment variables; ValueError naming any that are unset.
+    """
+    missing = [name for name in names if not os.getenv(name)]
+    if missing:
+        raise ValueError(f"Please set {', '.join(missing)} (see README)")
+    return [os.environ[name] for name in names]
+
+
+# Embedding model; recorded in the index snapshot manifest
+EMBEDDING_DEPLOYMENT = "text-embedding-ada-002"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Embedding cache and request limits
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite")
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "100000"))
+
+# Vector index (flat | hnsw | ivf | ivfpq | ivfsq) and its search parameters
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat")
+VECTOR_NPROBE = int(os.getenv("VECTOR_NPROBE")) if os.getenv("VECTOR_NPROBE") else None
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH")) if os.getenv("VECTOR_EF_SEARCH") else None
+
+# Answer cache in front of the LLM (exact query match, then embedding similarity)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+# Chat model and the token budget for retrieved context in its prompt
+LLM_DEPLOYMENT = "gpt-4o-mini"
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "2000"))
 
-os.environ["AZURE_OPENAI_ENDPOINT"] = os.getenv("AZURE_OPENAI_ENDPOINT")
-os.environ["AZURE_OPENAI_API_KEY"] = os.getenv("AZURE_OPENAI_API_KEY")
-os.environ["AZURE_OPENAI_API_VERSION"] = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
-os.environ["OPENAI_API_TYPE"] = os.getenv("OPENAI_API_TYPE", "azure")
+# Hybrid search settings; tune_fusion.py sweeps them against labeled queries
+HYBRID_TOP_K = int(os.getenv("HYBRID_TOP_K", "3"))
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.6"))
+HYBRID_CANDIDATE_FACTOR = int(os.getenv("HYBRID_CANDIDATE_FACTOR", "2"))
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "minmax")
+# MMR diversity re-ranking of the fused candidates (see diversity.py): HYBRID_MMR_LAMBDA trades relevance (1.0)
+# against novelty (unset = off) and HYBRID_MAX_PER_SOURCE caps the results per PDF (0 = no cap)
+HYBRID_MMR_LAMBDA = float(os.getenv("HYBRID_MMR_LAMBDA")) if os.getenv("HYBRID_MMR_LAMBDA") else None
+HYBRID_MAX_PER_SOURCE = int(os.getenv("HYBRID_MAX_PER_SOURCE", "0"))
+# Query embedding runs alongside BM25; past this deadline a search returns BM25-only results (0 = always wait)
+HYBRID_EMBED_DEADLINE_MS = float(os.getenv("HYBRID_EMBED_DEADLINE_MS", "0"))
 
-# OCR cache directory
-OCR_CACHE_DIR = "ocr_cache"
-os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+# Per-stage metrics (PIPELINE_METRICS=0 disables them); METRICS_DUMP=path.json|path.prom writes them on exit
+METRICS_DUMP = os.getenv("METRICS_DUMP")
 
-def extract_text_with_ocr_cached(pdf_path, skip_empty=True):
+# Index snapshot directory (set REBUILD_INDEX=1 to force re-ingestion)
+INDEX_SNAPSHOT_DIR = os.getenv("INDEX_SNAPSHOT_DIR", "index_snapshot")
+REBUILD_INDEX = os.getenv("REBUILD_INDEX", "0") == "1"
+
+# Sharded index (see sharded_index.py): INDEX_SHARDS > 1 partitions the snapshot by INDEX_SHARD_PARTITION
+# (source | hash) and searches every shard in its own worker process (INDEX_SHARD_WORKERS=0: in-process)
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+INDEX_SHARD_PARTITION = os.getenv("INDEX_SHARD_PARTITION", "source")
+INDEX_SHARD_WORKERS = os.getenv("INDEX_SHARD_WORKERS", "1") == "1"
+
+# Incremental sync (see delta_sync.py): only new or changed blobs are ingested and the chunks of changed or
+# deleted ones are tombstoned; segments are compacted once more than SYNC_COMPACT_RATIO of the rows are
+# tombstoned or there are more than SYNC_MAX_SEGMENTS of them (SYNC_BACKGROUND_COMPACTION=1: in a thread)
+SYNC_COMPACT_RATIO = float(os.getenv("SYNC_COMPACT_RATIO", "0.2"))
+SYNC_MAX_SEGMENTS = int(os.getenv("SYNC_MAX_SEGMENTS", "8"))
+SYNC_BACKGROUND_COMPACTION = os.getenv("SYNC_BACKGROUND_COMPACTION", "0") == "1"
+
+# Ingestion pipeline limits (INGEST_MAX_BLOBS=0 ingests the whole container)
+INGEST_MAX_BLOBS = int(os.getenv("INGEST_MAX_BLOBS", "0"))
+INGEST_DOWNLOAD_WORKERS = int(os.getenv("INGEST_DOWNLOAD_WORKERS", "8"))
+INGEST_OCR_WORKERS = int(os.getenv("INGEST_OCR_WORKERS", "4"))
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "16"))
+
+# Chunking: how PDF text and OCR are combined per page (merge | best | pdf | ocr | concat),
+# chunk size/overlap in characters (0 = whole pages) and the near-duplicate
+# threshold (estimated Jaccard similarity; 0 disables de-duplication)
+PAGE_TEXT_MODE = os.getenv("PAGE_TEXT_MODE", "merge")
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "150"))
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))
+
+# OCR model and content-addressed OCR cache (size-bounded, LRU)
+OCR_MODEL_ID = "prebuilt-read"
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "ocr_cache")
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+_ocr_cache = None
+
+# Selective OCR (see ocr_selection.py): only pages with a sparse, undecodable or image-covered
+# text layer are sent to Form Recognizer, OCR_BATCH_PAGES pages per request. OCR_MODE=all OCRs everything.
+OCR_MODE = os.getenv("OCR_MODE", "selective")
+OCR_MIN_TEXT_DENSITY = float(os.getenv("OCR_MIN_TEXT_DENSITY", "0.2"))
+OCR_MIN_GLYPH_COVERAGE = float(os.getenv("OCR_MIN_GLYPH_COVERAGE", "0.9"))
+OCR_MAX_IMAGE_RATIO = float(os.getenv("OCR_MAX_IMAGE_RATIO", "0.5"))
+OCR_BATCH_PAGES = int(os.getenv("OCR_BATCH_PAGES", "20"))
+
+
+def get_ocr_cache():
+    global _ocr_cache
+    if _ocr_cache is None:
+        _ocr_cache = OcrCache(OCR_CACHE_DIR, max_bytes=OCR_CACHE_MAX_BYTES)
+    return _ocr_cache
+
+
+def extract_text_with_ocr_cached(pdf, skip_empty=True, pages=None):
     """
     Extract text from PDF using OCR with local caching.
+
+    `pdf` is a file path or the raw PDF bytes. `pages` is an optional page
+    spec ("1-3,7") to OCR only those pages; the result then has one string
+    per requested page. The cache is keyed on the PDF content, OCR model and
+    page spec, so unchanged documents never hit Form Recognizer.
+    """
+    ocr_cache = get_ocr_cache()
+    if isinstance(pdf, (bytes, bytearray)):
+        pdf_bytes = bytes(pdf)
+    else:
+        with open(pdf, "rb") as f:
+            pdf_bytes = f.read()
+    cache_key = OcrCache.make_key(pdf_bytes, OCR_MODEL_ID, pages)
+    page_texts = ocr_cache.get(cache_key)
+    if page_texts is not None:
+        metrics.count("ocr_cache_hits")
+        print(f"♻️  Loading OCR from cache: {cache_key[:12]}")
+    else:
+        metrics.count("ocr_cache_misses")
+        from azure.ai.formrecognizer import DocumentAnalysisClient
+        from azure.core.credentials import AzureKeyCredential
+
+        endpoint, key = require_env("AZURE_FORM_RECOGNIZER_ENDPOINT", "AZURE_FORM_RECOGNIZER_KEY")
+        form_client = DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key))
+        with metrics.span("ocr_submit"):
+            poller = form_client.begin_analyze_document(OCR_MODEL_ID, document=pdf_bytes, pages=pages)
+        with metrics.span("ocr_poll"):
+            result = poller.result()
+        by_number = {page.page_number: " ".join([line.content for line in page.lines]) for page in result.pages}
+        if pages:
+            page_texts = [by_number.get(n, "") for n in parse_page_spec(pages)]
+        else:
+            page_texts = [by_number[n] for n in sorted(by_number)]
+        metrics.count("ocr_pages", len(result.pages))
+        ocr_cache.put(cache_key, page_texts, OCR_MODEL_ID)
+        print(f"💾 Saved OCR to cache: {cache_key[:12]}")
+    if skip_empty:
+        return [page_text for page_text in page_texts if page_text.strip()]
+    return page_texts
+
+def ocr_pages_cached(pdf_bytes, pages=None):
+    """
+    OCR for iter_ingested_documents: every page as a list, or {page number: text} for a page spec.
+    """
+    # Keep empty pages so OCR page numbers line up with the PDF text layer
+    page_texts = extract_text_with_ocr_cached(pdf_bytes, skip_empty=False, pages=pages)
+    if pages is None:
+        return page_texts
+    return dict(zip(parse_page_spec(pages), page_texts))
+
+
+def build_ocr_policy():
+    """
+    OcrPolicy for selective OCR, or None to OCR every page (OCR_MODE=all).
     """
-    cache_file = os.path.join(OCR_CACHE_DIR, os.path.basename(pdf_path) + ".pkl")
-    if os.path.exists(cache_file):
-        with open(cache_file, "rb") as f:
-            print(f"♻️  Loading OCR from cache: {cache_file}")
-            return pickle.load(f)
-    form_client = DocumentAnalysisClient(
-        endpoint=AZURE_FORM_RECOGNIZER_ENDPOINT,
-        credential=AzureKeyCredential(AZURE_FORM_RECOGNIZER_KEY)
+    if OCR_MODE == "all":
+        return None
+    if OCR_MODE != "selective":
+        raise ValueError(f"OCR_MODE must be 'selective' or 'all', not {OCR_MODE!r}")
+    return OcrPolicy(
+        min_text_density=OCR_MIN_TEXT_DENSITY,
+        min_glyph_coverage=OCR_MIN_GLYPH_COVERAGE,
+        max_image_ratio=OCR_MAX_IMAGE_RATIO,
+        max_pages=OCR_BATCH_PAGES,
     )
-    with open(pdf_path, "rb") as f:
-        poller = form_client.begin_analyze_document("prebuilt-read", document=f)
-    result = poller.result()
-    extracted_text = []
-    for page in result.pages:
-        page_text = " ".join([line.content for line in page.lines])
-        if skip_empty and len(page_text.strip()) == 0:
-            continue
-        extracted_text.append(page_text)
-    with open(cache_file, "wb") as f:
-        pickle.dump(extracted_text, f)
-        print(f"💾 Saved OCR to cache: {cache_file}")
-    return extracted_text
 
-def main():
-    # Connect to Azure Blob Storage
-    blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-    container_client = blob_service_client.get_container_client(CONTAINER_NAME)
-
-    # Download and process PDFs
-    all_docs = []
-    blobs = sorted(container_client.list_blobs(), key=lambda b: b.name)
-    count = 0
-    for blob in blobs:
-        if blob.name.endswith(".pdf") and count < 1:
-            count += 1
-            print("Processing:", blob.name)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_pdf:
-                blob_client = container_client.get_blob_client(blob)
-                data = blob_client.download_blob().readall()
-                temp_pdf.write(data)
-                temp_path = temp_pdf.name
-            try:
-                loader = PyPDFLoader(temp_path)
-                pdf_docs = loader.load()
-                ocr_lines = extract_text_with_ocr_cached(temp_path, skip_empty=True)
-                num_pages = max(len(pdf_docs), len(ocr_lines))
-                for i in range(num_pages):
-                    structured_text = pdf_docs[i].page_content if i < len(pdf_docs) else ""
-                    ocr_text = ocr_lines[i] if i < len(ocr_lines) else ""
-                    if not structured_text.strip() and not ocr_text.strip():
-                        continue
-                    merged_text = structured_text + "\n" + ocr_text
-                    doc = Document(
-                        page_content=merged_text,
-                        metadata={"source": blob.name, "page": i + 1}
-                    )
-                    all_docs.append(doc)
-            finally:
-                os.remove(temp_path)
-                print(f"🗑️  Deleted temporary PDF: {temp_path}")
-    print(f"✅ Loaded {len(all_docs)} non-empty pages with cached OCR")
+
+def get_container_client():
+    """
+    ContainerClient for CONTAINER_NAME in Azure Blob Storage.
+    """
+    from azure.storage.blob import BlobServiceClient
+
+    (connection_string,) = require_env("AZURE_STORAGE_CONNECTION_STRING")
+    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+    return blob_service_client.get_container_client(CONTAINER_NAME)
+
+
+def ingest_documents(container_client=None, ocr_fn=None, blob_names=None, content_filter=None, on_failure=None):
+    """
+    Stream PDFs from Blob Storage through the parse/OCR pipeline into a chunk DocStore.
+
+    `blob_names` limits ingestion to those blobs (default: the whole
+    container); `content_filter` and `on_failure` are passed to
+    iter_ingested_documents.
+    """
+    from ingestion import iter_ingested_documents, list_pdf_blobs
+    from chunking import chunk_store, deduplicate_chunks
+    from doc_store import DocStoreBuilder
+
+    if container_client is None:
+        container_client = get_container_client()
+    if ocr_fn is None:
+        ocr_fn = ocr_pages_cached
+
+    if blob_names is None:
+        blob_names = list_pdf_blobs(container_client, max_blobs=INGEST_MAX_BLOBS)
+    pages = DocStoreBuilder()
+    for doc in iter_ingested_documents(
+        container_client, ocr_fn, blob_names=blob_names,
+        download_workers=INGEST_DOWNLOAD_WORKERS,
+        ocr_workers=INGEST_OCR_WORKERS,
+        max_in_flight=INGEST_MAX_IN_FLIGHT,
+        page_text_mode=PAGE_TEXT_MODE,
+        ocr_policy=build_ocr_policy(),
+        content_filter=content_filter,
+        on_failure=on_failure,
+    ):
+        pages.add_document(doc)
+    # Blobs finish out of order; keep the index layout deterministic
+    pages = pages.build().sorted()
+    print(f"✅ Loaded {len(pages)} non-empty pages from {len(blob_names)} PDFs with cached OCR")
+    print(f"OCR cache: {get_ocr_cache().stats()}")
+
+    chunks = chunk_store(pages, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    del pages
+    if DEDUP_THRESHOLD > 0:
+        chunks, removed = deduplicate_chunks(chunks, threshold=DEDUP_THRESHOLD)
+        print(f"🧹 Removed {removed} near-duplicate chunks")
+    print(f"✅ Indexing {len(chunks)} chunks ({chunks.nbytes / 1e6:.1f} MB doc store)")
+    return chunks
+
+
+def build_snapshot(embeddings_model):
+    """
+    Ingest the container, build BM25 + FAISS and write them as a snapshot.
+    """
+    from bm25_index import BM25Index, tokenize
+    from index_snapshot import save_snapshot
+    from vector_index import build_vector_index
+
+    all_docs = ingest_documents()
+
+    with metrics.span("embedding"):
+        vector_embeddings = embeddings_model.embed_documents(list(all_docs.texts()))
+    print(f"Embeddings: {embeddings_model.stats}")
+
+    if INDEX_SHARDS > 1:
+        from sharded_index import build_sharded_snapshot
+
+        build_sharded_snapshot(
+            INDEX_SNAPSHOT_DIR, all_docs, vector_embeddings, INDEX_SHARDS, EMBEDDING_MODEL,
+            partition=INDEX_SHARD_PARTITION, embedding_deployment=EMBEDDING_DEPLOYMENT,
+            vector_index_type=VECTOR_INDEX_TYPE, nprobe=VECTOR_NPROBE, ef_search=VECTOR_EF_SEARCH,
+        )
+        return
 
     # BM25 and FAISS setup
-    tokenized_corpus = [doc.page_content.split(" ") for doc in all_docs]
-    bm25 = BM25Okapi(tokenized_corpus)
-
-    embeddings_model = AzureOpenAIEmbeddings(
-    azure_deployment="text-embedding-ada-002",   # deployment name in Azure
-    model="text-embedding-ada-002",              # model type
-    openai_api_key=os.environ["AZURE_OPENAI_API_KEY"],
-    azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-    openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"]
-)
-    vector_embeddings = np.array(embeddings_model.embed_documents([doc.page_content for doc in all_docs])).astype("float32")
-    embedding_dim = vector_embeddings.shape[1]
-    faiss_index = faiss.IndexFlatL2(embedding_dim)
-    faiss_index.add(vector_embeddings)
-    faiss_id_to_doc = {i: doc for i, doc in enumerate(all_docs)}
-
-    # Example hybrid search function
-    def hybrid_search(query, top_k=3, alpha=0.5, candidate_factor=2):
-        tokenized_query = query.lower().split()
-        bm25_scores = bm25.get_scores(tokenized_query)
-        bm25_norm = (bm25_scores - np.min(bm25_scores)) / (np.max(bm25_scores) - np.min(bm25_scores) + 1e-6)
-        query_vector = np.array([embeddings_model.embed_query(query)]).astype("float32")
-        distances, indices = faiss_index.search(query_vector, top_k * candidate_factor)
-        faiss_top_indices = indices[0]
-        bm25_top_indices = np.argsort(bm25_scores)[-top_k * candidate_factor:]
-        candidate_indices = set(faiss_top_indices) | set(bm25_top_indices)
-        hybrid_scores = []
-        for i in candidate_indices:
-            semantic_score = 0
-            if i in faiss_top_indices:
-                idx_pos = list(faiss_top_indices).index(i)
-                semantic_score = 1 - distances[0][idx_pos]
-            lexical_score = bm25_norm[i] if i in bm25_top_indices else 0
-            final_score = alpha * semantic_score + (1 - alpha) * lexical_score
-            hybrid_scores.append((all_docs[i], final_score))
-        hybrid_results = sorted(hybrid_scores, key=lambda x: x[1], reverse=True)
-        return [doc for doc, _ in hybrid_results[:top_k]]
+    with metrics.span("bm25_build"):
+        bm25 = BM25Index.build(tokenize(text) for text in all_docs.texts())
+
+    with metrics.span("vector_index_build"):
+        faiss_index, vector_config = build_vector_index(
+            vector_embeddings, VECTOR_INDEX_TYPE, nprobe=VECTOR_NPROBE, ef_search=VECTOR_EF_SEARCH
+        )
+
+    with metrics.span("snapshot_write"):
+        save_snapshot(
+            INDEX_SNAPSHOT_DIR, all_docs, bm25, faiss_index,
+            embedding_model=EMBEDDING_MODEL, embedding_deployment=EMBEDDING_DEPLOYMENT,
+            vector_index_config=vector_config
+        )
+
+
+def sync_snapshot(embeddings_model, container_client=None, ocr_fn=None, compact=False):
+    """
+    Apply the container's changes since the last sync to the (sharded) index snapshot.
+    """
+    import delta_sync
+
+    if container_client is None:
+        container_client = get_container_client()
+    build_params = {
+        "embedding_deployment": EMBEDDING_DEPLOYMENT, "vector_index_type": VECTOR_INDEX_TYPE,
+        "nprobe": VECTOR_NPROBE, "ef_search": VECTOR_EF_SEARCH,
+    }
+    summary = delta_sync.sync_snapshot(
+        INDEX_SNAPSHOT_DIR, container_client,
+        lambda blob_names, content_filter: ingest_documents(
+            container_client, ocr_fn, blob_names=blob_names, content_filter=content_filter,
+            on_failure=content_filter.failed,
+        ),
+        embeddings_model, EMBEDDING_MODEL, n_shards=INDEX_SHARDS, partition=INDEX_SHARD_PARTITION,
+        max_blobs=INGEST_MAX_BLOBS, compact_ratio=SYNC_COMPACT_RATIO, max_segments=SYNC_MAX_SEGMENTS,
+        background_compaction=SYNC_BACKGROUND_COMPACTION, **build_params,
+    )
+    if compact and not summary["compacted"] and summary["mode"] == "delta":
+        delta_sync.compact_snapshot(INDEX_SNAPSHOT_DIR, embeddings_model, **build_params)
+        summary["compacted"] = True
+    return summary
+
+
+def build_embedding_service():
+    """
+    AzureOpenAIEmbeddings behind the persistent cache and batching layer.
+    """
+    from langchain_openai import AzureOpenAIEmbeddings
+
+    endpoint, api_key = require_env("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY")
+    backend = AzureOpenAIEmbeddings(
+        azure_deployment=EMBEDDING_DEPLOYMENT,   # deployment name in Azure
+        model=EMBEDDING_MODEL,                   # model type
+        openai_api_key=api_key,
+        azure_endpoint=endpoint,
+        openai_api_version=AZURE_OPENAI_API_VERSION,
+        max_retries=0,                           # retries are handled by EmbeddingService
+    )
+    return EmbeddingService(
+        backend,
+        model=EMBEDDING_MODEL,
+        cache=EmbeddingCache(EMBEDDING_CACHE_PATH),
+        max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+        max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+    )
+
+
+def open_snapshot(snapshot_dir=None, expected_embedding_model=None):
+    """
+    The snapshot in snapshot_dir (default INDEX_SNAPSHOT_DIR): an IndexSnapshot, or a ShardedIndex if sharded.
+    """
+    from sharded_index import ShardedIndex, is_sharded
+
+    snapshot_dir = snapshot_dir or INDEX_SNAPSHOT_DIR
+    if is_sharded(snapshot_dir):
+        return ShardedIndex(
+            snapshot_dir, expected_embedding_model=expected_embedding_model, workers=INDEX_SHARD_WORKERS,
+            nprobe=VECTOR_NPROBE, ef_search=VECTOR_EF_SEARCH,
+        )
+    return load_snapshot(
+        snapshot_dir, expected_embedding_model=expected_embedding_model,
+        nprobe=VECTOR_NPROBE, ef_search=VECTOR_EF_SEARCH
+    )
+
+
+def load_or_build_snapshot(embeddings_model):
+    """
+    Open the index snapshot; ingest and embed only if it is missing or stale.
+    """
+    from sharded_index import is_sharded, read_shards_manifest
+
+    if not REBUILD_INDEX:
+        try:
+            if is_sharded(INDEX_SNAPSHOT_DIR):
+                n_shards = read_shards_manifest(INDEX_SNAPSHOT_DIR)["n_shards"]
+            else:
+                n_shards = 1
+            if n_shards != max(INDEX_SHARDS, 1):
+                raise ValueError(f"it has {n_shards} shards, INDEX_SHARDS={INDEX_SHARDS}")
+            snapshot = open_snapshot(expected_embedding_model=EMBEDDING_MODEL)
+            print(f"⚡ Loaded index snapshot: {INDEX_SNAPSHOT_DIR} ({len(snapshot.docs)} docs)")
+            return snapshot
+        except FileNotFoundError:
+            print(f"No index snapshot at {INDEX_SNAPSHOT_DIR}, building one")
+        except ValueError as ex:
+            print(f"Index snapshot is stale ({ex}), rebuilding")
+    build_snapshot(embeddings_model)
+    return open_snapshot(expected_embedding_model=EMBEDDING_MODEL)
+
+
+def build_retriever(snapshot, embeddings_model):
+    """
+    HybridRetriever over a snapshot, or a ShardedRetriever over a ShardedIndex.
+    """
+    from hybrid_retriever import HybridRetriever
+    from sharded_index import ShardedIndex, ShardedRetriever
+
+    embed_deadline = HYBRID_EMBED_DEADLINE_MS / 1000 if HYBRID_EMBED_DEADLINE_MS > 0 else None
+    if isinstance(snapshot, ShardedIndex):
+        return ShardedRetriever(snapshot, embeddings_model, embed_deadline=embed_deadline)
+    return HybridRetriever(
+        snapshot.docs, snapshot.bm25, snapshot.faiss_index, embeddings_model, embed_deadline=embed_deadline
+    )
+
+
+def build_rag_pipeline(snapshot, embeddings_model, verbose=True):
+    """
+    Hybrid retriever, answer cache, context packer and Azure chat model as a RagPipeline.
+    """
+    from langchain_openai import AzureChatOpenAI
+    from answer_cache import AnswerCache
+    from context_packing import ContextPacker
+    from rag import RagPipeline
+    from sharded_index import current_snapshot_id
+
+    # Hybrid search: vectorised fusion over BM25 + FAISS candidates
+    retriever = build_retriever(snapshot, embeddings_model)
 
     # Example LLM setup (Azure OpenAI)
+    endpoint, api_key = require_env("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY")
     llm = AzureChatOpenAI(
-        openai_api_key=os.environ["AZURE_OPENAI_API_KEY"],
-        openai_api_version=os.environ["OPENAI_OPENAI_API_VERSION"],
-        azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-        deployment_name="gpt-4o-mini"
+        openai_api_key=api_key,
+        openai_api_version=LLM_API_VERSION,
+        azure_endpoint=endpoint,
+        deployment_name=LLM_DEPLOYMENT
+    )
+
+    answer_cache = AnswerCache(
+        max_entries=ANSWER_CACHE_SIZE,
+        ttl_seconds=ANSWER_CACHE_TTL,
+        similarity_threshold=ANSWER_CACHE_SIMILARITY,
+        index_version=snapshot.snapshot_id,
+        index_version_fn=lambda: current_snapshot_id(snapshot.snapshot_dir),
+    )
+
+    context_packer = ContextPacker(
+        max_tokens=CONTEXT_MAX_TOKENS, token_counter=TokenCounter(LLM_DEPLOYMENT), bm25=snapshot.bm25
+    )
+
+    return RagPipeline(
+        retriever,
+        llm,
+        answer_cache=answer_cache,
+        context_packer=context_packer,
+        top_k=HYBRID_TOP_K,
+        alpha=HYBRID_ALPHA,
+        candidate_factor=HYBRID_CANDIDATE_FACTOR,
+        fusion=HYBRID_FUSION,
+        mmr_lambda=HYBRID_MMR_LAMBDA,
+        max_per_source=HYBRID_MAX_PER_SOURCE,
+        verbose=verbose,
     )
 
-    def rag_pipeline(query, top_k=3, alpha=0.6, candidate_factor=2):
-        retrieved_docs = hybrid_search(query, top_k=top_k, alpha=alpha, candidate_factor=candidate_factor)
-        context_texts = []
-        for doc in retrieved_docs:
-            citation = f"[{doc.metadata['source']}, Page {doc.metadata['page']}]"
-            context_texts.append(f"{doc.page_content}\n{citation}")
-        context = "\n\n".join(context_texts)
-        prompt = f"Answer the question using the context below and provide sources for each point:\n\n{context}\n\nQuestion: {query}"
-        response = llm.invoke(prompt)
-        return response
-
-    # Example usage
+
+def main():
+    embeddings_model = build_embedding_service()
+    snapshot = load_or_build_snapshot(embeddings_model)
+    rag_pipeline = build_rag_pipeline(snapshot, embeddings_model)
+
+    # Example usage: stream the answer as it is generated
     query = "what is the information on internal use only."
-    print(rag_pipeline(query))
+    for token in rag_pipeline.stream(query):
+        print(token, end="", flush=True)
+    print()
+    print(f"Streaming: {rag_pipeline.stream_stats()}")
+    print(f"Answer cache: {rag_pipeline.answer_cache.stats()}")
+    print(f"Stages: {metrics.stage_summary()}")
+    if METRICS_DUMP:
+        metrics.dump(METRICS_DUMP)
+        print(f"💾 Wrote metrics to: {METRICS_DUMP}")
 
 if __name__ == "__main__":
     main()
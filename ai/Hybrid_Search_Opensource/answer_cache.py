@@ -0,0 +1,217 @@
+"""
+answer_cache.py
+
+Two-tier, in-memory cache of RAG answers in front of the LLM.
+
+    exact     the normalised query text was answered before with the same
+              retrieval parameters (top_k, alpha, fusion, ...), so from the
+              same kind of context
+    semantic  a previous query's embedding is within `similarity_threshold`
+              (cosine) of this one AND retrieval returned the same chunk ids
+              for both, so the answer was grounded in the same context
+
+Entries expire after `ttl_seconds` and the least recently used ones are
+evicted beyond `max_entries`. Every entry belongs to one index snapshot:
+set_index_version drops the whole cache when the snapshot changes. With an
+`index_version_fn` (e.g. sharded_index.current_snapshot_id of the snapshot
+directory), lookups check it at most every `version_check_seconds`, so a
+sync or compaction under a running server invalidates the cached answers.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from bm25_index import tokenize
+
+
+def normalize_query(query):
+    """
+    Case- and punctuation-insensitive form of a query, used as the exact key.
+    """
+    return " ".join(tokenize(query))
+
+
+def cache_key(query, params=None):
+    """
+    Exact-tier key: the normalised query plus the retrieval parameters it was answered with.
+    """
+    return normalize_query(query), tuple(sorted((params or {}).items()))
+
+
+class _Entry:
+    __slots__ = ("answer", "context_ids", "slot", "created_at")
+
+    def __init__(self, answer, context_ids, slot, created_at):
+        self.answer = answer
+        self.context_ids = context_ids
+        self.slot = slot
+        self.created_at = created_at
+
+
+class AnswerCache:
+    """
+    Thread-safe exact + semantic answer cache with TTL and LRU eviction.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, similarity_threshold=0.95, index_version=None,
+                 index_version_fn=None, version_check_seconds=1.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.index_version = index_version
+        self.index_version_fn = index_version_fn
+        self.version_check_seconds = version_check_seconds
+        self._version_checked = time.monotonic()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()     # cache_key -> _Entry, oldest first
+        self._vectors = None              # (max_entries, dim) unit query vectors by slot
+        self._slot_keys = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.context_mismatches = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def set_index_version(self, index_version):
+        """
+        Bind the cache to an index snapshot; answers from another snapshot are dropped.
+        """
+        with self._lock:
+            if index_version != self.index_version:
+                if self._entries:
+                    self.invalidations += 1
+                self._clear()
+                self.index_version = index_version
+
+    def check_index_version(self):
+        """
+        Re-read index_version_fn (at most every version_check_seconds) and drop the cache if it moved.
+        """
+        if self.index_version_fn is None:
+            return
+        now = time.monotonic()
+        if now - self._version_checked < self.version_check_seconds:
+            return
+        self._version_checked = now
+        try:
+            index_version = self.index_version_fn()
+        except (OSError, ValueError, KeyError):
+            # Mid-swap or missing manifest: keep the current answers until it can be read
+            return
+        self.set_index_version(index_version)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self._slot_keys = [None] * self.max_entries
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def _expired(self, entry, now):
+        return self.ttl_seconds is not None and now - entry.created_at > self.ttl_seconds
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._slot_keys[entry.slot] = None
+        self._free_slots.append(entry.slot)
+
+    def get(self, query, params=None):
+        """
+        Cached answer for exactly this (normalised) query and retrieval params, or None.
+        """
+        self.check_index_version()
+        key = cache_key(query, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, time.time()):
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry.answer
+
+    def get_similar(self, query_vector, context_ids):
+        """
+        Cached answer of the most similar earlier query, or None.
+
+        A match above the similarity threshold is only served when it was
+        answered from the same retrieved chunk ids as this query.
+        """
+        self.check_index_version()
+        query_vector = _unit(query_vector)
+        context_ids = tuple(context_ids)
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or not self._entries:
+                self.misses += 1
+                return None
+            similarities = self._vectors @ query_vector
+            for slot in np.argsort(-similarities):
+                if similarities[slot] < self.similarity_threshold:
+                    break
+                key = self._slot_keys[slot]
+                if key is None:
+                    continue
+                entry = self._entries[key]
+                if self._expired(entry, now):
+                    self._remove(key)
+                    self.expirations += 1
+                    continue
+                if entry.context_ids != context_ids:
+                    self.context_mismatches += 1
+                    continue
+                self._entries.move_to_end(key)
+                self.semantic_hits += 1
+                return entry.answer
+            self.misses += 1
+            return None
+
+    def put(self, query, query_vector, context_ids, answer, params=None):
+        query_vector = _unit(query_vector)
+        key = cache_key(query, params)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(query_vector):
+                self._clear()
+                self._vectors = np.zeros((self.max_entries, len(query_vector)), dtype=np.float32)
+            if key in self._entries:
+                self._remove(key)
+            while not self._free_slots:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            slot = self._free_slots.pop()
+            self._vectors[slot] = query_vector
+            self._slot_keys[slot] = key
+            self._entries[key] = _Entry(answer, tuple(context_ids), slot, time.time())
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "context_mismatches": self.context_mismatches,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
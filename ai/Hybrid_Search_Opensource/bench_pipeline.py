@@ -0,0 +1,346 @@
+"""
+bench_pipeline.py
+
+Offline performance benchmark for the ingestion and query paths.
+
+Everything runs on the stand-ins in local_backends.py (synthetic corpus,
+LocalBlobContainer, LocalOcr, HashingEmbedder, LocalChatModel), so results
+depend only on this code and the machine. For every corpus scale it reports:
+
+    ingestion   pages/sec through iter_ingested_documents (synthetic PDFs, a
+                --scanned-ratio share image-only) with full and selective OCR
+    build       chunking, BM25, embedding and vector index build times
+    size        snapshot size on disk per component, doc store and index RAM
+    queries     p50/p95/p99 latency of lexical, vector and hybrid retrieval
+                (also with MMR re-ranking),
+                hybrid retrieval with a --query-embed-latency embedding call
+                made before BM25 (sequential) or alongside it (overlapped,
+                and with --embed-deadline-ms), batched hybrid throughput
+                (also over --shards worker processes) and RagPipeline overhead
+
+Ingestion writes real PDFs, so it is capped at --ingest-pages per scale;
+indexing and queries run on the full synthetic corpus.
+
+    python bench_pipeline.py --scales 1000 100000 --json bench_results.json
+    python bench_pipeline.py --scales 1000000 --queries 200
+    python bench_pipeline.py --compare old.json --json new.json
+"""
+
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import faiss
+
+from bm25_index import BM25Index, tokenize
+from chunking import chunk_store
+from vector_index import build_vector_index, index_memory_bytes, search_similarities
+from index_snapshot import save_snapshot, load_snapshot
+from ingestion import iter_ingested_documents
+from ocr_selection import OcrPolicy
+from hybrid_retriever import HybridRetriever
+from sharded_index import ShardedIndex, ShardedRetriever, build_sharded_snapshot
+from context_packing import ContextPacker
+from rag import RagPipeline
+from local_backends import (
+    HashingEmbedder, LocalBlobContainer, LocalChatModel, LocalOcr, synthetic_pages, write_synthetic_pdfs
+)
+
+
+def rss_bytes():
+    """
+    Resident set size of this process (Linux /proc, else peak RSS).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def latency_summary(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+    }
+
+
+def timed(fn, items):
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - start)
+    return latency_summary(latencies)
+
+
+def make_queries(docs, n_queries, seed=0):
+    """
+    2-4 word queries drawn from random pages, so every query has matches.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i in rng.integers(0, len(docs), n_queries):
+        words = tokenize(docs[i].page_content)
+        picks = rng.choice(len(words), size=min(int(rng.integers(2, 5)), len(words)), replace=False)
+        queries.append(" ".join(words[j] for j in picks))
+    return queries
+
+
+def bench_ingestion(n_pages, workdir, ocr_latency=0.0, ocr_page_latency=0.0, scanned_ratio=0.0):
+    """
+    Ingest the same synthetic PDFs with full and with selective OCR.
+
+    Both modes must recover every page, scanned ones included, with the same text.
+    """
+    pdf_dir = os.path.join(workdir, "pdfs")
+    n_pages = write_synthetic_pdfs(pdf_dir, n_pages, scanned_ratio=scanned_ratio)
+    result = {}
+    pages = {}
+    for mode, ocr_policy in (("ocr_all", None), ("ocr_selective", OcrPolicy())):
+        ocr = LocalOcr(latency=ocr_latency, page_latency=ocr_page_latency)
+        start = time.perf_counter()
+        docs = list(iter_ingested_documents(LocalBlobContainer(pdf_dir), ocr, ocr_policy=ocr_policy))
+        seconds = time.perf_counter() - start
+        pages[mode] = sorted((doc.metadata["source"], doc.metadata["page"], doc.page_content) for doc in docs)
+        result[mode] = {
+            "pages": len(docs),
+            "seconds": round(seconds, 3),
+            "pages_per_s": round(len(docs) / seconds, 1) if seconds > 0 else None,
+            "ocr_requests": ocr.calls,
+            "ocr_pages": ocr.pages,
+        }
+    shutil.rmtree(pdf_dir, ignore_errors=True)
+    if len(pages["ocr_all"]) != n_pages or pages["ocr_selective"] != pages["ocr_all"]:
+        raise RuntimeError(
+            f"OCR modes disagree: {len(pages['ocr_all'])} pages with full OCR, "
+            f"{len(pages['ocr_selective'])} with selective OCR, {n_pages} written"
+        )
+    return result
+
+
+def bench_scale(n_pages, args, workdir):
+    result = {"pages": n_pages}
+    if args.ingest_pages:
+        result["ingestion"] = bench_ingestion(
+            min(n_pages, args.ingest_pages), workdir, args.ocr_latency, args.ocr_page_latency, args.scanned_ratio
+        )
+        print(f"  ingestion: {result['ingestion']}")
+
+    build = {}
+    start = time.perf_counter()
+    docs = synthetic_pages(n_pages, words_per_page=args.words_per_page, seed=args.seed)
+    build["corpus_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    chunks = chunk_store(docs, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    build["chunking_s"] = time.perf_counter() - start
+    del docs
+    start = time.perf_counter()
+    bm25 = BM25Index.build(tokenize(text) for text in chunks.texts())
+    build["bm25_s"] = time.perf_counter() - start
+    embedder = HashingEmbedder(dim=args.dim)
+    start = time.perf_counter()
+    vectors = np.asarray(embedder.embed_documents(list(chunks.texts())), dtype=np.float32)
+    build["embedding_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    faiss_index, vector_config = build_vector_index(vectors, args.index_type)
+    build["vector_index_s"] = time.perf_counter() - start
+    sharded_dir = os.path.join(workdir, "sharded")
+    if args.shards > 1:
+        start = time.perf_counter()
+        build_sharded_snapshot(sharded_dir, chunks, vectors, args.shards, "hashing", vector_index_type=args.index_type)
+        build["sharded_snapshot_s"] = time.perf_counter() - start
+    del vectors
+    snapshot_dir = os.path.join(workdir, "snapshot")
+    start = time.perf_counter()
+    save_snapshot(snapshot_dir, chunks, bm25, faiss_index, "hashing", vector_index_config=vector_config)
+    build["snapshot_write_s"] = time.perf_counter() - start
+    result["chunks"] = len(chunks)
+    result["doc_store_bytes"] = chunks.nbytes
+    result["build"] = {k: round(v, 3) for k, v in build.items()}
+    print(f"  build: {result['build']}")
+    queries = make_queries(chunks, args.queries, seed=args.seed + 1)
+    del chunks, bm25, faiss_index
+
+    result["disk_bytes"] = {
+        "total": dir_size(snapshot_dir),
+        "vectors": dir_size(os.path.join(snapshot_dir, "vectors.faiss")),
+        "bm25": dir_size(os.path.join(snapshot_dir, "bm25")),
+        "docs": sum(dir_size(os.path.join(snapshot_dir, name))
+                    for name in os.listdir(snapshot_dir) if name.startswith("docs_")),
+    }
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    snapshot = load_snapshot(snapshot_dir)
+    load_seconds = time.perf_counter() - start
+    bm25_arrays = sum(getattr(snapshot.bm25, name).nbytes for name in (
+        "term_ptr", "term_first_doc", "term_max_weight", "skip_doc", "gaps_1", "gaps_2", "gaps_4",
+        "weights", "doc_len"))
+    result["memory_bytes"] = {
+        "vector_index": index_memory_bytes(snapshot.faiss_index),
+        "bm25_arrays": int(bm25_arrays),
+        "rss_after_load_delta": rss_bytes() - rss_before,
+    }
+    result["load_s"] = round(load_seconds, 4)
+    print(f"  disk: {result['disk_bytes']}  memory: {result['memory_bytes']}")
+
+    retriever = HybridRetriever(snapshot.docs, snapshot.bm25, snapshot.faiss_index, embedder)
+    query_vectors = retriever.embed_queries(queries)
+    token_lists = [tokenize(q) for q in queries]
+    k = args.top_k
+    query_results = {
+        "lexical": timed(lambda i: snapshot.bm25.top_n(token_lists[i], k), range(len(queries))),
+        "vector": timed(lambda i: search_similarities(snapshot.faiss_index, query_vectors[i:i + 1], k),
+                        range(len(queries))),
+        "hybrid": timed(lambda i: retriever.search_ids_batch([queries[i]], top_k=k,
+                                                              query_vectors=query_vectors[i:i + 1]),
+                        range(len(queries))),
+        "hybrid_with_embedding": timed(lambda q: retriever.search_ids_batch([q], top_k=k), queries),
+        "hybrid_mmr": timed(lambda i: retriever.search_ids_batch([queries[i]], top_k=k, mmr_lambda=0.5,
+                                                                  max_per_source=2,
+                                                                  query_vectors=query_vectors[i:i + 1]),
+                            range(len(queries))),
+    }
+    # The query embedding as a network call: waited for before BM25, or overlapped with it
+    remote = HybridRetriever(snapshot.docs, snapshot.bm25, snapshot.faiss_index,
+                             HashingEmbedder(dim=args.dim, latency=args.query_embed_latency))
+    query_results["hybrid_embed_sequential"] = timed(
+        lambda q: remote.search_ids_batch([q], top_k=k, query_vectors=remote.embed_queries([q])), queries
+    )
+    query_results["hybrid_embed_overlapped"] = timed(lambda q: remote.search_ids_batch([q], top_k=k), queries)
+    if args.embed_deadline_ms:
+        remote.embed_deadline = args.embed_deadline_ms / 1000
+        query_results["hybrid_embed_deadline"] = timed(lambda q: remote.search_ids_batch([q], top_k=k), queries)
+    start = time.perf_counter()
+    for i in range(0, len(queries), args.batch_size):
+        retriever.search_ids_batch(queries[i:i + args.batch_size], top_k=k,
+                                   query_vectors=query_vectors[i:i + args.batch_size])
+    batch_seconds = time.perf_counter() - start
+    query_results["hybrid_batch_qps"] = round(len(queries) / batch_seconds, 1)
+    if args.shards > 1:
+        with ShardedIndex(sharded_dir) as sharded:
+            sharded_retriever = ShardedRetriever(sharded, embedder)
+            start = time.perf_counter()
+            for i in range(0, len(queries), args.batch_size):
+                sharded_retriever.search_ids_batch(queries[i:i + args.batch_size], top_k=k,
+                                                   query_vectors=query_vectors[i:i + args.batch_size])
+            batch_seconds = time.perf_counter() - start
+        query_results["sharded_batch_qps"] = round(len(queries) / batch_seconds, 1)
+        shutil.rmtree(sharded_dir, ignore_errors=True)
+
+    pipeline = RagPipeline(retriever, LocalChatModel(), context_packer=ContextPacker(bm25=snapshot.bm25),
+                           top_k=k, verbose=False)
+    query_results["rag_local_llm"] = timed(pipeline.invoke, queries[:args.rag_queries])
+    result["queries"] = query_results
+    for name, summary in query_results.items():
+        print(f"  {name:22s} {summary}")
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "faiss": getattr(faiss, "__version__", None),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def flatten(results, prefix=""):
+    """
+    {"scale.path.to.metric": value} for every numeric leaf, to compare runs.
+    """
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            flat.update(flatten(value, f"{prefix}{key}."))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        flat[prefix[:-1]] = results
+    return flat
+
+
+def compare(old, new):
+    old_flat = flatten({str(s["pages"]): s for s in old["scales"]})
+    new_flat = flatten({str(s["pages"]): s for s in new["scales"]})
+    print("\n📈 Compared with previous run (new / old):")
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        if old_flat[key]:
+            print(f"  {key:60s} {old_flat[key]:>14,.3f} -> {new_flat[key]:>14,.3f}  x{new_flat[key] / old_flat[key]:.2f}")
+
+
+def run(args):
+    results = {"environment": environment(), "config": vars(args).copy(), "scales": []}
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    try:
+        for n_pages in args.scales:
+            print(f"📊 Scale: {n_pages} pages")
+            results["scales"].append(bench_scale(n_pages, args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Wrote results to: {args.json}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), results)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ingestion and query benchmark")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 100_000], help="corpus sizes in pages")
+    parser.add_argument("--words-per-page", type=int, default=200)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=150)
+    parser.add_argument("--dim", type=int, default=256, help="HashingEmbedder dimension")
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--ingest-pages", type=int, default=2000, help="max pages per ingestion run (0 skips it)")
+    parser.add_argument("--ocr-latency", type=float, default=0.0, help="stand-in OCR latency per request (s)")
+    parser.add_argument("--ocr-page-latency", type=float, default=0.0, help="stand-in OCR latency per page (s)")
+    parser.add_argument("--scanned-ratio", type=float, default=0.1, help="share of image-only pages in the PDFs")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--rag-queries", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--query-embed-latency", type=float, default=0.005,
+                        help="stand-in query embedding latency (s) for the sequential / overlapped timings")
+    parser.add_argument("--embed-deadline-ms", type=float, default=0.0,
+                        help="also time hybrid search with this query embedding deadline (BM25-only past it)")
+    parser.add_argument("--shards", type=int, default=0, help="also time a sharded index with this many shards")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--compare", help="print the change against an earlier results file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,160 @@
+"""
+bench_vector_index.py
+
+Recall-vs-latency benchmark for the vector index types in vector_index.py.
+
+Vectors come from an index snapshot (reconstructed from vectors.faiss) or
+are generated as clustered synthetic embeddings. Queries are perturbed
+copies of corpus vectors. For every index type and search setting the
+script reports recall@k against exact search, p50/p99 single-query
+latency, batch throughput, build time and index size.
+
+    python bench_vector_index.py --n 100000 --dim 1536 --types flat hnsw ivfpq
+    python bench_vector_index.py --snapshot index_snapshot --json results.json
+"""
+
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+import faiss
+
+from vector_index import INDEX_TYPES, build_vector_index, set_search_params, index_memory_bytes, normalize
+
+
+def synthetic_vectors(n, dim, n_clusters=256, spread=0.35, seed=0):
+    """
+    Normalised vectors drawn around random centroids, like embedding clusters.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    assignment = rng.integers(0, n_clusters, n)
+    vectors = centroids[assignment] + spread * rng.standard_normal((n, dim)).astype(np.float32)
+    return normalize(vectors)
+
+
+def snapshot_vectors(snapshot_dir):
+    """
+    All vectors stored in a snapshot's FAISS index.
+    """
+    index = faiss.read_index(os.path.join(snapshot_dir, "vectors.faiss"))
+    return normalize(index.reconstruct_n(0, index.ntotal))
+
+
+def make_queries(vectors, n_queries, noise=0.1, seed=1):
+    rng = np.random.default_rng(seed)
+    picks = vectors[rng.integers(0, len(vectors), n_queries)]
+    return normalize(picks + noise * rng.standard_normal(picks.shape).astype(np.float32))
+
+
+def recall_at_k(found_ids, true_ids):
+    k = true_ids.shape[1]
+    hits = sum(len(np.intersect1d(found, true)) for found, true in zip(found_ids[:, :k], true_ids))
+    return hits / true_ids.size
+
+
+def time_queries(index, queries, k):
+    """
+    (p50 ms, p99 ms) of one-query searches and batch queries per second.
+    """
+    latencies = []
+    for q in queries:
+        start = time.perf_counter()
+        index.search(q.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    _, ids = index.search(queries, k)
+    batch_seconds = time.perf_counter() - start
+    return (
+        float(np.percentile(latencies, 50)),
+        float(np.percentile(latencies, 99)),
+        len(queries) / batch_seconds if batch_seconds > 0 else float("inf"),
+        ids,
+    )
+
+
+def sweep_values(index_type, args):
+    if index_type == "hnsw":
+        return "ef_search", args.ef_search
+    if index_type in ("ivf", "ivfpq", "ivfsq"):
+        return "nprobe", args.nprobe
+    return None, [None]
+
+
+def run(args):
+    if args.snapshot:
+        vectors = snapshot_vectors(args.snapshot)
+        source = f"snapshot {args.snapshot}"
+    else:
+        vectors = synthetic_vectors(args.n, args.dim, seed=args.seed)
+        source = "synthetic"
+    queries = make_queries(vectors, args.queries, seed=args.seed + 1)
+    n, dim = vectors.shape
+    print(f"📊 {n} vectors x {dim} dims ({source}), {len(queries)} queries, k={args.k}")
+
+    exact = faiss.IndexFlatIP(dim)
+    exact.add(vectors)
+    _, true_ids = exact.search(queries, args.k)
+
+    results = []
+    for index_type in args.types:
+        start = time.perf_counter()
+        index, config = build_vector_index(
+            vectors, index_type, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m
+        )
+        build_seconds = time.perf_counter() - start
+        memory_bytes = index_memory_bytes(index)
+        knob, values = sweep_values(index_type, args)
+        for value in values:
+            if knob:
+                set_search_params(index, **{knob: value})
+            p50, p99, qps, ids = time_queries(index, queries, args.k)
+            row = {
+                "type": index_type,
+                "factory": config["factory"],
+                "knob": knob,
+                "value": value,
+                "recall": recall_at_k(ids, true_ids),
+                "p50_ms": p50,
+                "p99_ms": p99,
+                "batch_qps": qps,
+                "build_s": build_seconds,
+                "memory_mb": memory_bytes / 2**20,
+            }
+            results.append(row)
+            setting = f"{knob}={value}" if knob else "exact"
+            print(
+                f"  {index_type:6s} {setting:14s} recall@{args.k}={row['recall']:.3f}  "
+                f"p50={p50:.3f}ms p99={p99:.3f}ms  {qps:,.0f} q/s  "
+                f"build={build_seconds:.1f}s  mem={row['memory_mb']:.1f}MB"
+            )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"n": n, "dim": dim, "k": args.k, "source": source, "results": results}, f, indent=2)
+        print(f"💾 Wrote results to: {args.json}")
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Recall vs latency for FAISS vector index types")
+    parser.add_argument("--snapshot", help="benchmark the vectors of this index snapshot")
+    parser.add_argument("--n", type=int, default=50_000, help="synthetic vector count")
+    parser.add_argument("--dim", type=int, default=1536, help="synthetic vector dimension")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--nlist", type=int)
+    parser.add_argument("--pq-m", type=int)
+    parser.add_argument("--hnsw-m", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this JSON file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
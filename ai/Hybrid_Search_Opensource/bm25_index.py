@@ -0,0 +1,439 @@
+"""
+bm25_index.py
+
+Inverted-index BM25 (Okapi) engine with MaxScore pruning.
+
+Layout (all flat NumPy arrays, memory-mappable from disk):
+    - vocabulary interned to integer term ids in sorted order, so a term is
+      found by binary search over the mapped vocabulary blob,
+    - postings per term as delta-encoded doc ids, stored at the narrowest
+      width (uint8/uint16/uint32) that fits the term's largest gap, with a
+      skip entry every SKIP_INTERVAL postings,
+    - a precomputed BM25 weight per posting (idf and length normalisation
+      already applied) and the maximum weight per term.
+
+Queries are scored term-at-a-time, highest-impact terms first. Once the
+remaining terms cannot lift an unseen doc above the current k-th best
+score, they are only probed (through the skip entries) for docs that can
+still reach the top k, instead of being decoded in full. Results are the
+same as exhaustive scoring (get_scores). That relies on no weight being
+negative, so the idf floor of very common terms is clamped at 0 (see
+okapi_idf); otherwise scores match rank_bm25's BM25Okapi.
+
+Indexing and querying share `tokenize`, so case and punctuation are
+handled identically on both sides.
+
+A shard of a larger corpus is built with the corpus' CollectionStats
+(document frequencies, size and average length), so its weights, and
+therefore its scores, are exactly those of one index over the whole corpus.
+"""
+
+import os
+import re
+import json
+import math
+from collections import Counter
+
+import numpy as np
+
+from mapped_strings import write_strings, MappedStrings
+
+
+SKIP_INTERVAL = 128
+_TOKEN_RE = re.compile(r"\w+")
+_GAP_DTYPES = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+_ARRAYS = (
+    "term_ptr", "term_width", "term_gap_offset", "term_first_doc", "term_max_weight",
+    "skip_ptr", "skip_doc", "gaps_1", "gaps_2", "gaps_4", "weights", "doc_len",
+)
+
+
+def tokenize(text):
+    """
+    Lower-cased word tokens; used for both documents and queries.
+    """
+    return _TOKEN_RE.findall(text.lower())
+
+
+def okapi_idf(df, corpus_size, epsilon=0.25):
+    """
+    rank_bm25.BM25Okapi idf: log((N - df + 0.5) / (df + 0.5)), with negative
+    values floored at epsilon * mean idf.
+
+    Unlike BM25Okapi, the floor itself is never below 0. It would be when the
+    mean idf is negative (small or common-term-heavy corpora), and negative
+    weights break MaxScore pruning and the 0 score floor of top_n_batch.
+    """
+    idf = np.log(corpus_size - df + 0.5) - np.log(df + 0.5)
+    if len(idf):
+        idf = np.where(idf < 0, max(epsilon * idf.mean(), 0.0), idf)
+    return idf
+
+
+class BM25Index:
+    """
+    Compressed inverted index with precomputed BM25 weights.
+
+    Build in memory with BM25Index.build(tokenized_corpus), persist with
+    save(path) and reopen memory-mapped with BM25Index.load(path).
+    """
+
+    def __init__(self, vocab, arrays, params):
+        self.vocab = vocab
+        self.params = params
+        self.k1 = params["k1"]
+        self.b = params["b"]
+        self.avgdl = params["avgdl"]
+        for name in _ARRAYS:
+            setattr(self, name, arrays[name])
+        self.corpus_size = len(self.doc_len)
+        self._gaps = {1: self.gaps_1, 2: self.gaps_2, 4: self.gaps_4}
+        self._term_ids = {}
+
+    # -- building ---------------------------------------------------------
+
+    @classmethod
+    def build(cls, tokenized_corpus, k1=1.5, b=0.75, epsilon=0.25, stats=None):
+        """
+        Index tokenized docs; with `stats` (CollectionStats), idf and avgdl are the collection's.
+        """
+        term_ids = {}
+        posting_terms, posting_docs, posting_tfs = [], [], []
+        doc_len = []
+        for doc_id, tokens in enumerate(tokenized_corpus):
+            doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+                posting_docs.append(doc_id)
+                posting_tfs.append(tf)
+
+        # Re-number terms in sorted order so the on-disk vocab is searchable
+        vocab = sorted(term_ids)
+        remap = np.empty(len(vocab), dtype=np.int64)
+        remap[[term_ids[t] for t in vocab]] = np.arange(len(vocab))
+        posting_terms = remap[np.asarray(posting_terms, dtype=np.int64)]
+        order = np.argsort(posting_terms, kind="stable")  # doc ids stay ascending
+        posting_terms = posting_terms[order]
+        posting_docs = np.asarray(posting_docs, dtype=np.int64)[order]
+        posting_tfs = np.asarray(posting_tfs, dtype=np.float64)[order]
+
+        doc_len = np.asarray(doc_len, dtype=np.int32)
+        corpus_size = len(doc_len)
+        df = np.bincount(posting_terms, minlength=len(vocab))
+        if stats is None:
+            avgdl = float(doc_len.mean()) if corpus_size else 0.0
+            idf = okapi_idf(df.astype(np.float64), corpus_size, epsilon)
+        else:
+            avgdl = stats.avgdl
+            idf = stats.idf(epsilon)[[stats.term_id(term) for term in vocab]]
+        doc_norm = k1 * (1 - b + b * doc_len / (avgdl or 1.0))
+        weights = idf[posting_terms] * posting_tfs * (k1 + 1) / (posting_tfs + doc_norm[posting_docs])
+
+        arrays = cls._encode(posting_terms, posting_docs, weights.astype(np.float32), df, len(vocab))
+        arrays["doc_len"] = doc_len
+        params = {"k1": k1, "b": b, "epsilon": epsilon, "avgdl": avgdl, "vocab_size": len(vocab)}
+        if stats is not None:
+            params["collection_size"] = stats.corpus_size
+        index = cls(vocab, arrays, params)
+        index._term_ids = {term: i for i, term in enumerate(vocab)}
+        return index
+
+    @staticmethod
+    def _encode(posting_terms, posting_docs, weights, df, n_terms):
+        term_ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=term_ptr[1:])
+        starts = term_ptr[:-1]
+        n = len(posting_docs)
+
+        # Gap to the previous posting of the same term; 0 at each term start
+        gaps = np.zeros(n, dtype=np.int64)
+        gaps[1:] = np.diff(posting_docs)
+        nonempty = df > 0
+        gaps[starts[nonempty]] = 0
+        term_first_doc = np.zeros(n_terms, dtype=np.int32)
+        term_first_doc[nonempty] = posting_docs[starts[nonempty]]
+
+        term_max_gap = np.zeros(n_terms, dtype=np.int64)
+        term_max_weight = np.zeros(n_terms, dtype=np.float32)
+        if n:
+            term_max_gap[nonempty] = np.maximum.reduceat(gaps, starts[nonempty])
+            term_max_weight[nonempty] = np.maximum.reduceat(weights, starts[nonempty])
+        term_width = np.where(term_max_gap < 2 ** 8, 1, np.where(term_max_gap < 2 ** 16, 2, 4)).astype(np.uint8)
+
+        arrays = {}
+        term_gap_offset = np.zeros(n_terms, dtype=np.int64)
+        posting_width = np.repeat(term_width, df)
+        for width, dtype in _GAP_DTYPES.items():
+            in_width = term_width == width
+            sizes = np.where(in_width, df, 0)
+            term_gap_offset[in_width] = (np.cumsum(sizes) - sizes)[in_width]
+            arrays[f"gaps_{width}"] = gaps[posting_width == width].astype(dtype)
+
+        # Skip entries: absolute doc id at every SKIP_INTERVAL-th posting
+        skips_per_term = (df + SKIP_INTERVAL - 1) // SKIP_INTERVAL
+        skip_ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(skips_per_term, out=skip_ptr[1:])
+        within = np.arange(n) - np.repeat(starts, df)
+        skip_doc = posting_docs[within % SKIP_INTERVAL == 0].astype(np.int32)
+
+        arrays.update({
+            "term_ptr": term_ptr,
+            "term_width": term_width,
+            "term_gap_offset": term_gap_offset,
+            "term_first_doc": term_first_doc,
+            "term_max_weight": term_max_weight,
+            "skip_ptr": skip_ptr,
+            "skip_doc": skip_doc,
+            "weights": weights,
+        })
+        return arrays
+
+    # -- persistence ------------------------------------------------------
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        write_strings(os.path.join(index_dir, "vocab"), list(self.vocab))
+        for name in _ARRAYS:
+            np.save(os.path.join(index_dir, name + ".npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(index_dir, "params.json"), "w", encoding="utf-8") as f:
+            json.dump(self.params, f, indent=2)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, "params.json"), encoding="utf-8") as f:
+            params = json.load(f)
+        arrays = {name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r") for name in _ARRAYS}
+        return cls(MappedStrings(os.path.join(index_dir, "vocab")), arrays, params)
+
+    # -- lookups ----------------------------------------------------------
+
+    def term_id(self, term):
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = self.vocab.find(term) if isinstance(self.vocab, MappedStrings) else -1
+            if len(self._term_ids) < 100_000:
+                self._term_ids[term] = term_id
+        return term_id
+
+    def doc_freq(self, term_id):
+        return int(self.term_ptr[term_id + 1] - self.term_ptr[term_id])
+
+    def _gap_slice(self, term_id, lo, hi):
+        width = int(self.term_width[term_id])
+        offset = self.term_gap_offset[term_id]
+        return self._gaps[width][offset + lo:offset + hi]
+
+    def postings(self, term_id):
+        """
+        All (doc ids, weights) of a term, doc ids ascending.
+        """
+        lo, hi = self.term_ptr[term_id], self.term_ptr[term_id + 1]
+        docs = self.term_first_doc[term_id] + np.cumsum(self._gap_slice(term_id, 0, hi - lo), dtype=np.int64)
+        return docs, self.weights[lo:hi]
+
+    def probe(self, term_id, candidates):
+        """
+        Weights of a term for sorted candidate docs (0 where absent).
+
+        Only the skip blocks that can contain a candidate are decoded.
+        """
+        lo, hi = self.term_ptr[term_id], self.term_ptr[term_id + 1]
+        n = hi - lo
+        skips = self.skip_doc[self.skip_ptr[term_id]:self.skip_ptr[term_id + 1]]
+        block = np.searchsorted(skips, candidates, side="right") - 1
+        blocks = np.unique(block[block >= 0])
+        out = np.zeros(len(candidates), dtype=np.float64)
+        if not len(blocks):
+            return out
+        if len(blocks) * SKIP_INTERVAL * 2 >= n:
+            docs, weights = self.postings(term_id)
+        else:
+            block_start = blocks * SKIP_INTERVAL
+            lengths = np.minimum(block_start + SKIP_INTERVAL, n) - block_start
+            seg_first = np.cumsum(lengths) - lengths
+            within = np.arange(lengths.sum()) - np.repeat(seg_first, lengths)
+            positions = np.repeat(block_start, lengths) + within
+            gaps = self._gap_slice(term_id, 0, n)[positions].astype(np.int64)
+            gaps[within == 0] = 0
+            running = np.cumsum(gaps)
+            docs = np.repeat(skips[blocks], lengths) + running - np.repeat(running[seg_first], lengths)
+            weights = self.weights[lo + positions]
+        found = np.searchsorted(docs, candidates)
+        found_clipped = np.minimum(found, len(docs) - 1)
+        hit = (found < len(docs)) & (docs[found_clipped] == candidates)
+        out[hit] = weights[found_clipped[hit]]
+        return out
+
+    # -- scoring ----------------------------------------------------------
+
+    def _query_terms(self, tokens):
+        # Repeated query tokens count once per occurrence, as in BM25Okapi. Indexes built
+        # before the idf floor was clamped at 0 can hold negative terms; they score as 0.
+        term_ids = (self.term_id(tok) for tok in tokens)
+        counts = Counter(t for t in term_ids if t >= 0 and self.term_max_weight[t] >= 0)
+        return list(counts.items())
+
+    def get_scores(self, tokens):
+        """
+        Exhaustive scores for every doc (same contract as BM25Okapi.get_scores).
+        """
+        scores = np.zeros(self.corpus_size)
+        for term_id, count in self._query_terms(tokens):
+            docs, weights = self.postings(term_id)
+            scores[docs] += count * weights
+        return scores
+
+    def top_n(self, tokens, n, live=None):
+        """
+        (doc ids, scores) of the n best docs, best first, with MaxScore pruning.
+
+        `live` is an optional boolean mask over the docs; docs it marks False
+        (tombstoned rows) are skipped while scoring.
+        """
+        terms = self._query_terms(tokens)
+        if not terms or n <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        bounds = np.array([count * float(self.term_max_weight[t]) for t, count in terms])
+        order = np.argsort(-bounds, kind="stable")
+        # remaining[j] = best score a doc can still gain from terms j, j+1, ...
+        remaining = np.cumsum(bounds[order][::-1])[::-1]
+
+        acc_docs = np.zeros(0, dtype=np.int64)
+        acc_scores = np.zeros(0)
+        for j, term_pos in enumerate(order):
+            term_id, count = terms[term_pos]
+            threshold = np.partition(acc_scores, -n)[-n] if len(acc_scores) >= n else -math.inf
+            if remaining[j] >= threshold:
+                # Essential term: an unseen doc could still reach the top n
+                docs, weights = self.postings(term_id)
+                if live is not None:
+                    keep = live[docs]
+                    docs, weights = docs[keep], weights[keep]
+                all_docs = np.concatenate([acc_docs, docs])
+                merged_docs, inverse = np.unique(all_docs, return_inverse=True)
+                acc_scores = np.bincount(
+                    inverse, weights=np.concatenate([acc_scores, count * weights.astype(np.float64)])
+                )
+                acc_docs = merged_docs
+            else:
+                # Non-essential: only docs that can still reach the threshold
+                alive = acc_scores + remaining[j] >= threshold
+                acc_docs, acc_scores = acc_docs[alive], acc_scores[alive]
+                acc_scores = acc_scores + count * self.probe(term_id, acc_docs)
+
+        k = min(n, len(acc_scores))
+        top = np.argpartition(-acc_scores, k - 1)[:k]
+        top = top[np.argsort(-acc_scores[top], kind="stable")]
+        return acc_docs[top], acc_scores[top]
+
+    def top_n_batch(self, queries, n, live=None):
+        """
+        (ids, scores, floors) for many tokenized queries; see hybrid_retriever.
+
+        ids/scores are (Q, n), best first, -1 for empty slots. BM25 scores are
+        never negative (okapi_idf keeps every idf >= 0), so the min-max floor
+        is reported as 0 rather than paying a full-corpus pass to find the
+        exact minimum.
+        """
+        ids = np.full((len(queries), n), -1, dtype=np.int64)
+        scores = np.zeros((len(queries), n))
+        for qi, tokens in enumerate(queries):
+            docs, doc_scores = self.top_n(tokens, n, live=live)
+            ids[qi, :len(docs)] = docs
+            scores[qi, :len(docs)] = doc_scores
+        return ids, scores, np.zeros(len(queries))
+
+
+class CollectionStats:
+    """
+    Corpus-wide BM25 statistics: sorted vocabulary, document frequencies, size and avgdl.
+
+    Shards built with the same stats score like a single index, and the
+    stats answer corpus_size / term_id / doc_freq like a BM25Index (which is
+    all ContextPacker needs).
+    """
+
+    def __init__(self, vocab, df, corpus_size, avgdl):
+        self.vocab = vocab
+        self.df = df
+        self.corpus_size = corpus_size
+        self.avgdl = avgdl
+        self._term_ids = {}
+
+    @classmethod
+    def build(cls, tokenized_corpus):
+        df = Counter()
+        corpus_size = total_len = 0
+        for tokens in tokenized_corpus:
+            corpus_size += 1
+            total_len += len(tokens)
+            df.update(set(tokens))
+        vocab = sorted(df)
+        stats = cls(vocab, np.array([df[t] for t in vocab], dtype=np.int64), corpus_size,
+                    total_len / corpus_size if corpus_size else 0.0)
+        stats._term_ids = {term: i for i, term in enumerate(vocab)}
+        return stats
+
+    def save(self, stats_dir):
+        os.makedirs(stats_dir, exist_ok=True)
+        write_strings(os.path.join(stats_dir, "vocab"), list(self.vocab))
+        np.save(os.path.join(stats_dir, "df.npy"), np.asarray(self.df))
+        with open(os.path.join(stats_dir, "params.json"), "w", encoding="utf-8") as f:
+            json.dump({"corpus_size": self.corpus_size, "avgdl": self.avgdl, "vocab_size": len(self.df)}, f, indent=2)
+
+    @classmethod
+    def load(cls, stats_dir):
+        with open(os.path.join(stats_dir, "params.json"), encoding="utf-8") as f:
+            params = json.load(f)
+        return cls(
+            MappedStrings(os.path.join(stats_dir, "vocab")), np.load(os.path.join(stats_dir, "df.npy"), mmap_mode="r"),
+            params["corpus_size"], params["avgdl"],
+        )
+
+    def term_id(self, term):
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = self.vocab.find(term) if isinstance(self.vocab, MappedStrings) else -1
+            if len(self._term_ids) < 100_000:
+                self._term_ids[term] = term_id
+        return term_id
+
+    def doc_freq(self, term_id):
+        return int(self.df[term_id])
+
+    def updated(self, added=(), removed=()):
+        """
+        New stats after adding and removing the given tokenized docs (cost ~ vocabulary + changes).
+        """
+        delta = Counter()
+        corpus_size, total_len = self.corpus_size, self.avgdl * self.corpus_size
+        for tokens in added:
+            corpus_size += 1
+            total_len += len(tokens)
+            delta.update(set(tokens))
+        for tokens in removed:
+            corpus_size -= 1
+            total_len -= len(tokens)
+            delta.subtract(set(tokens))
+        vocab = list(self.vocab)
+        df = np.asarray(self.df, dtype=np.int64).copy()
+        new_terms = sorted(t for t, change in delta.items() if change and self.term_id(t) < 0)
+        if new_terms:
+            vocab = vocab + new_terms
+            df = np.concatenate([df, np.zeros(len(new_terms), dtype=np.int64)])
+        term_ids = {term: i for i, term in enumerate(vocab)}
+        for term, change in delta.items():
+            if change:
+                df[term_ids[term]] += change
+        # Keep the vocabulary sorted (and free of terms no document has any more)
+        order = sorted((t for t in term_ids if df[term_ids[t]] > 0))
+        stats = CollectionStats(order, df[[term_ids[t] for t in order]], corpus_size,
+                                total_len / corpus_size if corpus_size > 0 else 0.0)
+        stats._term_ids = {term: i for i, term in enumerate(order)}
+        return stats
+
+    def idf(self, epsilon=0.25):
+        """
+        okapi_idf of every term over the whole collection.
+        """
+        return okapi_idf(np.asarray(self.df, dtype=np.float64), self.corpus_size, epsilon)
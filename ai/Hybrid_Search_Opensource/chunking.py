@@ -0,0 +1,209 @@
+"""
+chunking.py
+
+Turns ingested pages into the units that are indexed, embedded and sent to the LLM.
+
+Three steps:
+    - combine_page_text picks or fuzzy-merges the PDF text layer and the OCR
+      text of a page, instead of storing both copies of the same words,
+    - chunk_documents splits pages into size-bounded, overlapping chunks that
+      keep their source / page citation (plus a chunk number),
+    - deduplicate_chunks drops near-duplicate chunks across the corpus
+      (repeated headers, boilerplate pages, copies of the same PDF) with
+      MinHash signatures and LSH banding.
+"""
+
+import re
+import zlib
+
+import numpy as np
+
+from bm25_index import tokenize
+
+
+PAGE_TEXT_MODES = ("merge", "best", "pdf", "ocr", "concat")
+
+# Sentences of OCR text that share at least this fraction of their word
+# trigrams with the PDF text layer are treated as a re-read of that text.
+OCR_CONTAINMENT_THRESHOLD = 0.5
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+|\n+")
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def word_shingles(tokens, size):
+    """
+    Set of word n-grams (the whole token list when it is shorter than size).
+    """
+    if len(tokens) < size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+
+def merge_pdf_and_ocr(pdf_text, ocr_text, threshold=OCR_CONTAINMENT_THRESHOLD):
+    """
+    PDF text plus only the OCR sentences the text layer does not already contain.
+
+    OCR re-reads the text layer (with small recognition differences) and also
+    picks up text that only exists in images; this keeps the latter.
+    """
+    pdf_tokens = tokenize(pdf_text)
+    pdf_shingles = word_shingles(pdf_tokens, 3)
+    if not pdf_shingles:
+        return ocr_text.strip()
+    pdf_words = " " + " ".join(pdf_tokens) + " "
+    extra = []
+    for sentence in split_sentences(ocr_text):
+        tokens = tokenize(sentence)
+        if not tokens:
+            continue
+        if len(tokens) < 3:
+            # Too short for trigrams: contained if the words appear in that order
+            if " " + " ".join(tokens) + " " not in pdf_words:
+                extra.append(sentence)
+            continue
+        shingles = word_shingles(tokens, 3)
+        if len(shingles & pdf_shingles) / len(shingles) < threshold:
+            extra.append(sentence)
+    if not extra:
+        return pdf_text.strip()
+    return pdf_text.strip() + "\n" + " ".join(extra)
+
+
+def combine_page_text(pdf_text, ocr_text, mode="merge"):
+    """
+    Text of one page from its PDF text layer and OCR text.
+
+        merge   PDF text plus OCR sentences missing from it (default)
+        best    whichever source recovered more words; the text layer wins ties
+        pdf     PDF text layer, falling back to OCR for scanned pages
+        ocr     OCR text, falling back to the PDF text layer
+        concat  both, one after the other (the original behaviour)
+    """
+    pdf_text = pdf_text or ""
+    ocr_text = ocr_text or ""
+    if mode == "merge":
+        return merge_pdf_and_ocr(pdf_text, ocr_text)
+    if mode == "best":
+        return pdf_text if len(tokenize(pdf_text)) >= 0.9 * len(tokenize(ocr_text)) else ocr_text
+    if mode == "pdf":
+        return pdf_text if pdf_text.strip() else ocr_text
+    if mode == "ocr":
+        return ocr_text if ocr_text.strip() else pdf_text
+    if mode == "concat":
+        return pdf_text + "\n" + ocr_text
+    raise ValueError(f"Unknown page text mode {mode!r}; choose from {PAGE_TEXT_MODES}")
+
+
+def iter_chunks(docs, chunk_size=1000, chunk_overlap=150):
+    """
+    Yield (page doc, chunk number, chunk text) for every chunk of every page.
+
+    chunk_size <= 0 keeps whole pages (as chunk 0).
+    """
+    if chunk_size <= 0:
+        for doc in docs:
+            yield doc, 0, doc.page_content
+        return
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    for doc in docs:
+        for i, text in enumerate(splitter.split_text(doc.page_content)):
+            yield doc, i, text
+
+
+def chunk_documents(docs, chunk_size=1000, chunk_overlap=150):
+    """
+    Split page Documents into chunk Documents that keep the page metadata.
+
+    Every chunk gets a `chunk` number within its page.
+    """
+    from langchain.docstore.document import Document
+
+    return [
+        Document(page_content=text, metadata={**doc.metadata, "chunk": i})
+        for doc, i, text in iter_chunks(docs, chunk_size, chunk_overlap)
+    ]
+
+
+def chunk_store(docs, chunk_size=1000, chunk_overlap=150):
+    """
+    chunk_documents straight into a DocStore, without a Document per chunk.
+    """
+    from doc_store import DocStoreBuilder
+
+    builder = DocStoreBuilder()
+    for doc, i, text in iter_chunks(docs, chunk_size, chunk_overlap):
+        metadata = doc.metadata
+        builder.add(text, metadata["source"], metadata["page"], i)
+    return builder.build()
+
+
+class MinHasher:
+    """
+    MinHash signatures of word-shingle sets, using (a * x + b) mod p permutations.
+    """
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=0):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self._a = rng.integers(1, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        """
+        uint64 signature, or None for text without any words.
+        """
+        shingles = word_shingles(tokenize(text), self.shingle_size)
+        if not shingles:
+            return None
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)
+        ) % _MERSENNE_PRIME
+        # a, x < 2^31, so a * x + b cannot overflow uint64
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+
+def deduplicate_chunks(docs, threshold=0.85, num_perm=128, bands=16, shingle_size=5):
+    """
+    Drop chunks whose estimated Jaccard similarity to an earlier chunk is >= threshold.
+
+    Candidate pairs come from LSH buckets (bands x rows = num_perm) and are
+    confirmed on the full signatures. Chunks without any words are dropped
+    too. Returns (kept docs, number removed); a DocStore comes back as a
+    DocStore of the kept rows.
+    """
+    if num_perm % bands:
+        raise ValueError(f"bands={bands} must divide num_perm={num_perm}")
+    rows = num_perm // bands
+    hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+    buckets = [dict() for _ in range(bands)]
+    kept_signatures = []
+    kept = []
+    removed = 0
+    for doc in docs:
+        signature = hasher.signature(doc.page_content)
+        if signature is None:
+            removed += 1
+            continue
+        keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(bands)]
+        candidates = set()
+        for band, key in enumerate(keys):
+            candidates.update(buckets[band].get(key, ()))
+        if any(np.mean(kept_signatures[c] == signature) >= threshold for c in candidates):
+            removed += 1
+            continue
+        position = len(kept)
+        for band, key in enumerate(keys):
+            buckets[band].setdefault(key, []).append(position)
+        kept_signatures.append(signature)
+        kept.append(doc)
+    if hasattr(docs, "take"):
+        return docs.take([doc.index for doc in kept]), removed
+    return kept, removed
@@ -0,0 +1,236 @@
+"""
+cli.py
+
+Command line for the hybrid RAG pipeline:
+
+    python cli.py ingest                     # ingest the container and write the index snapshot
+    python cli.py sync                       # apply new / changed / deleted blobs to the snapshot
+    python cli.py query "how do I ..."       # hybrid search against the snapshot
+    python cli.py query --answer "..."       # ... and stream an LLM answer
+    python cli.py serve --port 8080          # rag_server.py
+    python cli.py bench pipeline --scales 1000
+    python cli.py bench vector-index --n 100000
+    python cli.py bench startup              # import-time budget check
+
+Only argparse is imported up front; every command imports what it needs when
+it runs. A `query` never loads LangChain, the Azure SDKs or pypdf unless it
+has to call Azure (Azure embeddings or --answer). A snapshot built with the
+offline HashingEmbedder is queried without any Azure settings.
+
+`bench startup` imports cli and the query modules in fresh interpreters,
+fails (exit 1) if that pulls in a heavy dependency or takes longer than
+--budget-ms, and prints the slowest imports; run it in CI to keep query
+startup fast.
+"""
+
+import os
+import sys
+import argparse
+
+
+# Modules a `query` against a snapshot must not import (top-level package names)
+HEAVY_MODULES = ("langchain", "langchain_core", "langchain_openai", "azure", "openai", "pypdf", "aiohttp")
+
+# What a query needs before it can search: the snapshot, the retriever and the config module
+QUERY_IMPORTS = "import index_snapshot, hybrid_retriever, sharded_index, Hybrid_Search1_OpenSource"
+
+
+def _open_snapshot(args):
+    import Hybrid_Search1_OpenSource as hybrid
+
+    snapshot = hybrid.open_snapshot(args.snapshot)
+    if snapshot.manifest["embedding_model"] == "hashing":
+        from local_backends import HashingEmbedder
+        embeddings_model = HashingEmbedder(dim=snapshot.manifest["embedding_dim"])
+    else:
+        if snapshot.manifest["embedding_model"] != hybrid.EMBEDDING_MODEL:
+            raise SystemExit(
+                f"Snapshot was built with {snapshot.manifest['embedding_model']}, not {hybrid.EMBEDDING_MODEL}; "
+                "run `python cli.py ingest`"
+            )
+        embeddings_model = hybrid.build_embedding_service()
+    return hybrid, snapshot, embeddings_model
+
+
+def cmd_ingest(args):
+    import Hybrid_Search1_OpenSource as hybrid
+
+    if args.snapshot:
+        hybrid.INDEX_SNAPSHOT_DIR = args.snapshot
+    if args.shards:
+        hybrid.INDEX_SHARDS = args.shards
+    hybrid.build_snapshot(hybrid.build_embedding_service())
+    print(f"Stages: {hybrid.metrics.stage_summary()}")
+
+
+def cmd_sync(args):
+    import Hybrid_Search1_OpenSource as hybrid
+
+    if args.snapshot:
+        hybrid.INDEX_SNAPSHOT_DIR = args.snapshot
+    if args.shards:
+        hybrid.INDEX_SHARDS = args.shards
+    summary = hybrid.sync_snapshot(hybrid.build_embedding_service(), compact=args.compact)
+    print(f"Sync: {summary}")
+    print(f"Stages: {hybrid.metrics.stage_summary()}")
+
+
+def cmd_query(args):
+    import json
+
+    hybrid, snapshot, embeddings_model = _open_snapshot(args)
+    params = {
+        "top_k": args.top_k or hybrid.HYBRID_TOP_K,
+        "alpha": hybrid.HYBRID_ALPHA if args.alpha is None else args.alpha,
+        "candidate_factor": args.candidate_factor or hybrid.HYBRID_CANDIDATE_FACTOR,
+        "fusion": args.fusion or hybrid.HYBRID_FUSION,
+        "mmr_lambda": hybrid.HYBRID_MMR_LAMBDA if args.mmr_lambda is None else args.mmr_lambda,
+        "max_per_source": hybrid.HYBRID_MAX_PER_SOURCE if args.max_per_source is None else args.max_per_source,
+    }
+    if args.answer:
+        pipeline = hybrid.build_rag_pipeline(snapshot, embeddings_model, verbose=False)
+        for query in args.queries:
+            for token in pipeline.stream(query, **params):
+                print(token, end="", flush=True)
+            print()
+        return
+
+    retriever = hybrid.build_retriever(snapshot, embeddings_model)
+    ids, scores = retriever.search_ids_batch(args.queries, **params)
+    results = []
+    for query, row_ids, row_scores in zip(args.queries, ids, scores):
+        hits = [
+            {"id": int(i), "score": round(float(score), 4), **snapshot.docs.metadata(i), "text": snapshot.docs.text(i)}
+            for i, score in zip(row_ids, row_scores) if i >= 0
+        ]
+        results.append({"query": query, "results": hits})
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return
+    for result in results:
+        print(f"🔎 {result['query']}")
+        for hit in result["results"]:
+            preview = " ".join(hit["text"].split())[:160]
+            print(f"  {hit['score']:.4f}  [{hit['source']}, Page {hit['page']}]  {preview}")
+
+
+def cmd_serve(args):
+    import rag_server
+
+    rag_server.main(args.args)
+
+
+def cmd_bench(args):
+    if args.target == "pipeline":
+        import bench_pipeline
+        bench_pipeline.run(bench_pipeline.parse_args(args.args))
+    elif args.target == "vector-index":
+        import bench_vector_index
+        bench_vector_index.run(bench_vector_index.parse_args(args.args))
+    else:
+        sys.exit(0 if check_startup(args.budget_ms, args.runs) else 1)
+
+
+def _import_profile(statement):
+    """
+    (cumulative µs per module, wall seconds) of running statement in a fresh interpreter.
+    """
+    import time
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=here, capture_output=True, text=True, env={**os.environ, "PIPELINE_METRICS": "1"},
+    )
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"`{statement}` failed:\n{proc.stderr[-2000:]}")
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative.strip())
+    return modules, seconds
+
+
+def check_startup(budget_ms=1000, runs=3):
+    """
+    True if importing cli and the query modules stays within budget_ms and loads no heavy module.
+    """
+    ok = True
+    for label, statement in (("cli", "import cli"), ("query", QUERY_IMPORTS)):
+        profiles = [_import_profile(statement) for _ in range(runs)]
+        modules = profiles[-1][0]
+        best_ms = min(seconds for _, seconds in profiles) * 1000
+        heavy = sorted({name.split(".")[0] for name in modules} & set(HEAVY_MODULES))
+        status = "✅" if best_ms <= budget_ms and not heavy else "❌"
+        print(f"{status} {label}: {best_ms:.0f} ms interpreter start + imports (budget {budget_ms} ms)")
+        if heavy:
+            print(f"   heavy modules imported: {', '.join(heavy)}")
+        top_level = {name: us for name, us in modules.items() if "." not in name}
+        for name, us in sorted(top_level.items(), key=lambda item: -item[1])[:5]:
+            print(f"   {us / 1000:8.1f} ms  {name}")
+        ok = ok and status == "✅"
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Hybrid search / RAG pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="ingest the blob container and write the index snapshot")
+    ingest.add_argument("--snapshot", help="snapshot directory (default INDEX_SNAPSHOT_DIR)")
+    ingest.add_argument("--shards", type=int, help="partition the index into this many shards (default INDEX_SHARDS)")
+    ingest.set_defaults(handler=cmd_ingest)
+
+    sync = commands.add_parser("sync", help="ingest only new or changed blobs into the sharded index snapshot")
+    sync.add_argument("--snapshot", help="snapshot directory (default INDEX_SNAPSHOT_DIR)")
+    sync.add_argument("--shards", type=int, help="shard count of a first full build (default INDEX_SHARDS)")
+    sync.add_argument("--compact", action="store_true", help="compact segments and tombstones after syncing")
+    sync.set_defaults(handler=cmd_sync)
+
+    query = commands.add_parser("query", help="hybrid search (or answer) against the index snapshot")
+    query.add_argument("queries", nargs="+")
+    query.add_argument("--snapshot", help="snapshot directory (default INDEX_SNAPSHOT_DIR)")
+    query.add_argument("--top-k", type=int)
+    query.add_argument("--alpha", type=float)
+    query.add_argument("--candidate-factor", type=int)
+    query.add_argument("--fusion", choices=["minmax", "rrf", "zscore"])
+    query.add_argument("--mmr-lambda", type=float, help="MMR re-ranking: 1.0 = relevance only, lower = more diverse")
+    query.add_argument("--max-per-source", type=int, help="at most this many hits per PDF (0 = no cap)")
+    query.add_argument("--answer", action="store_true", help="stream an LLM answer instead of the hits")
+    query.add_argument("--json", action="store_true", help="print the hits as JSON")
+    query.set_defaults(handler=cmd_query)
+
+    serve = commands.add_parser("serve", help="run rag_server.py (arguments are passed through)")
+    serve.set_defaults(handler=cmd_serve, passthrough=True)
+
+    bench = commands.add_parser("bench", help="benchmarks and the startup import check")
+    targets = bench.add_subparsers(dest="target", required=True)
+    for name, description in (("pipeline", "bench_pipeline.py"), ("vector-index", "bench_vector_index.py")):
+        target = targets.add_parser(name, help=f"run {description} (arguments are passed through)")
+        target.set_defaults(passthrough=True)
+    startup = targets.add_parser("startup", help="check cli / query import time and heavy imports")
+    startup.add_argument("--budget-ms", type=int, default=1000, help="allowed interpreter start + import time")
+    startup.add_argument("--runs", type=int, default=3, help="best of this many runs")
+    bench.set_defaults(handler=cmd_bench)
+
+    # serve / bench pipeline / bench vector-index hand unknown options to the script they run
+    args, extra = parser.parse_known_args(argv)
+    if extra and not getattr(args, "passthrough", False):
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    args.args = extra
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+context_packing.py
+
+Fits retrieved chunks into a token budget for the RAG prompt.
+
+Chunks are packed in fused-score order. Sentences that mostly repeat text
+already packed are dropped, and a chunk that does not fit the remaining
+budget is trimmed to its most query-relevant sentences (kept in reading
+order). Every packed passage keeps its `[source, Page N]` citation.
+"""
+
+import numpy as np
+
+from bm25_index import tokenize
+from chunking import split_sentences, word_shingles
+from embedding_service import TokenCounter
+
+
+def format_citation(doc):
+    return f"[{doc.metadata['source']}, Page {doc.metadata['page']}]"
+
+
+def format_passage(text, doc):
+    return f"{text}\n{format_citation(doc)}"
+
+
+class PackedContext:
+    """
+    Packed prompt context plus what it cost and saved, in tokens.
+    """
+
+    def __init__(self, text, docs, tokens, unpacked_tokens, trimmed, dropped):
+        self.text = text
+        self.docs = docs
+        self.tokens = tokens
+        self.unpacked_tokens = unpacked_tokens
+        self.trimmed = trimmed
+        self.dropped = dropped
+
+    @property
+    def saved_tokens(self):
+        return max(self.unpacked_tokens - self.tokens, 0)
+
+    def stats(self):
+        return {
+            "tokens": self.tokens,
+            "unpacked_tokens": self.unpacked_tokens,
+            "saved_tokens": self.saved_tokens,
+            "passages": len(self.docs),
+            "trimmed": self.trimmed,
+            "dropped": self.dropped,
+        }
+
+
+class ContextPacker:
+    """
+    Packs Documents into at most max_tokens tokens of prompt context.
+
+    With a BM25Index, query terms are weighted by idf when ranking sentences,
+    so rare terms count for more than common ones.
+    """
+
+    def __init__(self, max_tokens=2000, token_counter=None, bm25=None, redundancy_threshold=0.6):
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter or TokenCounter()
+        self.bm25 = bm25
+        self.redundancy_threshold = redundancy_threshold
+
+    def _term_weights(self, query):
+        terms = set(tokenize(query))
+        if self.bm25 is None:
+            return {term: 1.0 for term in terms}
+        n = self.bm25.corpus_size
+        weights = {}
+        for term in terms:
+            term_id = self.bm25.term_id(term)
+            df = self.bm25.doc_freq(term_id) if term_id >= 0 else 0
+            weights[term] = float(np.log1p(n / (df + 1)))
+        return weights
+
+    def pack(self, query, docs, scores=None):
+        """
+        PackedContext for docs; scores (fused, higher is better) set the order.
+        """
+        count = self.token_counter.count
+        docs = list(docs)
+        if scores is not None:
+            docs = [docs[i] for i in np.argsort(-np.asarray(scores), kind="stable")]
+        unpacked_tokens = count("\n\n".join(format_passage(doc.page_content, doc) for doc in docs))
+        weights = self._term_weights(query)
+
+        seen = set()
+        passages, packed_docs = [], []
+        trimmed = dropped = 0
+        remaining = self.max_tokens
+        for doc in docs:
+            budget = remaining - count(format_citation(doc)) - 2
+            if budget <= 0:
+                dropped += 1
+                continue
+            all_sentences = split_sentences(doc.page_content)
+            sentences = []
+            for sentence in all_sentences:
+                tokens = tokenize(sentence)
+                shingles = word_shingles(tokens, 3)
+                if shingles and len(shingles & seen) / len(shingles) >= self.redundancy_threshold:
+                    continue
+                relevance = sum(weights.get(term, 0.0) for term in set(tokens))
+                sentences.append((sentence, shingles, count(sentence) + 1, relevance))
+            if not sentences:
+                dropped += 1
+                continue
+
+            keep = list(range(len(sentences)))
+            if sum(s[2] for s in sentences) > budget:
+                # Most relevant sentences first, earlier ones on ties; sentences
+                # without query terms only when none of the chunk's have any
+                candidates = [i for i in keep if sentences[i][3] > 0] or keep
+                keep, used = [], 0
+                for i in sorted(candidates, key=lambda i: (-sentences[i][3], i)):
+                    if used + sentences[i][2] <= budget:
+                        keep.append(i)
+                        used += sentences[i][2]
+                keep.sort()
+                if not keep:
+                    dropped += 1
+                    continue
+            if len(keep) == len(all_sentences):
+                text = doc.page_content.strip()
+            else:
+                text = " ".join(sentences[i][0] for i in keep)
+                trimmed += 1
+
+            passage = format_passage(text, doc)
+            remaining -= count(passage) + 2
+            for i in keep:
+                seen |= sentences[i][1]
+            passages.append(passage)
+            packed_docs.append(doc)
+
+        text = "\n\n".join(passages)
+        return PackedContext(text, packed_docs, count(text), unpacked_tokens, trimmed, dropped)
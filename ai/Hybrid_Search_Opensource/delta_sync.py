@@ -0,0 +1,415 @@
+"""
+delta_sync.py
+
+Incremental ingestion into a sharded index snapshot (sharded_index.py).
+
+The snapshot keeps a blob manifest, blobs.json, with one fingerprint per
+ingested PDF:
+
+    {blob name: {etag, size, last_modified, content_hash}}
+
+A sync lists the container and diffs the listing against it. Only new blobs
+and blobs whose ETag, size or modification time moved are downloaded; of
+those, blobs whose SHA-256 still matches content_hash are not parsed,
+OCR'd or embedded again (a re-upload of the same file only refreshes the
+fingerprint). Blobs that fail to ingest are left out of blobs.json, and
+their old chunks are not tombstoned, so the next sync retries them.
+
+Chunks of deleted and changed blobs are tombstoned: every shard gets a
+sorted .npy file of its deleted row ids, which the shard searchers skip.
+The chunks of new and changed blobs go into a new delta segment, a shard
+like the others built with the updated collection statistics. Segments
+and tombstones are folded back into regular shards by compact_snapshot,
+which runs once too many rows are dead or too many segments have piled
+up; embeddings come from the embedding cache, so compaction costs no
+embedding calls.
+
+Syncs and compactions of a snapshot hold an exclusive lock on a
+<snapshot_dir>.lock file next to it, so they never interleave, whether
+they run in one process or in several. With max_blobs, a sync ingests at
+most that many of the new and changed blobs; the rest wait for the next
+sync, and deletions are still taken from the full listing.
+
+Until compaction, the precomputed BM25 weights of the older shards keep the
+collection statistics they were built with; new segments use the current
+ones.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+
+from bm25_index import BM25Index, CollectionStats, tokenize
+from doc_store import DocStore
+from index_snapshot import read_manifest, save_snapshot
+from metrics import metrics
+from sharded_index import (
+    BLOBS_FILE, STATS_DIR, build_sharded_snapshot, is_sharded, read_shards_manifest, write_shards_manifest
+)
+
+
+DEFAULT_COMPACT_RATIO = 0.2
+DEFAULT_MAX_SEGMENTS = 8
+
+_compaction = None
+
+
+@contextlib.contextmanager
+def snapshot_lock(snapshot_dir):
+    """
+    Exclusive lock on snapshot_dir, held across threads and processes (see module docstring).
+
+    The lock file sits next to the directory because compaction swaps the directory itself.
+    """
+    path = os.path.abspath(snapshot_dir) + ".lock"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    pass
+        # Closing the file releases the lock
+        yield
+
+
+def blob_fingerprint(blob):
+    """
+    {etag, size, last_modified} of a listed blob (BlobProperties or LocalBlob).
+    """
+    last_modified = getattr(blob, "last_modified", None)
+    return {
+        "etag": getattr(blob, "etag", None),
+        "size": getattr(blob, "size", None),
+        "last_modified": last_modified.isoformat() if last_modified is not None else None,
+    }
+
+
+def list_fingerprints(container_client):
+    """
+    {name: fingerprint} of the PDF blobs in the container, sorted by name.
+    """
+    listing = {blob.name: blob_fingerprint(blob) for blob in container_client.list_blobs()
+               if blob.name.endswith(".pdf")}
+    return {name: listing[name] for name in sorted(listing)}
+
+
+def read_blob_manifest(snapshot_dir):
+    """
+    The blobs.json fingerprints of a snapshot, or None if it was not built by a sync.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, BLOBS_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_blob_manifest(snapshot_dir, blobs):
+    path = os.path.join(snapshot_dir, BLOBS_FILE)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(blobs, f)
+    os.replace(tmp_path, path)
+
+
+def diff_listing(blobs, listing, max_blobs=None):
+    """
+    (new, changed, deleted) blob names of a container listing against the blob manifest.
+
+    max_blobs caps new + changed (first by name); deleted always covers the whole listing.
+    """
+    new = [name for name in listing if name not in blobs]
+    changed = [
+        name for name, fingerprint in listing.items()
+        if name in blobs and any(blobs[name].get(key) != value for key, value in fingerprint.items())
+    ]
+    deleted = sorted(name for name in blobs if name not in listing)
+    if max_blobs:
+        pending = set(sorted(new + changed)[:max_blobs])
+        new = [name for name in new if name in pending]
+        changed = [name for name in changed if name in pending]
+    return new, changed, deleted
+
+
+class ContentFilter:
+    """
+    content_filter for iter_ingested_documents: passes blobs whose SHA-256 differs from the manifest.
+
+    `hashes` collects the hash of every downloaded blob and `changed` the
+    names that passed. Its `failed` method is the on_failure callback of the
+    same ingestion: a blob that failed at any stage stays out of `done`, so
+    its old chunks stay live and it is retried by the next sync.
+    """
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.hashes = {}
+        self.changed = set()
+        self.failures = set()
+        self._lock = threading.Lock()
+
+    def failed(self, name):
+        with self._lock:
+            self.failures.add(name)
+
+    def done(self, names):
+        """
+        The names that were downloaded and, if they changed, made it through every stage.
+        """
+        return [name for name in names if name in self.hashes and name not in self.failures]
+
+    def __call__(self, name, pdf_bytes):
+        content_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        with self._lock:
+            self.hashes[name] = content_hash
+            if self.blobs.get(name, {}).get("content_hash") == content_hash:
+                return False
+            self.changed.add(name)
+            return True
+
+
+def dead_ratio(manifest):
+    """
+    Share of the snapshot's rows that are tombstoned.
+    """
+    total = sum(shard["doc_count"] for shard in manifest["shards"])
+    deleted = sum(shard.get("deleted", 0) for shard in manifest["shards"])
+    return deleted / total if total else 0.0
+
+
+def segment_count(manifest):
+    return sum(1 for shard in manifest["shards"] if shard["name"].startswith("delta_"))
+
+
+def needs_compaction(manifest, compact_ratio=DEFAULT_COMPACT_RATIO, max_segments=DEFAULT_MAX_SEGMENTS):
+    return dead_ratio(manifest) > compact_ratio or segment_count(manifest) > max_segments
+
+
+def _remove_unreferenced(snapshot_dir, manifest):
+    # Stats and tombstones of earlier syncs; kept for one sync so readers opening the old manifest find them
+    keep = {manifest.get("stats", STATS_DIR)} | {s["tombstones"] for s in manifest["shards"] if s.get("tombstones")}
+    for name in os.listdir(snapshot_dir):
+        if name in keep:
+            continue
+        path = os.path.join(snapshot_dir, name)
+        if name.startswith(f"{STATS_DIR}-"):
+            shutil.rmtree(path, ignore_errors=True)
+        elif ".deleted-" in name and name.endswith(".npy"):
+            os.remove(path)
+
+
+def _tombstone_sources(snapshot_dir, manifest, sources):
+    """
+    Tombstone every live row of the given sources; returns their token lists (for the stats).
+    """
+    removed_tokens = []
+    if not sources:
+        return removed_tokens
+    for shard in manifest["shards"]:
+        shard_dir = os.path.join(snapshot_dir, shard["name"])
+        store = DocStore.open(shard_dir, read_manifest(shard_dir)["sources"])
+        rows = [store.source_rows(source) for source in sources if source in store.sources]
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        deleted = np.zeros(0, dtype=np.int64)
+        if shard.get("tombstones"):
+            deleted = np.load(os.path.join(snapshot_dir, shard["tombstones"]))
+        rows = np.setdiff1d(rows, deleted)
+        if not len(rows):
+            continue
+        removed_tokens.extend(tokenize(store.text(i)) for i in rows)
+        deleted = np.union1d(deleted, rows).astype(np.int64)
+        shard["tombstones"] = f"{shard['name']}.deleted-{uuid.uuid4().hex[:8]}.npy"
+        np.save(os.path.join(snapshot_dir, shard["tombstones"]), deleted)
+        shard["deleted"] = len(deleted)
+    return removed_tokens
+
+
+def sync_snapshot(snapshot_dir, container_client, ingest_fn, embeddings_model, embedding_model, n_shards=1,
+                  partition="source", max_blobs=None, compact_ratio=DEFAULT_COMPACT_RATIO,
+                  max_segments=DEFAULT_MAX_SEGMENTS, background_compaction=False, **build_params):
+    """
+    Bring the sharded snapshot in snapshot_dir up to date with the container.
+
+    `ingest_fn(blob_names, content_filter)` returns the chunk DocStore of the
+    given blobs (Hybrid_Search1_OpenSource.ingest_documents) and reports
+    blobs that fail to content_filter.failed. Without a
+    sharded snapshot carrying a blob manifest this is a full build with
+    build_sharded_snapshot (n_shards, partition and **build_params);
+    otherwise only the changes are applied. Returns a summary dict.
+    """
+    with snapshot_lock(snapshot_dir):
+        listing = list_fingerprints(container_client)
+        blobs = read_blob_manifest(snapshot_dir) if is_sharded(snapshot_dir) else None
+        if blobs is None:
+            if max_blobs:
+                listing = {name: listing[name] for name in list(listing)[:max_blobs]}
+            return _full_sync(snapshot_dir, listing, ingest_fn, embeddings_model, embedding_model, n_shards,
+                              partition, **build_params)
+
+        manifest = read_shards_manifest(snapshot_dir)
+        _remove_unreferenced(snapshot_dir, manifest)
+        new, changed, deleted = diff_listing(blobs, listing, max_blobs=max_blobs)
+        summary = {"mode": "delta", "new": len(new), "changed": len(changed), "deleted": len(deleted),
+                   "reingested": 0, "added_chunks": 0, "removed_chunks": 0, "failed": 0, "compacted": False}
+        print(f"🔄 Sync: {len(new)} new, {len(changed)} changed, {len(deleted)} deleted of {len(listing)} blobs")
+        if not (new or changed or deleted):
+            return summary
+
+        content_filter = ContentFilter(blobs)
+        docs = ingest_fn(new + changed, content_filter) if new or changed else DocStore.concat([])
+        done = content_filter.done(new + changed)
+        removed_sources = set(deleted) | (set(done) & set(changed) & content_filter.changed)
+        with metrics.span("sync_tombstones"):
+            removed_tokens = _tombstone_sources(snapshot_dir, manifest, removed_sources)
+        added_tokens = [tokenize(text) for text in docs.texts()]
+
+        stats_dir = os.path.join(snapshot_dir, manifest.get("stats", STATS_DIR))
+        with metrics.span("bm25_stats"):
+            stats = CollectionStats.load(stats_dir).updated(added=added_tokens, removed=removed_tokens)
+        manifest["stats"] = f"{STATS_DIR}-{uuid.uuid4().hex[:8]}"
+        stats.save(os.path.join(snapshot_dir, manifest["stats"]))
+
+        if len(docs):
+            _add_segment(snapshot_dir, manifest, docs, added_tokens, stats, embeddings_model)
+
+        manifest["snapshot_id"] = uuid.uuid4().hex
+        manifest["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        manifest["doc_count"] = sum(shard["doc_count"] - shard.get("deleted", 0) for shard in manifest["shards"])
+        # The manifest goes first: if the blob manifest is lost, the next sync only redoes this one
+        write_shards_manifest(snapshot_dir, manifest)
+        for name in deleted:
+            blobs.pop(name, None)
+        for name in done:
+            blobs[name] = {**listing[name], "content_hash": content_filter.hashes[name]}
+        write_blob_manifest(snapshot_dir, blobs)
+
+        summary.update(reingested=len(content_filter.changed - content_filter.failures), added_chunks=len(docs),
+                       removed_chunks=len(removed_tokens), failed=len(content_filter.failures))
+        print(f"✅ Synced: +{len(docs)} chunks, -{len(removed_tokens)} tombstoned, "
+              f"{dead_ratio(manifest):.0%} dead, {segment_count(manifest)} delta segments")
+        if content_filter.failures:
+            print(f"⚠️  {len(content_filter.failures)} blobs failed to ingest; "
+                  "their old chunks stay live and the next sync retries them")
+
+    if needs_compaction(manifest, compact_ratio, max_segments):
+        if background_compaction:
+            compact_in_background(snapshot_dir, embeddings_model, **build_params)
+        else:
+            compact_snapshot(snapshot_dir, embeddings_model, **build_params)
+            summary["compacted"] = True
+    return summary
+
+
+def _full_sync(snapshot_dir, listing, ingest_fn, embeddings_model, embedding_model, n_shards, partition,
+               **build_params):
+    print(f"🔄 Sync: no blob manifest in {snapshot_dir}, ingesting all {len(listing)} blobs")
+    content_filter = ContentFilter({})
+    docs = ingest_fn(list(listing), content_filter)
+    with metrics.span("embedding"):
+        vectors = embeddings_model.embed_documents(list(docs.texts()))
+    blobs = {name: {**listing[name], "content_hash": content_filter.hashes[name]}
+             for name in content_filter.done(listing)}
+    build_sharded_snapshot(snapshot_dir, docs, vectors, max(n_shards, 1), embedding_model, partition=partition,
+                           blobs=blobs, **build_params)
+    return {"mode": "full", "new": len(listing), "changed": 0, "deleted": 0, "reingested": len(blobs),
+            "added_chunks": len(docs), "removed_chunks": 0, "failed": len(content_filter.failures),
+            "compacted": False}
+
+
+def _add_segment(snapshot_dir, manifest, docs, tokens, stats, embeddings_model):
+    """
+    Write docs as the next delta_XXXX shard (flat vector index) and append it to the manifest.
+    """
+    from vector_index import build_vector_index
+
+    with metrics.span("embedding"):
+        vectors = embeddings_model.embed_documents(list(docs.texts()))
+    with metrics.span("bm25_build"):
+        bm25 = BM25Index.build(tokens, stats=stats)
+    # Segments are small and short-lived; an exact index needs no training
+    with metrics.span("vector_index_build"):
+        faiss_index, vector_config = build_vector_index(np.asarray(vectors, dtype=np.float32), "flat")
+    segment = manifest.get("next_segment", 1)
+    name = f"delta_{segment:04d}"
+    save_snapshot(
+        os.path.join(snapshot_dir, name), docs, bm25, faiss_index, manifest["embedding_model"],
+        embedding_deployment=manifest.get("embedding_deployment"), vector_index_config=vector_config,
+    )
+    manifest["next_segment"] = segment + 1
+    manifest["shards"].append({"name": name, "doc_count": len(docs), "deleted": 0, "tombstones": None})
+
+
+def live_docs(snapshot_dir, manifest=None):
+    """
+    In-memory DocStore of every row that is not tombstoned, sorted by (source, page, chunk).
+    """
+    manifest = manifest or read_shards_manifest(snapshot_dir)
+    stores = []
+    for shard in manifest["shards"]:
+        shard_dir = os.path.join(snapshot_dir, shard["name"])
+        store = DocStore.open(shard_dir, read_manifest(shard_dir)["sources"])
+        live = np.arange(len(store))
+        if shard.get("tombstones"):
+            live = np.setdiff1d(live, np.load(os.path.join(snapshot_dir, shard["tombstones"])))
+        stores.append(store.take(live))
+    return DocStore.concat(stores).sorted()
+
+
+def compact_snapshot(snapshot_dir, embeddings_model, **build_params):
+    """
+    Rebuild the live rows as regular shards: no segments, no tombstones, current BM25 statistics.
+
+    The vector index type and parameters recorded at the last full build are
+    kept unless given in build_params.
+    """
+    global _compaction
+    with snapshot_lock(snapshot_dir):
+        manifest = read_shards_manifest(snapshot_dir)
+        with metrics.span("compaction"):
+            docs = live_docs(snapshot_dir, manifest)
+            with metrics.span("embedding"):
+                vectors = embeddings_model.embed_documents(list(docs.texts()))
+            vector_index = dict(manifest.get("vector_index", {}))
+            params = {"vector_index_type": vector_index.pop("type", "flat"), **vector_index,
+                      "embedding_deployment": manifest.get("embedding_deployment"), **build_params}
+            print(f"🗜️  Compacting {segment_count(manifest)} delta segments and "
+                  f"{dead_ratio(manifest):.0%} dead rows into {manifest['n_shards']} shards")
+            build_sharded_snapshot(
+                snapshot_dir, docs, vectors, manifest["n_shards"], manifest["embedding_model"],
+                partition=manifest["partition"], blobs=read_blob_manifest(snapshot_dir), **params,
+            )
+        if _compaction is threading.current_thread():
+            _compaction = None
+
+
+def compact_in_background(snapshot_dir, embeddings_model, **build_params):
+    """
+    Run compact_snapshot in a thread (at most one); the next sync waits for it.
+    """
+    global _compaction
+    if _compaction is not None and _compaction.is_alive():
+        return _compaction
+    _compaction = threading.Thread(
+        target=compact_snapshot, args=(snapshot_dir, embeddings_model), kwargs=build_params, name="compaction"
+    )
+    _compaction.start()
+    return _compaction
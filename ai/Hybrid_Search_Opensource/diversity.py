@@ -0,0 +1,74 @@
+"""
+diversity.py
+
+Maximal Marginal Relevance (MMR) re-ranking of fused hybrid candidates.
+
+Adjacent pages of a brochure and the PDF-text / OCR variants of one passage
+are near-copies that can fill every top_k slot. MMR picks the results one
+at a time, each time taking the candidate with the best
+
+    mmr_lambda * relevance - (1 - mmr_lambda) * max similarity to the picks so far
+
+where relevance is the fused score scaled to [0, 1] per query and similarity
+is the cosine between the candidates' stored embeddings (read back from the
+vector index, not re-embedded). Like fusion.py, everything runs on a batch
+of queries at once: the pairwise similarities of all candidate lists are
+one batched matrix product, and each greedy step is a vector update over
+(Q, m) arrays. max_per_source additionally caps the picks per source PDF.
+"""
+
+import numpy as np
+
+
+def _relevance(scores, valid):
+    # Fused scores scaled to [0, 1] per query; a single candidate (or all tied) gets 1
+    high = np.where(valid, scores, -np.inf).max(axis=1, keepdims=True)
+    low = np.where(valid, scores, np.inf).min(axis=1, keepdims=True)
+    span = high - low
+    with np.errstate(invalid="ignore", divide="ignore"):
+        relevance = np.where(span > 0, (scores - low) / np.where(span > 0, span, 1.0), 1.0)
+    return np.where(valid, relevance, 0.0)
+
+
+def mmr_rerank(ids, scores, vectors, top_k, mmr_lambda=0.5, source_codes=None, max_per_source=0):
+    """
+    Re-rank fused candidates with MMR into (ids, scores) of shape (Q, top_k).
+
+    ids / scores are (Q, m) fused candidates (-1 = empty slot), vectors the
+    (Q, m, d) unit embeddings of those candidates and source_codes an
+    optional (Q, m) integer source per candidate for max_per_source (0 = no
+    cap). Scores stay the fused scores; empty slots have id -1 and score -inf.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    n_queries, m = ids.shape
+    valid = ids >= 0
+    relevance = _relevance(scores, valid)
+    similarity = np.matmul(vectors, np.swapaxes(vectors, 1, 2))
+    max_similarity = np.zeros((n_queries, m))
+    available = valid.copy()
+    if max_per_source and source_codes is not None:
+        source_codes = np.asarray(source_codes, dtype=np.int64)
+        counts = np.zeros((n_queries, int(source_codes.max(initial=0)) + 1), dtype=np.int64)
+    rows = np.arange(n_queries)
+    picks = np.full((n_queries, top_k), -1, dtype=np.int64)
+    for step in range(min(top_k, m)):
+        mmr = mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity
+        mmr = np.where(available, mmr, -np.inf)
+        best = mmr.argmax(axis=1)
+        found = np.isfinite(mmr[rows, best])
+        if not found.any():
+            break
+        picked_rows, picked = rows[found], best[found]
+        picks[picked_rows, step] = picked
+        available[picked_rows, picked] = False
+        max_similarity[picked_rows] = np.maximum(max_similarity[picked_rows], similarity[picked_rows, picked])
+        if max_per_source and source_codes is not None:
+            counts[picked_rows, source_codes[picked_rows, picked]] += 1
+            available &= np.take_along_axis(counts, source_codes, axis=1) < max_per_source
+
+    filled = picks >= 0
+    safe = np.where(filled, picks, 0)
+    out_ids = np.where(filled, np.take_along_axis(ids, safe, axis=1), -1)
+    out_scores = np.where(filled, np.take_along_axis(scores, safe, axis=1), -np.inf)
+    return out_ids, out_scores
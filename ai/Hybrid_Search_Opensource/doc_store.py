@@ -0,0 +1,240 @@
+"""
+doc_store.py
+
+Compact columnar store for chunk text and metadata.
+
+    text      one UTF-8 blob + int64 offsets (the mapped_strings layout)
+    source    int32 codes into a list of source names
+    page      int32 page number
+    chunk     int32 chunk number within the page
+
+A DocStore holds no Python object per document: store[i] returns a DocView,
+a two-slot object whose page_content and metadata are decoded from the
+columns when read, so code written against LangChain Documents
+(doc.page_content, doc.metadata["source"]) works unchanged. Memory is the
+raw UTF-8 text plus 20 bytes per document.
+
+Stores are built in memory with DocStoreBuilder (or from_documents), saved
+as docs_* files in a snapshot directory and opened again with memory maps.
+"""
+
+import os
+from array import array
+
+import numpy as np
+
+from mapped_strings import map_file
+
+
+class DocView:
+    """
+    Read-only Document-like view of one row of a DocStore.
+    """
+
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def page_content(self):
+        return self.store.text(self.index)
+
+    @property
+    def metadata(self):
+        return self.store.metadata(self.index)
+
+    def __repr__(self):
+        return f"DocView({self.index}, {self.metadata})"
+
+
+class DocStore:
+    """
+    Columnar, read-only sequence of documents (see module docstring).
+    """
+
+    def __init__(self, blob, offsets, source_codes, pages, chunks, sources):
+        self._blob = blob
+        self._offsets = offsets
+        self._source = source_codes
+        self._page = pages
+        self._chunk = chunks
+        self.sources = list(sources)
+
+    @classmethod
+    def from_documents(cls, docs):
+        builder = DocStoreBuilder()
+        for doc in docs:
+            builder.add_document(doc)
+        return builder.build()
+
+    @classmethod
+    def open(cls, directory, sources, prefix="docs"):
+        """
+        Memory-map a store written by save(); nothing is read up front.
+        """
+        path = os.path.join(directory, prefix)
+        return cls(
+            map_file(path + "_text.bin"),
+            np.load(path + "_text.offsets.npy", mmap_mode="r"),
+            np.load(path + "_source.npy", mmap_mode="r"),
+            np.load(path + "_page.npy", mmap_mode="r"),
+            np.load(path + "_chunk.npy", mmap_mode="r"),
+            sources,
+        )
+
+    def save(self, directory, prefix="docs"):
+        """
+        Write the columns as <prefix>_* files; returns the source names (for the manifest).
+        """
+        path = os.path.join(directory, prefix)
+        with open(path + "_text.bin", "wb") as f:
+            f.write(memoryview(self._blob))
+        np.save(path + "_text.offsets.npy", np.asarray(self._offsets, dtype=np.int64))
+        np.save(path + "_source.npy", np.asarray(self._source, dtype=np.int32))
+        np.save(path + "_page.npy", np.asarray(self._page, dtype=np.int32))
+        np.save(path + "_chunk.npy", np.asarray(self._chunk, dtype=np.int32))
+        return self.sources
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def text(self, i):
+        i = int(i)
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("utf-8")
+
+    def metadata(self, i):
+        i = int(i)
+        return {
+            "source": self.sources[self._source[i]],
+            "page": int(self._page[i]),
+            "chunk": int(self._chunk[i]),
+        }
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return DocView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield DocView(self, i)
+
+    def texts(self):
+        for i in range(len(self)):
+            yield self.text(i)
+
+    @property
+    def nbytes(self):
+        columns = (self._blob, self._offsets, self._source, self._page, self._chunk)
+        return int(sum(np.asarray(column).nbytes for column in columns))
+
+    def take(self, indices):
+        """
+        New in-memory store with the given rows, in the given order.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = np.asarray(self._offsets[:-1])[indices]
+        ends = np.asarray(self._offsets[1:])[indices]
+        blob = memoryview(self._blob)
+        data = b"".join(blob[start:end] for start, end in zip(starts.tolist(), ends.tolist()))
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        return DocStore(
+            np.frombuffer(data, dtype=np.uint8), offsets,
+            np.asarray(self._source)[indices], np.asarray(self._page)[indices], np.asarray(self._chunk)[indices],
+            self.sources,
+        )
+
+    def source_rows(self, source):
+        """
+        Row numbers of all documents of one source (empty if unknown).
+        """
+        if source not in self.sources:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(np.asarray(self._source) == self.sources.index(source))
+
+    @classmethod
+    def concat(cls, stores):
+        """
+        One in-memory store with the rows of every store, in order.
+        """
+        source_ids = {}
+        blobs, offsets, codes, pages, chunks = [], [np.zeros(1, dtype=np.int64)], [], [], []
+        base = 0
+        for store in stores:
+            remap = np.array([source_ids.setdefault(s, len(source_ids)) for s in store.sources], dtype=np.int32)
+            store_offsets = np.asarray(store._offsets, dtype=np.int64)
+            blobs.append(np.asarray(store._blob)[store_offsets[0]:store_offsets[-1]])
+            offsets.append(store_offsets[1:] - store_offsets[0] + base)
+            base += int(store_offsets[-1] - store_offsets[0])
+            codes.append(remap[np.asarray(store._source)])
+            pages.append(np.asarray(store._page, dtype=np.int32))
+            chunks.append(np.asarray(store._chunk, dtype=np.int32))
+        empty = np.zeros(0, dtype=np.int32)
+        return cls(
+            np.concatenate(blobs) if blobs else np.zeros(0, dtype=np.uint8), np.concatenate(offsets),
+            np.concatenate(codes) if codes else empty, np.concatenate(pages) if pages else empty,
+            np.concatenate(chunks) if chunks else empty, list(source_ids),
+        )
+
+    def sorted(self):
+        """
+        Copy ordered by (source, page, chunk), for a deterministic index layout.
+        """
+        source_rank = np.argsort(np.argsort(np.array(self.sources, dtype=object), kind="stable"))
+        order = np.lexsort((self._chunk, self._page, source_rank[np.asarray(self._source)]))
+        return self.take(order)
+
+
+class DocStoreBuilder:
+    """
+    Appends documents into growing columns; build() returns the DocStore.
+    """
+
+    def __init__(self):
+        self._blob = bytearray()
+        self._offsets = array("q", [0])
+        self._source = array("i")
+        self._page = array("i")
+        self._chunk = array("i")
+        self._sources = []
+        self._source_ids = {}
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def add(self, text, source, page, chunk=0):
+        source_id = self._source_ids.get(source)
+        if source_id is None:
+            source_id = self._source_ids[source] = len(self._sources)
+            self._sources.append(source)
+        self._blob += text.encode("utf-8")
+        self._offsets.append(len(self._blob))
+        self._source.append(source_id)
+        self._page.append(page)
+        self._chunk.append(chunk)
+
+    def add_document(self, doc):
+        metadata = doc.metadata
+        self.add(doc.page_content, metadata["source"], metadata["page"], metadata.get("chunk", 0))
+
+    def build(self):
+        """
+        The DocStore of everything added; the builder starts over empty.
+        """
+        # The store takes over the buffers instead of copying them
+        store = DocStore(
+            np.frombuffer(self._blob, dtype=np.uint8),
+            np.frombuffer(self._offsets, dtype=np.int64),
+            np.frombuffer(self._source, dtype=np.int32),
+            np.frombuffer(self._page, dtype=np.int32),
+            np.frombuffer(self._chunk, dtype=np.int32),
+            self._sources,
+        )
+        self.__init__()
+        return store
@@ -0,0 +1,249 @@
+"""
+embedding_service.py
+
+Batched, cached, concurrent embedding layer used on the indexing and query paths.
+
+`EmbeddingService` wraps any backend with `embed_documents(texts)` (such as
+AzureOpenAIEmbeddings, or HashingEmbedder from local_backends.py for offline
+runs) and adds:
+    - a persistent SQLite cache keyed on (model, sha256(text)), so re-indexing
+      after small edits only embeds the chunks that changed,
+    - batching by token budget as well as by input count,
+    - a bounded number of concurrent requests, with exponential backoff and
+      jitter on 429s and transient 5xx errors.
+"""
+
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to a chars/4 estimate
+    tiktoken = None
+
+from metrics import metrics
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _status_code(ex):
+    status = getattr(ex, "status_code", None)
+    if status is None:
+        response = getattr(ex, "response", None)
+        status = getattr(response, "status_code", None)
+    return status
+
+
+def _retry_after(ex):
+    # openai / azure-core errors expose the HTTP response and its headers
+    response = getattr(ex, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(ex):
+    if isinstance(ex, (TimeoutError, ConnectionError)):
+        return True
+    if _status_code(ex) in RETRYABLE_STATUS_CODES:
+        return True
+    return type(ex).__name__ in ("RateLimitError", "APITimeoutError", "APIConnectionError")
+
+
+def call_with_retries(fn, max_retries=6, base_delay=1.0, max_delay=60.0, on_retry=None):
+    """
+    Call fn(), retrying throttled/transient failures with jittered backoff.
+
+    A Retry-After header on the error takes precedence over the backoff delay.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as ex:
+            if attempt >= max_retries or not is_retryable(ex):
+                raise
+            delay = _retry_after(ex)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            attempt += 1
+            if on_retry:
+                on_retry(ex, attempt, delay)
+            time.sleep(delay)
+
+
+class TokenCounter:
+    """
+    Counts tokens with tiktoken when it is installed, otherwise estimates.
+
+    tiktoken downloads its BPE files on first use, so an offline machine
+    without them cached also falls back to the estimate.
+    """
+
+    def __init__(self, model="text-embedding-ada-002"):
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as ex:
+                print(f"tiktoken unavailable ({ex.__class__.__name__}), estimating token counts")
+
+    def count(self, text):
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return len(text) // 4 + 1
+
+
+class EmbeddingCache:
+    """
+    Persistent (model, text hash) -> float32 vector store in SQLite.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+
+    @staticmethod
+    def make_key(model, text):
+        return model + ":" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items],
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingService:
+    """
+    Drop-in replacement for a langchain Embeddings object with caching,
+    token-aware batching and bounded concurrency.
+
+    embed_documents returns a float32 array of shape (len(texts), dim).
+    """
+
+    def __init__(self, backend, model, cache=None, max_batch_size=256, max_batch_tokens=100_000,
+                 max_concurrency=4, max_retries=6):
+        self.backend = backend
+        self.model = model
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.token_counter = TokenCounter(model)
+        self._stats_lock = threading.Lock()
+        self.stats = {"cache_hits": 0, "cache_misses": 0, "requests": 0, "retries": 0, "tokens": 0}
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+        metrics.count(f"embedding_{name}", value)
+
+    def _batches(self, texts):
+        """
+        Group texts so no batch exceeds the input-count or token budget.
+        """
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = self.token_counter.count(text)
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                yield batch, batch_tokens
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch, batch_tokens
+
+    def _embed_batch(self, batch, batch_tokens, keys=None):
+        """
+        Vectors of one batch; with `keys`, they are cached as soon as the batch succeeds.
+        """
+        def on_retry(ex, attempt, delay):
+            self._count("retries")
+            print(f"⏳ Embedding request throttled ({ex.__class__.__name__}), retry {attempt} in {delay:.1f}s")
+
+        with metrics.span("embedding_request"):
+            vectors = call_with_retries(
+                lambda: self.backend.embed_documents(batch),
+                max_retries=self.max_retries, on_retry=on_retry
+            )
+        self._count("requests")
+        self._count("tokens", batch_tokens)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if keys is not None and self.cache is not None:
+            # Paid-for vectors survive a later batch failing
+            self.cache.put_many(zip(keys, vectors))
+        return vectors
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        keys = [EmbeddingCache.make_key(self.model, text) for text in texts]
+        found = self.cache.get_many(set(keys)) if self.cache is not None else {}
+
+        # Embed each distinct uncached text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self._count("cache_hits", len(texts) - len(missing))
+        self._count("cache_misses", len(missing))
+
+        if missing:
+            missing_keys = list(missing)
+            # Batches are consecutive runs of the missing texts; pair each with its keys
+            batches = []
+            start = 0
+            for batch, tokens in self._batches(list(missing.values())):
+                batches.append((batch, tokens, missing_keys[start:start + len(batch)]))
+                start += len(batch)
+            if len(batches) == 1 or self.max_concurrency <= 1:
+                results = [self._embed_batch(*batch) for batch in batches]
+            else:
+                with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="embed") as pool:
+                    results = list(pool.map(lambda b: self._embed_batch(*b), batches))
+            found.update(zip(missing_keys, np.concatenate(results)))
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([found[key] for key in keys]).astype(np.float32, copy=False)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
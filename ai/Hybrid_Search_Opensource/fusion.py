@@ -0,0 +1,139 @@
+"""
+fusion.py
+
+Vectorised score fusion for hybrid (vector + BM25) retrieval.
+
+Every function works on a batch of queries at once. Each retriever hands
+over its candidate lists as (Q, m) arrays of doc ids and scores, best first,
+with -1 marking empty slots. A fusion method turns each list into per-doc
+contributions; `fuse` merges the two lists per query, adds the contributions
+and returns the top_k doc ids and fused scores, all without Python loops
+over candidates.
+
+Methods:
+    minmax  alpha * vector score + (1 - alpha) * min-max normalised BM25
+            (the original hybrid_search blend)
+    rrf     weighted reciprocal rank fusion, alpha / (rrf_k + rank)
+    zscore  alpha / (1 - alpha) weighted z-scores of each list
+"""
+
+import numpy as np
+
+
+def _masked(values, valid, fill):
+    return np.where(valid, values, fill)
+
+
+def _minmax(vec_scores, vec_valid, lex_scores, lex_valid, alpha, lex_floor=None, **_):
+    lex_max = _masked(lex_scores, lex_valid, -np.inf).max(axis=1, keepdims=True)
+    if lex_floor is None:
+        lex_min = _masked(lex_scores, lex_valid, np.inf).min(axis=1, keepdims=True)
+    else:
+        lex_min = np.asarray(lex_floor, dtype=np.float64).reshape(-1, 1)
+    lex_norm = (lex_scores - lex_min) / (lex_max - lex_min + 1e-6)
+    zeros = np.zeros(len(vec_scores))
+    return alpha * vec_scores, zeros, (1 - alpha) * lex_norm, zeros
+
+
+def _rrf(vec_scores, vec_valid, lex_scores, lex_valid, alpha, rrf_k=60, **_):
+    vec_rank = np.arange(1, vec_scores.shape[1] + 1)
+    lex_rank = np.arange(1, lex_scores.shape[1] + 1)
+    vec_contrib = np.broadcast_to(alpha / (rrf_k + vec_rank), vec_scores.shape)
+    lex_contrib = np.broadcast_to((1 - alpha) / (rrf_k + lex_rank), lex_scores.shape)
+    zeros = np.zeros(len(vec_scores))
+    return vec_contrib, zeros, lex_contrib, zeros
+
+
+def _zscore_list(scores, valid):
+    count = np.maximum(valid.sum(axis=1, keepdims=True), 1)
+    mean = _masked(scores, valid, 0.0).sum(axis=1, keepdims=True) / count
+    var = (_masked(scores - mean, valid, 0.0) ** 2).sum(axis=1, keepdims=True) / count
+    z = (scores - mean) / (np.sqrt(var) + 1e-6)
+    # A doc missing from a list is scored like that list's worst candidate
+    missing = _masked(z, valid, np.inf).min(axis=1)
+    return z, np.where(np.isfinite(missing), missing, 0.0)
+
+
+def _zscore(vec_scores, vec_valid, lex_scores, lex_valid, alpha, **_):
+    vec_z, vec_missing = _zscore_list(vec_scores, vec_valid)
+    lex_z, lex_missing = _zscore_list(lex_scores, lex_valid)
+    return alpha * vec_z, alpha * vec_missing, (1 - alpha) * lex_z, (1 - alpha) * lex_missing
+
+
+FUSION_METHODS = {
+    "minmax": _minmax,
+    "rrf": _rrf,
+    "zscore": _zscore,
+}
+
+
+def top_k_rows(scores, k):
+    """
+    Column indices of the k largest scores in every row, best first.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((len(scores), 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+def fuse(vec_ids, vec_scores, lex_ids, lex_scores, top_k, method="minmax", alpha=0.5, **params):
+    """
+    Fuse per-query vector and lexical candidate lists into the top_k docs.
+
+    Returns (ids, scores), both shaped (Q, top_k); unfilled slots have id -1.
+    Extra keyword params go to the fusion method (lex_floor for minmax,
+    rrf_k for rrf).
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method {method!r}; choose from {sorted(FUSION_METHODS)}")
+    vec_ids = np.asarray(vec_ids, dtype=np.int64)
+    lex_ids = np.asarray(lex_ids, dtype=np.int64)
+    vec_scores = np.asarray(vec_scores, dtype=np.float64)
+    lex_scores = np.asarray(lex_scores, dtype=np.float64)
+    vec_valid = vec_ids >= 0
+    lex_valid = lex_ids >= 0
+
+    vec_contrib, vec_missing, lex_contrib, lex_missing = FUSION_METHODS[method](
+        vec_scores, vec_valid, lex_scores, lex_valid, alpha, **params
+    )
+
+    # One row of candidates per query: vector list first, then lexical list.
+    # Each side contributes its own score and the other side's "missing" fill.
+    m_vec = vec_ids.shape[1]
+    ids = np.concatenate([vec_ids, lex_ids], axis=1)
+    vec_part = np.concatenate([vec_contrib, np.repeat(vec_missing[:, None], lex_ids.shape[1], axis=1)], axis=1)
+    lex_part = np.concatenate([np.repeat(lex_missing[:, None], m_vec, axis=1), lex_contrib], axis=1)
+    valid = np.concatenate([vec_valid, lex_valid], axis=1)
+
+    # Sort ids per row (stable, so a doc's vector entry precedes its lexical
+    # entry); a doc found by both retrievers then sits in adjacent columns.
+    order = np.argsort(np.where(valid, ids, np.iinfo(np.int64).max), axis=1, kind="stable")
+    ids = np.take_along_axis(ids, order, axis=1)
+    vec_part = np.take_along_axis(vec_part, order, axis=1)
+    lex_part = np.take_along_axis(lex_part, order, axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+
+    total = vec_part + lex_part
+    dup = np.zeros_like(valid)
+    dup[:, 1:] = valid[:, 1:] & valid[:, :-1] & (ids[:, 1:] == ids[:, :-1])
+    # First of a pair keeps its vector contribution and takes the lexical one
+    first = np.zeros_like(valid)
+    first[:, :-1] = dup[:, 1:]
+    merged = vec_part[:, :-1] + lex_part[:, 1:]
+    total[:, :-1] = np.where(first[:, :-1], merged, total[:, :-1])
+    total = np.where(valid & ~dup, total, -np.inf)
+
+    best = top_k_rows(total, top_k)
+    out_scores = np.take_along_axis(total, best, axis=1)
+    out_ids = np.where(np.isfinite(out_scores), np.take_along_axis(ids, best, axis=1), -1)
+    if out_ids.shape[1] < top_k:
+        pad = top_k - out_ids.shape[1]
+        out_ids = np.pad(out_ids, ((0, 0), (0, pad)), constant_values=-1)
+        out_scores = np.pad(out_scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+    return out_ids, out_scores
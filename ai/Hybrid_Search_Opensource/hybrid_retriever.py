@@ -0,0 +1,217 @@
+"""
+hybrid_retriever.py
+
+Hybrid (BM25 + FAISS) retrieval over an index snapshot, for one query or a batch.
+
+For a batch of queries the retriever embeds all queries in one call, runs
+one faiss_index.search over the stacked query vectors, scores BM25 for all
+queries together and fuses the candidate lists with the array operations in
+fusion.py.
+
+The query embedding is a network round trip and BM25 scoring is CPU work,
+so they overlap: the embedding request runs on a small thread pool while
+BM25 scores on the calling thread, and the vector search and fusion start
+as soon as both are done. Query latency is then about max(embed, BM25)
+rather than their sum. With an embed_deadline, a slow embedding call is
+abandoned and the queries get lexical-only results.
+
+Optionally the fused candidates are re-ranked for diversity with MMR
+(diversity.py), using the vectors stored in the index.
+"""
+
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+from fusion import fuse
+from diversity import mmr_rerank
+from bm25_index import tokenize
+from vector_index import normalize, reconstruct_vectors, search_similarities
+from metrics import metrics
+
+
+# Shared by all retrievers; the threads only wait on embedding requests
+EMBED_WORKERS = 8
+_embed_executor = None
+_embed_executor_lock = threading.Lock()
+
+
+def _get_embed_executor():
+    global _embed_executor
+    with _embed_executor_lock:
+        if _embed_executor is None:
+            _embed_executor = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="query-embed")
+        return _embed_executor
+
+
+def empty_candidates(n_queries, n):
+    """
+    (ids, scores) with every slot empty (-1), e.g. the vector side of a lexical-only search.
+    """
+    return np.full((n_queries, n), -1, dtype=np.int64), np.zeros((n_queries, n), dtype=np.float32)
+
+
+def lexical_top_n(bm25, tokenized_queries, n, live=None):
+    """
+    (ids, scores, floors) of the top-n BM25 docs per query.
+
+    Uses the pruned top-n search of a BM25Index and falls back to full
+    get_scores for other BM25 objects (e.g. rank_bm25.BM25Okapi). Docs the
+    optional boolean `live` mask marks False are never returned.
+    """
+    if hasattr(bm25, "top_n_batch"):
+        return bm25.top_n_batch(tokenized_queries, n, live=live)
+    all_scores = np.stack([bm25.get_scores(tokens) for tokens in tokenized_queries])
+    if live is not None:
+        all_scores = np.where(live, all_scores, -np.inf)
+    n = min(n, all_scores.shape[1])
+    top = np.argpartition(-all_scores, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(all_scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    dead = ~np.isfinite(top_scores)
+    return (
+        np.where(dead, -1, top),
+        np.where(dead, 0.0, top_scores),
+        np.where(np.isfinite(all_scores), all_scores, np.inf).min(axis=1),
+    )
+
+
+class HybridRetriever:
+    """
+    Fuses BM25 and FAISS candidates; see fusion.FUSION_METHODS for methods.
+
+    `embed_deadline` (seconds, None = wait) bounds how long a search waits
+    for its query embeddings before it falls back to BM25 alone.
+    """
+
+    def __init__(self, docs, bm25, faiss_index, embeddings_model, tokenizer=tokenize, embed_deadline=None):
+        self.docs = docs
+        self.bm25 = bm25
+        self.faiss_index = faiss_index
+        self.embeddings_model = embeddings_model
+        self.tokenizer = tokenizer
+        self.embed_deadline = embed_deadline
+
+    def embed_queries(self, queries):
+        with metrics.span("query_embedding"):
+            return np.asarray(self.embeddings_model.embed_documents(list(queries)), dtype="float32")
+
+    def embed_queries_async(self, queries):
+        """
+        Future of embed_queries(queries); pass it as query_vectors to overlap it with BM25.
+        """
+        return _get_embed_executor().submit(self.embed_queries, list(queries))
+
+    def wait_for_embeddings(self, pending, started):
+        """
+        Query vectors of a pending embed_queries_async, or None if embed_deadline passed first.
+        """
+        timeout = None
+        if self.embed_deadline is not None:
+            timeout = max(self.embed_deadline - (time.perf_counter() - started), 0.0)
+        with metrics.span("query_embedding_wait"):
+            try:
+                return pending.result(timeout)
+            except FutureTimeoutError:
+                metrics.count("query_embedding_timeouts")
+                # Callers holding the future (rag.py) must not use vectors the search went without
+                pending.deadline_missed = True
+                return None
+
+    def vector_candidates(self, query_vectors, n):
+        # Cosine similarity (inner product over normalised vectors)
+        with metrics.span("vector_search"):
+            return search_similarities(self.faiss_index, query_vectors, n)
+
+    def lexical_candidates(self, token_lists, n):
+        with metrics.span("bm25"):
+            return lexical_top_n(self.bm25, token_lists, n)
+
+    def candidates(self, queries, n, query_vectors=None):
+        """
+        (vec_ids, vec_scores, lex_ids, lex_scores, lex_floors): top-n vector and BM25 candidates per query.
+
+        query_vectors may be an array, a Future from embed_queries_async or
+        None (embed here); BM25 runs while a pending embedding is in flight.
+        """
+        started = time.perf_counter()
+        if query_vectors is None:
+            query_vectors = self.embed_queries_async(queries)
+        lex_ids, lex_scores, lex_floors = self.lexical_candidates([self.tokenizer(q) for q in queries], n)
+        if isinstance(query_vectors, Future):
+            query_vectors = self.wait_for_embeddings(query_vectors, started)
+        if query_vectors is None:
+            vec_ids, vec_scores = empty_candidates(len(queries), n)
+        else:
+            vec_ids, vec_scores = self.vector_candidates(query_vectors, n)
+        return vec_ids, vec_scores, lex_ids, lex_scores, lex_floors
+
+    def candidate_vectors(self, ids):
+        """
+        Stored vectors of doc ids, read back from the vector index (no re-embedding).
+        """
+        return reconstruct_vectors(self.faiss_index, ids)
+
+    def diversify(self, ids, scores, top_k, mmr_lambda=0.5, max_per_source=0):
+        """
+        MMR re-ranking (diversity.mmr_rerank) of fused candidates to top_k per query.
+        """
+        with metrics.span("mmr"):
+            valid = ids >= 0
+            unique_ids, inverse = np.unique(ids[valid], return_inverse=True)
+            unique_vectors = normalize(self.candidate_vectors(unique_ids))
+            vectors = np.zeros(ids.shape + (unique_vectors.shape[1],), dtype=np.float32)
+            vectors[valid] = unique_vectors[inverse]
+            source_codes = None
+            if max_per_source:
+                codes = {}
+                sources = [codes.setdefault(self.docs.metadata(i)["source"], len(codes)) for i in unique_ids]
+                source_codes = np.zeros(ids.shape, dtype=np.int64)
+                source_codes[valid] = np.asarray(sources, dtype=np.int64)[inverse]
+            return mmr_rerank(ids, scores, vectors, top_k, mmr_lambda=mmr_lambda, source_codes=source_codes,
+                              max_per_source=max_per_source)
+
+    def search_ids_batch(self, queries, top_k=3, alpha=0.5, candidate_factor=2, fusion="minmax",
+                         query_vectors=None, mmr_lambda=None, max_per_source=0, **fusion_params):
+        """
+        Fused (ids, scores) arrays of shape (len(queries), top_k); -1 = no result.
+
+        With mmr_lambda (1.0 = relevance only) or max_per_source, the top
+        top_k * candidate_factor fused docs are re-ranked by diversify.
+        """
+        n_candidates = top_k * candidate_factor
+        rerank = mmr_lambda is not None or max_per_source > 0
+        metrics.count("search_queries", len(queries))
+        with metrics.span("hybrid_search"):
+            vec_ids, vec_scores, lex_ids, lex_scores, lex_floors = self.candidates(
+                queries, n_candidates, query_vectors=query_vectors
+            )
+            if fusion == "minmax":
+                fusion_params.setdefault("lex_floor", lex_floors)
+            with metrics.span("fusion"):
+                ids, scores = fuse(
+                    vec_ids, vec_scores, lex_ids, lex_scores, n_candidates if rerank else top_k,
+                    method=fusion, alpha=alpha, **fusion_params
+                )
+            if not rerank:
+                return ids, scores
+            return self.diversify(ids, scores, top_k, mmr_lambda=1.0 if mmr_lambda is None else mmr_lambda,
+                                  max_per_source=max_per_source)
+
+    def hybrid_search_batch(self, queries, top_k=3, alpha=0.5, candidate_factor=2, fusion="minmax", **fusion_params):
+        """
+        Top-k Documents for every query in one batched pass.
+        """
+        ids, _ = self.search_ids_batch(
+            queries, top_k=top_k, alpha=alpha, candidate_factor=candidate_factor, fusion=fusion, **fusion_params
+        )
+        return [[self.docs[i] for i in row if i >= 0] for row in ids]
+
+    def hybrid_search(self, query, top_k=3, alpha=0.5, candidate_factor=2, fusion="minmax", **fusion_params):
+        return self.hybrid_search_batch(
+            [query], top_k=top_k, alpha=alpha, candidate_factor=candidate_factor, fusion=fusion, **fusion_params
+        )[0]
@@ -0,0 +1,148 @@
+"""
+index_snapshot.py
+
+On-disk snapshot of the hybrid index built by Hybrid_Search1_OpenSource.py.
+
+A snapshot is a directory that is written once after ingestion and opened
+with memory maps at startup, so a query process never has to touch Blob
+Storage or the embeddings endpoint to get a usable index:
+
+    manifest.json        format version, embedding model, counts, BM25 and vector index params
+    vectors.faiss        FAISS index (read back with IO_FLAG_MMAP)
+    bm25/                compressed inverted index (see bm25_index.py)
+    docs_text.*          chunk text (UTF-8 blob + offsets); docs_* is a DocStore
+    docs_source.npy      integer-coded source column (names in the manifest)
+    docs_page.npy        page number column
+    docs_chunk.npy       chunk number within the page
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+
+import faiss
+
+from bm25_index import BM25Index
+from vector_index import set_search_params
+from doc_store import DocStore
+
+
+SNAPSHOT_FORMAT_VERSION = 3
+MANIFEST_FILE = "manifest.json"
+FAISS_FILE = "vectors.faiss"
+BM25_DIR = "bm25"
+
+
+class IndexSnapshot:
+    """
+    An opened snapshot: manifest, memory-mapped DocStore, BM25 scorer and FAISS index.
+    """
+
+    def __init__(self, snapshot_dir, manifest, docs, bm25, faiss_index):
+        self.snapshot_dir = snapshot_dir
+        self.manifest = manifest
+        self.docs = docs
+        self.bm25 = bm25
+        self.faiss_index = faiss_index
+
+    @property
+    def snapshot_id(self):
+        # Changes on every rebuild; caches derived from the index key on it
+        return self.manifest.get("snapshot_id", self.manifest["created_at"])
+
+
+def save_snapshot(snapshot_dir, docs, bm25, faiss_index, embedding_model, embedding_deployment=None,
+                  vector_index_config=None):
+    """
+    Write docs (a DocStore or a list of chunk Documents), the BM25Index and
+    the FAISS index as a snapshot directory.
+
+    The snapshot is assembled in a temporary sibling directory and swapped in
+    at the end, so readers never observe a half-written snapshot.
+    """
+    if faiss_index.ntotal != len(docs):
+        raise ValueError(f"FAISS index has {faiss_index.ntotal} vectors but there are {len(docs)} docs")
+    snapshot_dir = os.path.abspath(snapshot_dir)
+    tmp_dir = f"{snapshot_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    faiss.write_index(faiss_index, os.path.join(tmp_dir, FAISS_FILE))
+    bm25.save(os.path.join(tmp_dir, BM25_DIR))
+    if not isinstance(docs, DocStore):
+        docs = DocStore.from_documents(docs)
+    sources = docs.save(tmp_dir)
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "snapshot_id": uuid.uuid4().hex,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "embedding_model": embedding_model,
+        "embedding_deployment": embedding_deployment or embedding_model,
+        "embedding_dim": faiss_index.d,
+        "faiss_index_type": type(faiss_index).__name__,
+        "vector_index": vector_index_config or {},
+        "doc_count": len(docs),
+        "bm25": bm25.params,
+        "sources": sources,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    old_dir = f"{snapshot_dir}.old-{os.getpid()}"
+    if os.path.exists(snapshot_dir):
+        os.replace(snapshot_dir, old_dir)
+    os.replace(tmp_dir, snapshot_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"💾 Saved index snapshot ({len(docs)} docs) to: {snapshot_dir}")
+    return manifest
+
+
+def read_manifest(snapshot_dir):
+    """
+    Read and validate a snapshot manifest (raises FileNotFoundError/ValueError).
+    """
+    with open(os.path.join(snapshot_dir, MANIFEST_FILE), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported snapshot format {manifest.get('format_version')} "
+            f"(expected {SNAPSHOT_FORMAT_VERSION})"
+        )
+    return manifest
+
+
+def load_snapshot(snapshot_dir, expected_embedding_model=None, nprobe=None, ef_search=None):
+    """
+    Open a snapshot with memory maps; nothing is read eagerly beyond the manifest.
+
+    nprobe / ef_search override the search parameters recorded at build time.
+
+    Raises FileNotFoundError when there is no snapshot and ValueError when it
+    was built with a different embedding model or snapshot format.
+    """
+    manifest = read_manifest(snapshot_dir)
+    if expected_embedding_model and manifest["embedding_model"] != expected_embedding_model:
+        raise ValueError(
+            f"Snapshot was built with {manifest['embedding_model']}, "
+            f"not {expected_embedding_model}"
+        )
+    # IO_FLAG_MMAP_IFC lets flat indexes map their vectors instead of copying
+    # them; older faiss builds only know IO_FLAG_MMAP. Recent builds refuse the
+    # combination for IVF indexes, which then map their inverted lists only.
+    faiss_path = os.path.join(snapshot_dir, FAISS_FILE)
+    io_flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_READ_ONLY", 0)
+    try:
+        faiss_index = faiss.read_index(faiss_path, io_flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+    except RuntimeError:
+        faiss_index = faiss.read_index(faiss_path, io_flags)
+    vector_config = manifest.get("vector_index", {})
+    set_search_params(
+        faiss_index,
+        nprobe=nprobe if nprobe is not None else vector_config.get("nprobe"),
+        ef_search=ef_search if ef_search is not None else vector_config.get("ef_search"),
+    )
+    bm25 = BM25Index.load(os.path.join(snapshot_dir, BM25_DIR))
+    docs = DocStore.open(snapshot_dir, manifest["sources"])
+    return IndexSnapshot(snapshot_dir, manifest, docs, bm25, faiss_index)
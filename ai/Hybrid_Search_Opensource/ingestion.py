@@ -0,0 +1,213 @@
+"""
+ingestion.py
+
+Bounded, streaming ingestion pipeline: Blob download -> PDF parse -> OCR -> Document.
+
+Each blob moves through three worker pools:
+    - downloads run on a thread pool straight into memory (no temp files),
+    - PyPDF text extraction runs on a process pool (it is CPU-bound Python),
+    - OCR runs on a thread pool (it is mostly waiting on the Form Recognizer poller).
+Without an OCR policy, parsing and OCR of the same blob run concurrently on
+the same bytes. With one (see ocr_selection.py), OCR waits for the parse and
+only the pages the policy selects are sent, as page-range batches that run
+concurrently on the OCR pool and are merged back by page number. At most
+`max_in_flight` blobs are held in memory at once, and Documents are yielded
+as soon as both halves of a blob are done, so callers can start indexing
+before the whole container has been read.
+
+The container client and OCR function are plain arguments, so the pipeline
+runs the same against Azure or the stand-ins in local_backends.py. Stage
+times (measured inside the workers) and blob/page counts go to metrics.py.
+"""
+
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from pypdf import PdfReader
+
+from chunking import combine_page_text
+from metrics import metrics
+from ocr_selection import page_stats
+
+
+def parse_pdf_pages(pdf_bytes):
+    """
+    Text layer of every page (what PyPDFLoader returns), one string per page.
+    """
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [page.extract_text() or "" for page in reader.pages]
+
+
+def analyze_pdf_pages(pdf_bytes):
+    """
+    (page texts, page stats): parse_pdf_pages plus ocr_selection.page_stats of every page.
+    """
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    texts = []
+    stats = []
+    for page in reader.pages:
+        text = page.extract_text() or ""
+        texts.append(text)
+        stats.append(page_stats(page, text))
+    return texts, stats
+
+
+def merge_page_texts(source, pdf_pages, ocr_pages, page_text_mode="merge"):
+    """
+    Combine the PDF text layer and OCR text page by page into Documents.
+
+    See chunking.combine_page_text for the page_text_mode choices.
+    """
+    from langchain.docstore.document import Document
+
+    docs = []
+    num_pages = max(len(pdf_pages), len(ocr_pages))
+    for i in range(num_pages):
+        structured_text = pdf_pages[i] if i < len(pdf_pages) else ""
+        ocr_text = ocr_pages[i] if i < len(ocr_pages) else ""
+        if not structured_text.strip() and not ocr_text.strip():
+            continue
+        docs.append(Document(
+            page_content=combine_page_text(structured_text, ocr_text, page_text_mode),
+            metadata={"source": source, "page": i + 1}
+        ))
+    return docs
+
+
+def download_blob_bytes(container_client, blob_name):
+    return container_client.get_blob_client(blob_name).download_blob().readall()
+
+
+def list_pdf_blobs(container_client, max_blobs=None):
+    names = sorted(blob.name for blob in container_client.list_blobs() if blob.name.endswith(".pdf"))
+    return names[:max_blobs] if max_blobs else names
+
+
+def _timed_call(fn, *args):
+    # Runs in the worker (possibly another process); the parent records the time
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class _BlobState:
+    __slots__ = ("pdf_bytes", "pdf_pages", "ocr_pages", "ocr_pending", "failed")
+
+    def __init__(self):
+        self.pdf_bytes = None
+        self.pdf_pages = None
+        self.ocr_pages = {}  # page number -> OCR text
+        self.ocr_pending = 1
+        self.failed = False
+
+
+def iter_ingested_documents(container_client, ocr_fn, blob_names=None, download_workers=8,
+                            parse_workers=None, ocr_workers=4, max_in_flight=16, page_text_mode="merge",
+                            ocr_policy=None, content_filter=None, on_failure=None):
+    """
+    Yield Documents for every PDF blob, streaming them out as blobs finish.
+
+    Without `ocr_policy`, `ocr_fn(pdf_bytes)` must return one OCR string per
+    page (empty pages included, so page numbers line up with the text layer).
+    With an ocr_selection.OcrPolicy, `ocr_fn(pdf_bytes, pages)` is called once
+    per page-range spec ("1-3,7") and must return {page number: OCR text}.
+    Set `parse_workers=0` to parse on a thread instead of a process pool.
+    Blobs that fail at any stage are reported, passed to `on_failure(name)`
+    (once per blob) and skipped. `page_text_mode` picks how the text layer
+    and OCR of a page are combined.
+    `content_filter(name, pdf_bytes)` is called after each download; blobs
+    it returns False for are dropped before parsing and OCR.
+    """
+    if blob_names is None:
+        blob_names = list_pdf_blobs(container_client)
+    pending_names = iter(blob_names)
+    states = {}
+    pending = {}  # future -> (stage, blob name)
+
+    if parse_workers == 0:
+        parse_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-parse")
+    else:
+        parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+    with ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="blob-download") as download_pool, \
+            ThreadPoolExecutor(max_workers=ocr_workers, thread_name_prefix="ocr") as ocr_pool, \
+            parse_pool:
+        exhausted = False
+        while True:
+            # Keep the pipeline full, but never hold more than max_in_flight blobs
+            while not exhausted and len(states) < max_in_flight:
+                name = next(pending_names, None)
+                if name is None:
+                    exhausted = True
+                    break
+                states[name] = _BlobState()
+                pending[download_pool.submit(
+                    _timed_call, download_blob_bytes, container_client, name
+                )] = ("download", name)
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, name = pending.pop(future)
+                state = states[name]
+                try:
+                    result, seconds = future.result()
+                    metrics.observe("stage_seconds", seconds, stage=f"ingest_{stage}")
+                except Exception as ex:
+                    if not state.failed:
+                        print(f"⚠️  Failed to ingest {name} ({stage}): {ex}")
+                        metrics.count("ingest_failed_blobs", stage=stage)
+                        if on_failure is not None:
+                            on_failure(name)
+                    state.failed = True
+                    result = None
+
+                if stage == "download" and not state.failed:
+                    metrics.count("ingest_bytes", len(result))
+                    if content_filter is not None and not content_filter(name, result):
+                        metrics.count("ingest_unchanged_blobs")
+                        del states[name]
+                        continue
+                    print("Processing:", name)
+                    if ocr_policy is None:
+                        pending[parse_pool.submit(_timed_call, parse_pdf_pages, result)] = ("parse", name)
+                        pending[ocr_pool.submit(_timed_call, ocr_fn, result)] = ("ocr", name)
+                    else:
+                        # OCR needs the page stats, so it is submitted once the parse is back
+                        state.pdf_bytes = result
+                        pending[parse_pool.submit(_timed_call, analyze_pdf_pages, result)] = ("parse", name)
+                    continue
+                if stage == "parse" and not state.failed:
+                    if ocr_policy is None:
+                        state.pdf_pages = result
+                    else:
+                        state.pdf_pages, stats = result
+                        selected = ocr_policy.select(stats)
+                        batches = ocr_policy.batches(selected)
+                        metrics.count("ocr_pages_selected", len(selected))
+                        metrics.count("ocr_pages_skipped", len(stats) - len(selected))
+                        metrics.count("ocr_requests", len(batches))
+                        state.ocr_pending = len(batches)
+                        for spec in batches:
+                            pending[ocr_pool.submit(_timed_call, ocr_fn, state.pdf_bytes, spec)] = ("ocr", name)
+                        state.pdf_bytes = None
+                elif stage == "ocr" and not state.failed:
+                    if ocr_policy is None:
+                        result = {i + 1: text for i, text in enumerate(result)}
+                    state.ocr_pages.update(result)
+                    state.ocr_pending -= 1
+
+                if state.failed:
+                    # Drop the blob once no stage of it is still running
+                    if not any(n == name for _, n in pending.values()):
+                        del states[name]
+                elif state.pdf_pages is not None and state.ocr_pending == 0:
+                    del states[name]
+                    num_pages = max(len(state.pdf_pages), max(state.ocr_pages, default=0))
+                    ocr_pages = [state.ocr_pages.get(i + 1, "") for i in range(num_pages)]
+                    with metrics.span("ingest_merge"):
+                        docs = merge_page_texts(name, state.pdf_pages, ocr_pages, page_text_mode)
+                    metrics.count("ingest_blobs")
+                    metrics.count("ingest_pages", len(docs))
+                    yield from docs
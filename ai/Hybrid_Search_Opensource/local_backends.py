@@ -0,0 +1,330 @@
+"""
+local_backends.py
+
+Local stand-ins for the Azure services used by the hybrid pipeline, so
+ingestion and search can be exercised offline on a plain machine.
+
+    LocalBlobContainer  - a directory that behaves like a ContainerClient
+    LocalOcr            - a Form Recognizer replacement that reads the text of synthetic PDFs
+    HashingEmbedder     - a deterministic embedder with the Embeddings interface
+    LocalChatModel      - an extractive chat model with invoke/stream/ainvoke/astream
+    synthetic_pages     - a reproducible corpus of page Documents
+    write_synthetic_pdfs - the same corpus as PDF files for LocalBlobContainer
+"""
+
+import os
+import re
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+from ocr_selection import parse_page_spec
+
+
+class LocalBlob:
+    """
+    The subset of azure.storage.blob.BlobProperties the pipeline reads.
+    """
+
+    def __init__(self, name, size, last_modified, etag=None):
+        self.name = name
+        self.size = size
+        self.last_modified = last_modified
+        self.etag = etag
+
+
+class _LocalDownload:
+    def __init__(self, path):
+        self._path = path
+
+    def readall(self):
+        with open(self._path, "rb") as f:
+            return f.read()
+
+
+class _LocalBlobClient:
+    def __init__(self, path):
+        self._path = path
+
+    def download_blob(self):
+        return _LocalDownload(self._path)
+
+
+class LocalBlobContainer:
+    """
+    Directory-backed replacement for ContainerClient (list_blobs / get_blob_client).
+
+    `download_latency` adds a fixed delay per download to mimic network time.
+    """
+
+    def __init__(self, root_dir, download_latency=0.0):
+        self.root_dir = root_dir
+        self.download_latency = download_latency
+
+    def list_blobs(self):
+        for dirpath, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                name = os.path.relpath(path, self.root_dir).replace(os.sep, "/")
+                yield LocalBlob(
+                    name, stat.st_size, datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                    etag=f'"0x{stat.st_mtime_ns:X}{stat.st_size:X}"',
+                )
+
+    def get_blob_client(self, blob):
+        name = blob if isinstance(blob, str) else blob.name
+        if self.download_latency:
+            time.sleep(self.download_latency)
+        return _LocalBlobClient(os.path.join(self.root_dir, name))
+
+
+class LocalOcr:
+    """
+    Callable OCR stand-in: returns the text of each page and counts calls.
+
+    A page's text is its text layer plus the /OCRText that make_pdf stores on
+    the images of scanned pages, so image-only pages come back with the text
+    they were made from, as real OCR would recover it.
+
+    `latency` adds a fixed delay per request and `page_latency` one per page,
+    to mimic Form Recognizer polling. Called with a page spec ("1-3,7"), as
+    selective OCR does, it returns {page number: text} for those pages only.
+    """
+
+    def __init__(self, latency=0.0, page_latency=0.0):
+        self.latency = latency
+        self.page_latency = page_latency
+        self.calls = 0
+        self.pages = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, pdf_bytes, pages=None):
+        import io
+        from pypdf import PdfReader
+
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        if pages is None:
+            page_numbers = range(1, len(reader.pages) + 1)
+        else:
+            page_numbers = [n for n in parse_page_spec(pages) if n <= len(reader.pages)]
+        with self._lock:
+            self.calls += 1
+            self.pages += len(page_numbers)
+        if self.latency or self.page_latency:
+            time.sleep(self.latency + self.page_latency * len(page_numbers))
+        texts = {n: _page_text(reader.pages[n - 1]) for n in page_numbers}
+        if pages is None:
+            return list(texts.values())
+        return texts
+
+
+def _page_text(page):
+    texts = [page.extract_text() or ""]
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources else None
+    for image in (xobjects.get_object().values() if xobjects else ()):
+        texts.append(str(image.get_object().get("/OCRText", "")))
+    return "\n".join(text for text in texts if text)
+
+
+class HashingEmbedder:
+    """
+    Deterministic offline embedder: hashed bag of words, L2-normalised.
+
+    Texts sharing words get similar vectors, which is enough to exercise the
+    vector side of hybrid search without an embeddings endpoint. `latency`
+    adds a fixed delay per call to mimic a network round trip.
+    """
+
+    def __init__(self, dim=256, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text).tolist() for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class LocalMessage:
+    """
+    Minimal AIMessage / AIMessageChunk stand-in (chunks concatenate with +).
+    """
+
+    def __init__(self, content):
+        self.content = content
+
+    def __add__(self, other):
+        return LocalMessage(self.content + other.content)
+
+    def __repr__(self):
+        return f"LocalMessage({self.content!r})"
+
+
+class LocalChatModel:
+    """
+    Chat model stand-in: answers with the context sentences that share the
+    most words with the question, one word per streamed chunk.
+
+    `first_token_latency` and `token_latency` mimic model response times.
+    """
+
+    def __init__(self, first_token_latency=0.0, token_latency=0.0, max_words=60):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.max_words = max_words
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _answer_words(self, prompt):
+        with self._lock:
+            self.calls += 1
+        context, _, question = prompt.rpartition("Question:")
+        question_words = set(re.findall(r"\w+", question.lower()))
+        sentences = [s for s in re.split(r"(?<=[.!?])\s+|\n+", context) if s.strip() and not s.startswith("[")]
+        ranked = sorted(sentences, key=lambda s: -len(question_words & set(re.findall(r"\w+", s.lower()))))
+        words = " ".join(ranked[:2]).split()[:self.max_words]
+        return words or ["I", "don't", "know."]
+
+    def invoke(self, prompt):
+        return LocalMessage("".join(chunk.content for chunk in self.stream(prompt)))
+
+    def stream(self, prompt):
+        words = self._answer_words(prompt)
+        time.sleep(self.first_token_latency)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_latency)
+            yield LocalMessage(word if i == 0 else " " + word)
+
+    async def ainvoke(self, prompt):
+        chunks = [chunk.content async for chunk in self.astream(prompt)]
+        return LocalMessage("".join(chunks))
+
+    async def astream(self, prompt):
+        words = self._answer_words(prompt)
+        await asyncio.sleep(self.first_token_latency)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield LocalMessage(word if i == 0 else " " + word)
+
+
+def synthetic_pages(n_pages, words_per_page=200, vocab_size=20_000, pages_per_source=50, seed=0):
+    """
+    Reproducible page Documents with a Zipf-distributed vocabulary.
+
+    Pages are built from sentences of 8-20 words, so chunking and sentence
+    level processing behave as on real text.
+    """
+    from langchain.docstore.document import Document
+
+    rng = np.random.default_rng(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    weights = 1.0 / np.arange(1, vocab_size + 1)
+    weights /= weights.sum()
+    sentence_rng = random.Random(seed)
+    docs = []
+    for page in range(n_pages):
+        words = rng.choice(vocab_size, size=words_per_page, p=weights)
+        sentences, start = [], 0
+        while start < words_per_page:
+            end = min(start + sentence_rng.randint(8, 20), words_per_page)
+            sentences.append(" ".join(vocab[w] for w in words[start:end]).capitalize() + ".")
+            start = end
+        docs.append(Document(
+            page_content=" ".join(sentences),
+            metadata={"source": f"doc{page // pages_per_source:05d}.pdf", "page": page % pages_per_source + 1}
+        ))
+    return docs
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(page_texts, scanned=()):
+    """
+    Minimal PDF with one line of Helvetica text per page (readable by pypdf).
+
+    Pages whose index is in `scanned` get a full-page image and no text layer,
+    like a scanned page; the image carries the page text as /OCRText for LocalOcr.
+    """
+    n = len(page_texts)
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(n))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{kids}] /Count {n} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    images = []
+    for i, text in enumerate(page_texts):
+        if i in scanned:
+            stream = b"q 612 0 0 792 0 0 cm /Im1 Do Q"
+            # Images go after the pages, so page i stays object 4 + 2i
+            resources = f"<< /XObject << /Im1 {4 + 2 * n + len(images)} 0 R >> >>"
+            images.append((
+                f"<< /Type /XObject /Subtype /Image /Width 1 /Height 1 /ColorSpace /DeviceGray "
+                f"/BitsPerComponent 8 /OCRText ({_pdf_escape(text)}) /Length 1 >>"
+            ).encode("latin-1", "replace") + b"\nstream\n\x80\nendstream")
+        else:
+            stream = f"BT /F1 10 Tf 36 756 Td ({_pdf_escape(text)}) Tj ET".encode("latin-1", "replace")
+            resources = "<< /Font << /F1 3 0 R >> >>"
+        objects.append((
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources {resources} /Contents {5 + 2 * i} 0 R >>"
+        ).encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects.extend(images)
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def write_synthetic_pdfs(root_dir, n_pages, pages_per_source=50, seed=0, scanned_ratio=0.0, **page_params):
+    """
+    Write synthetic_pages as PDFs of pages_per_source pages each; returns the page count.
+
+    A random `scanned_ratio` share of the pages is written as image-only (scanned) pages.
+    """
+    os.makedirs(root_dir, exist_ok=True)
+    docs = synthetic_pages(n_pages, pages_per_source=pages_per_source, seed=seed, **page_params)
+    by_source = {}
+    for doc in docs:
+        by_source.setdefault(doc.metadata["source"], []).append(doc.page_content)
+    rng = np.random.default_rng(seed)
+    for source, texts in by_source.items():
+        scanned = set(np.flatnonzero(rng.random(len(texts)) < scanned_ratio).tolist())
+        with open(os.path.join(root_dir, source), "wb") as f:
+            f.write(make_pdf(texts, scanned))
+    return len(docs)
@@ -0,0 +1,81 @@
+"""
+mapped_strings.py
+
+String columns stored as one UTF-8 blob plus an int64 offsets array, read
+back through memory maps so opening them costs nothing up front.
+"""
+
+import os
+import bisect
+
+import numpy as np
+
+
+def write_strings(path_prefix, strings):
+    """
+    Write a list of strings as one UTF-8 blob plus an int64 offsets array.
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(path_prefix + ".bin", "wb") as f:
+        position = 0
+        for i, s in enumerate(strings):
+            data = s.encode("utf-8")
+            f.write(data)
+            position += len(data)
+            offsets[i + 1] = position
+    np.save(path_prefix + ".offsets.npy", offsets)
+
+
+def map_file(path):
+    """
+    Memory-map a file read-only (empty files cannot be mapped).
+    """
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+class MappedStrings:
+    """
+    Read-only sequence of strings backed by a memory-mapped UTF-8 blob.
+    """
+
+    def __init__(self, path_prefix):
+        self._blob = map_file(path_prefix + ".bin")
+        self._offsets = np.load(path_prefix + ".offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def raw(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.raw(i).decode("utf-8")
+
+    def find(self, s):
+        """
+        Binary search for s in a sorted blob; returns its position or -1.
+        """
+        key = s.encode("utf-8")
+        raw_view = _RawView(self)
+        pos = bisect.bisect_left(raw_view, key)
+        if pos < len(self) and raw_view[pos] == key:
+            return pos
+        return -1
+
+
+class _RawView:
+    # bisect only needs __len__ and __getitem__
+    def __init__(self, strings):
+        self._strings = strings
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __getitem__(self, i):
+        return self._strings.raw(i)
@@ -0,0 +1,276 @@
+"""
+metrics.py
+
+In-process instrumentation for the hybrid RAG pipeline: timing spans,
+counters and latency histograms, exported as Prometheus text or JSON.
+
+    from metrics import metrics
+
+    with metrics.span("bm25"):
+        ...
+    metrics.count("ocr_cache_hits")
+    metrics.observe("ttft_seconds", 0.42)
+
+Every span feeds the `stage_seconds{stage="<name>"}` histogram and, while
+tracing is on, a ring buffer of recent spans with their parent span, so one
+request can be followed through the stages. PIPELINE_METRICS=0 disables
+everything; span() then returns a shared no-op context manager and count /
+observe return after one attribute check.
+"""
+
+import os
+import json
+import time
+import bisect
+import itertools
+import threading
+import contextvars
+from collections import deque
+
+
+# Seconds; covers sub-millisecond BM25 lookups up to slow OCR polls
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("registry", "name", "labels", "span_id", "parent", "trace_id", "start", "_token")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.span_id = next(_span_ids)
+        self.parent = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self._token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        self.registry._finish_span(self, seconds, failed=exc_type is not None)
+        return False
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Bucket-interpolated quantile, as Prometheus histogram_quantile does.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, histograms and recent spans.
+    """
+
+    def __init__(self, enabled=True, tracing=True, max_spans=10_000, prefix="hybrid_rag_"):
+        self.enabled = enabled
+        self.tracing = tracing
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._spans = deque(maxlen=max_spans)
+
+    def span(self, name, **labels):
+        """
+        Context manager timing one stage into stage_seconds{stage=name}.
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name, labels)
+
+    def timed(self, name):
+        """
+        Decorator form of span().
+        """
+        def decorator(fn):
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            wrapper.__name__ = fn.__name__
+            wrapper.__doc__ = fn.__doc__
+            return wrapper
+        return decorator
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def _finish_span(self, span, seconds, failed):
+        self.observe("stage_seconds", seconds, stage=span.name, **span.labels)
+        if failed:
+            self.count("stage_errors", stage=span.name)
+        if self.tracing:
+            with self._lock:
+                self._spans.append({
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent,
+                    "trace_id": span.trace_id,
+                    "start": time.time() - seconds,
+                    "seconds": round(seconds, 6),
+                    "error": failed,
+                    **span.labels,
+                })
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._spans.clear()
+
+    # -- export ------------------------------------------------------------
+
+    def prometheus_text(self):
+        """
+        All counters and histograms in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            declared = set()
+            for (name, key), value in counters:
+                metric = f"{self.prefix}{name}_total"
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} counter")
+                    declared.add(metric)
+                lines.append(f"{metric}{_format_labels(key)} {value}")
+            for (name, key), histogram in histograms:
+                metric = f"{self.prefix}{name}"
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} histogram")
+                    declared.add(metric)
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    lines.append(f"{metric}_bucket{_format_labels(key, [('le', repr(bound))])} {cumulative}")
+                lines.append(f"{metric}_bucket{_format_labels(key, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{metric}_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{metric}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self, include_spans=True):
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(key), "value": value}
+                for (name, key), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(key),
+                    "count": h.count,
+                    "sum": h.sum,
+                    "mean": h.sum / h.count if h.count else None,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                }
+                for (name, key), h in sorted(self._histograms.items())
+            ]
+            spans = list(self._spans) if include_spans else []
+        return {"counters": counters, "histograms": histograms, "spans": spans}
+
+    def dump(self, path, include_spans=True):
+        """
+        Write to_dict() as JSON, or Prometheus text for a path ending in .prom.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus_text())
+            else:
+                json.dump(self.to_dict(include_spans), f, indent=2)
+
+    def stage_summary(self):
+        """
+        {stage: {"count", "total_s", "p50_ms", "p95_ms"}} for printing.
+        """
+        summary = {}
+        for h in self.to_dict(include_spans=False)["histograms"]:
+            if h["name"] == "stage_seconds":
+                summary[h["labels"]["stage"]] = {
+                    "count": h["count"],
+                    "total_s": round(h["sum"], 3),
+                    "p50_ms": round(h["p50"] * 1000, 2),
+                    "p95_ms": round(h["p95"] * 1000, 2),
+                }
+        return summary
+
+
+metrics = Metrics(
+    enabled=os.getenv("PIPELINE_METRICS", "1") == "1",
+    tracing=os.getenv("PIPELINE_TRACING", "1") == "1",
+)
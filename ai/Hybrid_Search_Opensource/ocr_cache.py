@@ -0,0 +1,138 @@
+"""
+ocr_cache.py
+
+Content-addressed cache for Form Recognizer OCR results.
+
+Entries are keyed on a SHA-256 of the OCR model id, the requested page range
+(if any) and the PDF bytes, so the same brochure hits the cache no matter
+which temp file or blob it came from.
+Each entry is a gzip-compressed JSON list of per-page text (no pickle), and
+the directory is kept under a byte budget by evicting least recently used
+entries.
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+CACHE_SUFFIX = ".json.gz"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class OcrCache:
+    """
+    Size-bounded LRU cache of per-page OCR text, with hit/miss counters.
+
+    Recency survives restarts through file modification times, which are
+    bumped on every hit. Safe to share between threads.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, oldest first
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(pdf_bytes, model_id, pages=None):
+        """
+        Cache key of an OCR request; `pages` is the page spec of a partial request.
+        """
+        digest = hashlib.sha256()
+        digest.update(model_id.encode("utf-8"))
+        digest.update(b"\0")
+        if pages:
+            digest.update(f"pages={pages}".encode("utf-8"))
+            digest.update(b"\0")
+        digest.update(pdf_bytes)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, name[:-len(CACHE_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def get(self, key):
+        """
+        Return the cached list of page texts for key, or None on a miss.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+        try:
+            with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+                pages = json.load(f)["pages"]
+            os.utime(self._path(key))
+        except (OSError, ValueError, KeyError):
+            # Unreadable or concurrently evicted entry: treat it as a miss
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+        return pages
+
+    def put(self, key, pages, model_id):
+        """
+        Store page texts for key, then evict old entries over the byte budget.
+        """
+        payload = gzip.compress(json.dumps({"model_id": model_id, "pages": pages}).encode("utf-8"))
+        path = self._path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = len(payload)
+            self._total_bytes += len(payload)
+            self._evict()
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+            }
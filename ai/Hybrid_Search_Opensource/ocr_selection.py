@@ -0,0 +1,185 @@
+"""
+ocr_selection.py
+
+Decides which PDF pages need OCR, so born-digital pages never reach Form Recognizer.
+
+Every page gets three cheap measurements from its parsed text layer and content stream:
+
+    text_density    non-whitespace characters per 1000 pt² of page area
+    glyph_coverage  share of those characters that decode to real glyphs
+                    (not U+FFFD, control, private-use or unassigned code points,
+                    which is what fonts without a ToUnicode map produce)
+    image_ratio     share of the page area covered by placed images
+
+OcrPolicy sends a page to OCR when its text layer is sparse, undecodable or
+mostly covered by images (text inside scans and figures). The selected pages
+are grouped into page-range specs ("1-3,7") of at most max_pages pages, one
+Form Recognizer request each, and the OCR text is merged back by page number.
+"""
+
+import unicodedata
+
+
+# Defaults for OcrPolicy; a US letter page is 612 x 792 pt, i.e. 485 kpt²
+DEFAULT_MIN_TEXT_DENSITY = 0.2
+DEFAULT_MIN_GLYPH_COVERAGE = 0.9
+DEFAULT_MAX_IMAGE_RATIO = 0.5
+
+_BAD_CATEGORIES = {"Cc", "Co", "Cn", "Cs"}
+
+
+def glyph_coverage(text):
+    """
+    Share of non-whitespace characters that are real glyphs (1.0 for empty text).
+    """
+    total = bad = 0
+    for ch in text:
+        if ch.isspace():
+            continue
+        total += 1
+        if ch == "\ufffd" or unicodedata.category(ch) in _BAD_CATEGORIES:
+            bad += 1
+    return 1.0 - bad / total if total else 1.0
+
+
+def _multiply(m, n):
+    # PDF matrices [a b c d e f]; m applied first, then n
+    a, b, c, d, e, f = m
+    a2, b2, c2, d2, e2, f2 = n
+    return (
+        a * a2 + b * c2, a * b2 + b * d2,
+        c * a2 + d * c2, c * b2 + d * d2,
+        e * a2 + f * c2 + e2, e * b2 + f * d2 + f2,
+    )
+
+
+def _image_area(content, resources, ctm, depth=0):
+    """
+    Total area (in default user space) of the images placed by a content stream.
+
+    Tracks the current transformation matrix through q/Q/cm; every image is
+    the unit square mapped by the CTM at its `Do` (or inline image).
+    """
+    from pypdf.generic import ContentStream
+
+    xobjects = resources.get("/XObject") if resources else None
+    xobjects = xobjects.get_object() if xobjects is not None else {}
+    area = 0.0
+    stack = []
+    for operands, operator in ContentStream(content, None).operations:
+        if operator == b"q":
+            stack.append(ctm)
+        elif operator == b"Q":
+            ctm = stack.pop() if stack else ctm
+        elif operator == b"cm":
+            ctm = _multiply(tuple(float(x) for x in operands), ctm)
+        elif operator == b"INLINE IMAGE":
+            area += abs(ctm[0] * ctm[3] - ctm[1] * ctm[2])
+        elif operator == b"Do" and operands and operands[0] in xobjects:
+            xobject = xobjects[operands[0]].get_object()
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image":
+                area += abs(ctm[0] * ctm[3] - ctm[1] * ctm[2])
+            elif subtype == "/Form" and depth < 3:
+                matrix = tuple(float(x) for x in xobject.get("/Matrix", (1, 0, 0, 1, 0, 0)))
+                area += _image_area(xobject, xobject.get("/Resources"), _multiply(matrix, ctm), depth + 1)
+    return area
+
+
+def _has_images(page):
+    resources = page.get("/Resources")
+    resources = resources.get_object() if resources is not None else {}
+    if resources.get("/XObject"):
+        return True
+    contents = page.get_contents()
+    return contents is not None and b"BI" in contents.get_data()
+
+
+def page_stats(page, text):
+    """
+    {page area, chars, text_density, glyph_coverage, image_ratio} of a pypdf page and its extracted text.
+    """
+    box = page.mediabox
+    area = float(box.width) * float(box.height)
+    chars = sum(1 for ch in text if not ch.isspace())
+    image_ratio = 0.0
+    # Walking the content stream is the expensive part; most text pages have no images at all
+    if area > 0 and _has_images(page):
+        resources = page.get("/Resources")
+        image_area = _image_area(page.get_contents(), resources.get_object() if resources else None,
+                                 (1.0, 0.0, 0.0, 1.0, 0.0, 0.0))
+        image_ratio = min(image_area / area, 1.0)
+    return {
+        "area": area,
+        "chars": chars,
+        "text_density": 1000.0 * chars / area if area > 0 else 0.0,
+        "glyph_coverage": glyph_coverage(text),
+        "image_ratio": image_ratio,
+    }
+
+
+class OcrPolicy:
+    """
+    Per-page OCR decision from page_stats (see module docstring).
+    """
+
+    def __init__(self, min_text_density=DEFAULT_MIN_TEXT_DENSITY, min_glyph_coverage=DEFAULT_MIN_GLYPH_COVERAGE,
+                 max_image_ratio=DEFAULT_MAX_IMAGE_RATIO, max_pages=20):
+        self.min_text_density = min_text_density
+        self.min_glyph_coverage = min_glyph_coverage
+        self.max_image_ratio = max_image_ratio
+        self.max_pages = max_pages
+
+    def needs_ocr(self, stats):
+        return (
+            stats["text_density"] < self.min_text_density
+            or stats["glyph_coverage"] < self.min_glyph_coverage
+            or stats["image_ratio"] > self.max_image_ratio
+        )
+
+    def select(self, page_stats_list):
+        """
+        1-based numbers of the pages that need OCR.
+        """
+        return [i + 1 for i, stats in enumerate(page_stats_list) if self.needs_ocr(stats)]
+
+    def batches(self, page_numbers):
+        """
+        Page-range specs covering page_numbers, at most max_pages pages each.
+        """
+        return ocr_batches(page_numbers, self.max_pages)
+
+
+def page_ranges(page_numbers):
+    """
+    Compact page spec for sorted page numbers: [1, 2, 3, 7] -> "1-3,7".
+    """
+    ranges = []
+    for n in page_numbers:
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def parse_page_spec(spec):
+    """
+    Page numbers of a page spec: "1-3,7" -> [1, 2, 3, 7].
+    """
+    pages = []
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        pages.extend(range(int(first), int(last or first) + 1))
+    return pages
+
+
+def ocr_batches(page_numbers, max_pages=20):
+    """
+    Split sorted page numbers into page specs of at most max_pages pages (0 = one spec).
+    """
+    page_numbers = sorted(page_numbers)
+    if not page_numbers:
+        return []
+    step = max_pages if max_pages > 0 else len(page_numbers)
+    return [page_ranges(page_numbers[i:i + step]) for i in range(0, len(page_numbers), step)]
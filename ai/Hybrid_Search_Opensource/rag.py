@@ -0,0 +1,292 @@
+"""
+rag.py
+
+Retrieval-augmented answering on top of HybridRetriever:
+answer cache -> hybrid retrieval -> context packing -> prompt -> LLM.
+
+RagPipeline.invoke returns the whole LLM response like the original
+rag_pipeline. stream (generator) and astream (async iterator) yield the
+answer text as the LLM produces it, followed by the citations of the
+packed passages, and record time-to-first-token and tokens/sec for every
+request.
+"""
+
+import time
+import asyncio
+from collections import deque
+
+import numpy as np
+
+from context_packing import format_citation, format_passage
+from embedding_service import TokenCounter
+from metrics import metrics
+
+
+PROMPT_TEMPLATE = (
+    "Answer the question using the context below and provide sources for each point:"
+    "\n\n{context}\n\nQuestion: {query}"
+)
+
+
+class _Prepared:
+    __slots__ = ("query", "query_vector", "context_ids", "citations", "prompt", "params")
+
+    def __init__(self, query, query_vector, context_ids, citations, prompt, params=None):
+        self.query = query
+        self.params = params
+        self.query_vector = query_vector
+        self.context_ids = context_ids
+        self.citations = citations
+        self.prompt = prompt
+
+
+def answer_text(answer):
+    """
+    Text of an LLM response (message objects carry it in .content).
+    """
+    return getattr(answer, "content", answer)
+
+
+def format_sources(citations):
+    return "\n\nSources: " + "; ".join(citations) if citations else ""
+
+
+class RagPipeline:
+    """
+    Answers questions from a HybridRetriever and a LangChain chat model.
+    """
+
+    def __init__(self, retriever, llm, answer_cache=None, context_packer=None, token_counter=None,
+                 top_k=3, alpha=0.6, candidate_factor=2, fusion="minmax", mmr_lambda=None, max_per_source=0,
+                 history_size=1000, verbose=True):
+        self.retriever = retriever
+        self.llm = llm
+        self.answer_cache = answer_cache
+        self.context_packer = context_packer
+        self.token_counter = token_counter or (context_packer.token_counter if context_packer else TokenCounter())
+        self.top_k = top_k
+        self.alpha = alpha
+        self.candidate_factor = candidate_factor
+        self.fusion = fusion
+        self.mmr_lambda = mmr_lambda              # MMR diversity re-ranking (see diversity.py)
+        self.max_per_source = max_per_source
+        self.history = deque(maxlen=history_size)   # per-request timing records
+        self.verbose = verbose
+
+    # -- retrieval and prompt --------------------------------------------
+
+    def retrieval_params(self, top_k=None, alpha=None, candidate_factor=None, fusion=None, mmr_lambda=None,
+                         max_per_source=None):
+        """
+        The search_ids_batch parameters of a request, unset ones taken from the pipeline.
+        """
+        return {
+            "top_k": top_k or self.top_k,
+            "alpha": self.alpha if alpha is None else alpha,
+            "candidate_factor": candidate_factor or self.candidate_factor,
+            "fusion": fusion or self.fusion,
+            "mmr_lambda": self.mmr_lambda if mmr_lambda is None else mmr_lambda,
+            "max_per_source": self.max_per_source if max_per_source is None else max_per_source,
+        }
+
+    def cached_answer(self, query, params=None):
+        """
+        Cached (response, citations) for exactly this query and retrieval params, or None.
+        """
+        metrics.count("rag_requests")
+        if self.answer_cache is None:
+            return None
+        cached = self.answer_cache.get(query, params)
+        if cached is not None:
+            metrics.count("answer_cache_hits", tier="exact")
+        return cached
+
+    def prepare(self, query, top_k=None, alpha=None, candidate_factor=None, fusion=None, mmr_lambda=None,
+                max_per_source=None):
+        """
+        (cached answer, None) on a cache hit, otherwise (None, prepared prompt).
+
+        Cached answers are (response, citations) pairs.
+        """
+        params = self.retrieval_params(top_k, alpha, candidate_factor, fusion, mmr_lambda, max_per_source)
+        cached = self.cached_answer(query, params)
+        if cached is not None:
+            return cached, None
+        # Embedded alongside BM25; the vector is kept for the semantic answer cache
+        pending = self.retriever.embed_queries_async([query])
+        ids, scores = self.retriever.search_ids_batch([query], query_vectors=pending, **params)
+        missed = getattr(pending, "deadline_missed", False) or pending.exception() is not None
+        query_vector = None if missed else pending.result()[0]
+        return self.prepare_retrieved(query, query_vector, ids[0], scores[0], params)
+
+    def prepare_retrieved(self, query, query_vector, ids, scores, params=None):
+        """
+        Same as prepare for a query already retrieved (one row of a batch search).
+
+        query_vector is None when the search fell back to BM25 alone; such
+        answers bypass the answer cache. `params` are the retrieval
+        parameters of the search, which key the exact cache tier.
+        """
+        found = ids >= 0
+        context_ids = [int(i) for i in ids[found]]
+        if self.answer_cache is not None and query_vector is not None:
+            # A similar earlier question is reused only if it was answered from the same chunks
+            cached = self.answer_cache.get_similar(query_vector, context_ids)
+            if cached is not None:
+                metrics.count("answer_cache_hits", tier="semantic")
+                return cached, None
+            metrics.count("answer_cache_misses")
+
+        docs = [self.retriever.docs[i] for i in context_ids]
+        if self.context_packer is not None:
+            with metrics.span("context_packing"):
+                packed = self.context_packer.pack(query, docs, scores[found])
+            metrics.count("context_tokens", packed.tokens)
+            metrics.count("context_tokens_saved", packed.saved_tokens)
+            if self.verbose:
+                print(f"📦 Context: {packed.tokens} tokens ({packed.saved_tokens} saved)")
+            context, docs = packed.text, packed.docs
+        else:
+            context = "\n\n".join(format_passage(doc.page_content, doc) for doc in docs)
+        citations = list(dict.fromkeys(format_citation(doc) for doc in docs))
+        prompt = PROMPT_TEMPLATE.format(context=context, query=query)
+        return None, _Prepared(query, query_vector, context_ids, citations, prompt, params)
+
+    def remember(self, prepared, response):
+        if self.answer_cache is not None and prepared.query_vector is not None:
+            self.answer_cache.put(
+                prepared.query, prepared.query_vector, prepared.context_ids, (response, prepared.citations),
+                params=prepared.params,
+            )
+
+    # -- answering -------------------------------------------------------
+
+    def invoke(self, query, **retrieval_params):
+        """
+        Full LLM response for query (blocks until the completion is done).
+        """
+        cached, prepared = self.prepare(query, **retrieval_params)
+        if cached is not None:
+            return cached[0]
+        with metrics.span("llm"):
+            response = self.llm.invoke(prepared.prompt)
+        metrics.count("llm_output_tokens", self.token_counter.count(answer_text(response)))
+        self.remember(prepared, response)
+        return response
+
+    __call__ = invoke
+
+    def _record(self, start, first_token_at, end, text, cached):
+        total = end - start
+        ttft = (first_token_at if first_token_at is not None else end) - start
+        tokens = self.token_counter.count(text) if text else 0
+        generation = total - ttft
+        record = {
+            "ttft_s": round(ttft, 4),
+            "total_s": round(total, 4),
+            "output_tokens": tokens,
+            "tokens_per_s": round(tokens / generation, 1) if generation > 0 and not cached else None,
+            "cached": cached,
+        }
+        self.history.append(record)
+        metrics.observe("ttft_seconds", ttft, cached=str(cached).lower())
+        metrics.count("llm_output_tokens", 0 if cached else tokens)
+        if self.verbose:
+            print(f"⏱️  TTFT {ttft * 1000:.0f} ms, {tokens} tokens in {total:.2f}s" + (" (cached)" if cached else ""))
+        return record
+
+    def stream(self, query, **retrieval_params):
+        """
+        Yield the answer text as it arrives, then the sources line.
+        """
+        start = time.perf_counter()
+        cached, prepared = self.prepare(query, **retrieval_params)
+        if cached is not None:
+            response, citations = cached
+            first_token_at = time.perf_counter()
+            yield answer_text(response)
+            yield format_sources(citations)
+            self._record(start, first_token_at, first_token_at, answer_text(response), cached=True)
+            return
+
+        first_token_at = None
+        response = None
+        llm_start = time.perf_counter()
+        for chunk in self.llm.stream(prepared.prompt):
+            if first_token_at is None and answer_text(chunk):
+                first_token_at = time.perf_counter()
+            response = chunk if response is None else response + chunk
+            yield answer_text(chunk)
+        end = time.perf_counter()
+        metrics.observe("stage_seconds", end - llm_start, stage="llm")
+        if response is not None:
+            self.remember(prepared, response)
+        yield format_sources(prepared.citations)
+        # Recorded after the last yield so the timing line never splits the answer
+        self._record(start, first_token_at, end, answer_text(response) if response is not None else "", cached=False)
+
+    async def astream(self, query, **retrieval_params):
+        """
+        Async version of stream; retrieval runs on a worker thread.
+        """
+        start = time.perf_counter()
+        cached, prepared = await asyncio.to_thread(self.prepare, query, **retrieval_params)
+        async for text in self.astream_prepared(cached, prepared, start):
+            yield text
+
+    async def astream_prepared(self, cached, prepared, start=None):
+        """
+        astream for the result of prepare / prepare_retrieved.
+        """
+        start = time.perf_counter() if start is None else start
+        if cached is not None:
+            response, citations = cached
+            first_token_at = time.perf_counter()
+            yield answer_text(response)
+            yield format_sources(citations)
+            self._record(start, first_token_at, first_token_at, answer_text(response), cached=True)
+            return
+
+        first_token_at = None
+        response = None
+        llm_start = time.perf_counter()
+        async for chunk in self.llm.astream(prepared.prompt):
+            if first_token_at is None and answer_text(chunk):
+                first_token_at = time.perf_counter()
+            response = chunk if response is None else response + chunk
+            yield answer_text(chunk)
+        end = time.perf_counter()
+        metrics.observe("stage_seconds", end - llm_start, stage="llm")
+        if response is not None:
+            self.remember(prepared, response)
+        yield format_sources(prepared.citations)
+        # Recorded after the last yield so the timing line never splits the answer
+        self._record(start, first_token_at, end, answer_text(response) if response is not None else "", cached=False)
+
+    async def ainvoke_prepared(self, cached, prepared):
+        """
+        (response, citations, cached) for the result of prepare / prepare_retrieved.
+        """
+        if cached is not None:
+            return cached[0], cached[1], True
+        with metrics.span("llm"):
+            response = await self.llm.ainvoke(prepared.prompt)
+        metrics.count("llm_output_tokens", self.token_counter.count(answer_text(response)))
+        self.remember(prepared, response)
+        return response, prepared.citations, False
+
+    def stream_stats(self):
+        """
+        TTFT percentiles and generation speed over the recorded requests.
+        """
+        if not self.history:
+            return {"requests": 0}
+        ttft = np.array([r["ttft_s"] for r in self.history])
+        speeds = [r["tokens_per_s"] for r in self.history if r["tokens_per_s"]]
+        return {
+            "requests": len(self.history),
+            "cached": sum(r["cached"] for r in self.history),
+            "ttft_p50_s": round(float(np.percentile(ttft, 50)), 4),
+            "ttft_p95_s": round(float(np.percentile(ttft, 95)), 4),
+            "tokens_per_s_mean": round(float(np.mean(speeds)), 1) if speeds else None,
+        }
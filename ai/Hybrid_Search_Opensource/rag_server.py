@@ -0,0 +1,488 @@
+"""
+rag_server.py
+
+Resident asyncio server for hybrid search and RAG answers.
+
+The index is loaded once at startup. Every request then goes through:
+    - admission control: at most `max_concurrency` requests are worked on at
+      once and requests beyond `max_pending` waiting ones get a 503,
+    - coalescing: identical in-flight requests share one result,
+    - micro-batching: queries arriving within `max_wait_ms` of each other are
+      embedded in one call and searched with one batched BM25/FAISS pass,
+      on a worker thread so the event loop never runs CPU-bound scoring.
+
+Endpoints:
+    GET  /health
+    GET  /stats
+    GET  /metrics         per-stage metrics, Prometheus text format
+    GET  /metrics.json    the same plus recent spans, as JSON
+    POST /search          {"query": "...", "top_k": 3, "alpha": 0.5, "fusion": "minmax"}
+    POST /answer          {"query": "...", "top_k": 3, "alpha": 0.6}
+    POST /answer/stream   same body; the answer is streamed as plain text (a failure
+                          after the first byte ends it with an "[error] ..." line)
+
+Request parameters besides "query" (all optional): top_k (at most
+--max-top-k), alpha, candidate_factor (at most --max-candidate-factor),
+fusion, mmr_lambda (MMR diversity re-ranking, null = off) and
+max_per_source (0 = no cap). Invalid or out-of-range values get a 400.
+/search defaults to SEARCH_DEFAULTS; the answer endpoints default to the
+pipeline's settings (HYBRID_* variables).
+
+Against the snapshot and Azure settings of Hybrid_Search1_OpenSource.py:
+
+    python rag_server.py --port 8080
+
+Fully offline, with a hashing embedder and an extractive stand-in LLM:
+
+    python rag_server.py --local --local-pages 20000
+    python rag_server.py --local --pdf-dir ./pdfs
+"""
+
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+from answer_cache import normalize_query
+from fusion import FUSION_METHODS
+from rag import answer_text
+from metrics import metrics
+
+
+SEARCH_DEFAULTS = {
+    "top_k": 3, "alpha": 0.5, "candidate_factor": 2, "fusion": "minmax", "mmr_lambda": None, "max_per_source": 0,
+}
+# Upper bounds on what one request may ask for; candidate lists are top_k * candidate_factor per side
+MAX_TOP_K = 100
+MAX_CANDIDATE_FACTOR = 10
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_weight(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= 1
+
+
+def validate_params(params, max_top_k=MAX_TOP_K, max_candidate_factor=MAX_CANDIDATE_FACTOR):
+    """
+    Error message for the first invalid search parameter of a request body, or None.
+    """
+    unknown = set(params) - set(SEARCH_DEFAULTS)
+    if unknown:
+        return f"unknown parameters: {sorted(unknown)}"
+    for name, limit in (("top_k", max_top_k), ("candidate_factor", max_candidate_factor)):
+        if name in params and not (_is_int(params[name]) and 1 <= params[name] <= limit):
+            return f"'{name}' must be an integer between 1 and {limit}"
+    if "max_per_source" in params and not (_is_int(params["max_per_source"]) and params["max_per_source"] >= 0):
+        return "'max_per_source' must be an integer >= 0"
+    if "alpha" in params and not _is_weight(params["alpha"]):
+        return "'alpha' must be a number between 0 and 1"
+    if params.get("mmr_lambda") is not None and not _is_weight(params["mmr_lambda"]):
+        return "'mmr_lambda' must be null or a number between 0 and 1"
+    if "fusion" in params and params["fusion"] not in FUSION_METHODS:
+        return f"'fusion' must be one of {sorted(FUSION_METHODS)}"
+    return None
+
+
+class MicroBatcher:
+    """
+    Collects concurrent searches and runs them as batched retriever calls.
+
+    Requests with the same search parameters that arrive within max_wait_ms
+    (up to max_batch_size of them) share one embed_queries call and one
+    search_ids_batch call on the executor.
+    """
+
+    def __init__(self, retriever, executor, max_batch_size=32, max_wait_ms=5.0):
+        self.retriever = retriever
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.batched_queries = 0
+        self._queue = None
+        self._worker = None
+        self._running = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+
+    async def search(self, query, params):
+        """
+        (query vector, ids, scores) for one query, resolved with its batch.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((tuple(sorted(params.items())), query, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            groups = {}
+            for params, query, future in batch:
+                groups.setdefault(params, []).append((query, future))
+            for params, items in groups.items():
+                # Dispatch without waiting, so the next batch can form meanwhile
+                task = asyncio.create_task(self._run(dict(params), items))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _run(self, params, items):
+        queries = list(dict.fromkeys(query for query, _ in items))
+        self.batches += 1
+        self.batched_queries += len(items)
+        metrics.observe("batch_size", len(items), buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._search_batch, queries, params
+            )
+        except Exception as ex:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        for query, future in items:
+            if not future.done():
+                future.set_result(results[query])
+
+    def _search_batch(self, queries, params):
+        # The embedding request overlaps BM25; a batch past the deadline is answered lexical-only
+        pending = self.retriever.embed_queries_async(queries)
+        ids, scores = self.retriever.search_ids_batch(queries, query_vectors=pending, **params)
+        vectors = None if getattr(pending, "deadline_missed", False) else pending.result()
+        return {query: (vectors[i] if vectors is not None else None, ids[i], scores[i])
+                for i, query in enumerate(queries)}
+
+
+class RagServer:
+    """
+    Search and answer endpoints over one RagPipeline, with coalescing and micro-batching.
+    """
+
+    def __init__(self, pipeline, max_concurrency=64, max_pending=1024, max_batch_size=32,
+                 max_wait_ms=5.0, search_workers=4, max_top_k=MAX_TOP_K, max_candidate_factor=MAX_CANDIDATE_FACTOR):
+        self.pipeline = pipeline
+        self.retriever = pipeline.retriever
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.max_top_k = max_top_k
+        self.max_candidate_factor = max_candidate_factor
+        self.executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="search")
+        self.batcher = MicroBatcher(self.retriever, self.executor, max_batch_size, max_wait_ms)
+        self._semaphore = None
+        self._inflight = {}
+        self.pending = 0
+        self.requests = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.latencies = {"search": deque(maxlen=10_000), "answer": deque(maxlen=10_000)}
+
+    # -- core operations ---------------------------------------------------
+
+    async def _coalesced(self, key, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            metrics.count("requests_coalesced")
+        # shield: one client disconnecting must not cancel the shared work
+        return await asyncio.shield(task)
+
+    async def search(self, query, **params):
+        params = {**SEARCH_DEFAULTS, **params}
+        key = ("search", normalize_query(query), tuple(sorted(params.items())))
+        return await self._coalesced(key, lambda: self.batcher.search(query, params))
+
+    async def _prepare(self, query, params):
+        cached = self.pipeline.cached_answer(query, params)
+        if cached is not None:
+            return cached, None
+        vector, ids, scores = await self.search(query, **params)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.pipeline.prepare_retrieved, query, vector, ids, scores, params
+        )
+
+    def _answer_params(self, params):
+        # Unset parameters fall back to the pipeline's (and so to its HYBRID_* settings)
+        return {
+            "top_k": self.pipeline.top_k,
+            "alpha": self.pipeline.alpha,
+            "candidate_factor": self.pipeline.candidate_factor,
+            "fusion": self.pipeline.fusion,
+            "mmr_lambda": self.pipeline.mmr_lambda,
+            "max_per_source": self.pipeline.max_per_source,
+            **params,
+        }
+
+    async def answer(self, query, **params):
+        params = self._answer_params(params)
+
+        async def run():
+            cached, prepared = await self._prepare(query, params)
+            response, citations, was_cached = await self.pipeline.ainvoke_prepared(cached, prepared)
+            return {"answer": answer_text(response), "sources": citations, "cached": was_cached}
+
+        key = ("answer", normalize_query(query), tuple(sorted(params.items())))
+        return await self._coalesced(key, run)
+
+    # -- HTTP --------------------------------------------------------------
+
+    async def _admit(self, request, endpoint, handler):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            metrics.count("requests_rejected")
+            return web.json_response({"error": "server busy"}, status=503)
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({"error": "request body must be JSON"}, status=400)
+        query = body.pop("query", None) if isinstance(body, dict) else None
+        if not isinstance(query, str) or not query.strip():
+            return web.json_response({"error": "'query' must be a non-empty string"}, status=400)
+        error = validate_params(body, self.max_top_k, self.max_candidate_factor)
+        if error is not None:
+            return web.json_response({"error": error}, status=400)
+
+        self.requests += 1
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            async with self._semaphore:
+                return await handler(request, query, body)
+        except Exception as ex:
+            self.errors += 1
+            started = request.get("stream_response")
+            if started is not None and started.prepared:
+                # Headers are out; a JSON error can no longer be sent on this connection
+                return started
+            return web.json_response({"error": str(ex)}, status=500)
+        finally:
+            self.pending -= 1
+            seconds = time.perf_counter() - start
+            self.latencies[endpoint].append(seconds)
+            metrics.observe("request_seconds", seconds, endpoint=endpoint)
+
+    async def _search_handler(self, request, query, params):
+        _, ids, scores = await self.search(query, **params)
+        results = []
+        for doc_id, score in zip(ids, scores):
+            if doc_id < 0:
+                continue
+            doc = self.retriever.docs[int(doc_id)]
+            results.append({"id": int(doc_id), "score": float(score), **doc.metadata, "text": doc.page_content})
+        return web.json_response({"query": query, "results": results})
+
+    async def _answer_handler(self, request, query, params):
+        return web.json_response({"query": query, **await self.answer(query, **params)})
+
+    async def _stream_handler(self, request, query, params):
+        cached, prepared = await self._prepare(query, self._answer_params(params))
+        response = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8"})
+        request["stream_response"] = response
+        await response.prepare(request)
+        try:
+            async for text in self.pipeline.astream_prepared(cached, prepared):
+                if text:
+                    await response.write(text.encode("utf-8"))
+        except Exception as ex:
+            # The 200 is already sent: end the stream with an error line instead
+            self.errors += 1
+            metrics.count("stream_errors")
+            try:
+                await response.write(f"\n[error] {ex}\n".encode("utf-8"))
+            except ConnectionError:
+                return response
+        await response.write_eof()
+        return response
+
+    async def handle_search(self, request):
+        return await self._admit(request, "search", self._search_handler)
+
+    async def handle_answer(self, request):
+        return await self._admit(request, "answer", self._answer_handler)
+
+    async def handle_answer_stream(self, request):
+        return await self._admit(request, "answer", self._stream_handler)
+
+    async def handle_health(self, request):
+        return web.json_response({"status": "ok", "docs": len(self.retriever.docs)})
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def handle_metrics(self, request):
+        return web.Response(text=metrics.prometheus_text(), content_type="text/plain", charset="utf-8")
+
+    async def handle_metrics_json(self, request):
+        return web.json_response(metrics.to_dict())
+
+    def stats(self):
+        stats = {
+            "requests": self.requests,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "coalesced": self.coalesced,
+            "batches": self.batcher.batches,
+            "mean_batch_size": round(self.batcher.batched_queries / self.batcher.batches, 2)
+            if self.batcher.batches else 0.0,
+        }
+        for endpoint, latencies in self.latencies.items():
+            if latencies:
+                values = np.array(latencies) * 1000
+                stats[f"{endpoint}_p50_ms"] = round(float(np.percentile(values, 50)), 2)
+                stats[f"{endpoint}_p99_ms"] = round(float(np.percentile(values, 99)), 2)
+        if self.pipeline.answer_cache is not None:
+            stats["answer_cache"] = self.pipeline.answer_cache.stats()
+        stats["streaming"] = self.pipeline.stream_stats()
+        return stats
+
+    async def _on_startup(self, app):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.batcher.start()
+
+    async def _on_cleanup(self, app):
+        await self.batcher.stop()
+        self.executor.shutdown(wait=False)
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.get("/health", self.handle_health),
+            web.get("/stats", self.handle_stats),
+            web.get("/metrics", self.handle_metrics),
+            web.get("/metrics.json", self.handle_metrics_json),
+            web.post("/search", self.handle_search),
+            web.post("/answer", self.handle_answer),
+            web.post("/answer/stream", self.handle_answer_stream),
+        ])
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+def build_local_pipeline(pages=5000, pdf_dir=None, embed_latency=0.0, llm_first_token_latency=0.0,
+                         llm_token_latency=0.0, embed_deadline=None, verbose=False):
+    """
+    RagPipeline over an in-memory index built with the offline stand-ins.
+    """
+    from bm25_index import BM25Index, tokenize
+    from vector_index import build_vector_index
+    from chunking import chunk_store
+    from hybrid_retriever import HybridRetriever
+    from answer_cache import AnswerCache
+    from context_packing import ContextPacker
+    from rag import RagPipeline
+    from local_backends import HashingEmbedder, LocalChatModel, synthetic_pages
+
+    if pdf_dir:
+        from ingestion import iter_ingested_documents
+        from local_backends import LocalBlobContainer, LocalOcr
+        from ocr_selection import OcrPolicy
+        docs = list(iter_ingested_documents(
+            LocalBlobContainer(pdf_dir), LocalOcr(), parse_workers=0, ocr_policy=OcrPolicy()
+        ))
+        docs.sort(key=lambda doc: (doc.metadata["source"], doc.metadata["page"]))
+    else:
+        docs = synthetic_pages(pages)
+    docs = chunk_store(docs)
+    embedder = HashingEmbedder(latency=embed_latency)
+    bm25 = BM25Index.build(tokenize(text) for text in docs.texts())
+    faiss_index, _ = build_vector_index(embedder.embed_documents(list(docs.texts())))
+    print(f"✅ Local index: {len(docs)} chunks")
+    retriever = HybridRetriever(docs, bm25, faiss_index, embedder, embed_deadline=embed_deadline)
+    llm = LocalChatModel(first_token_latency=llm_first_token_latency, token_latency=llm_token_latency)
+    return RagPipeline(
+        retriever, llm, answer_cache=AnswerCache(), context_packer=ContextPacker(bm25=bm25), verbose=verbose
+    )
+
+
+def build_azure_pipeline(verbose=False):
+    """
+    RagPipeline over the index snapshot, with the Azure clients of the main script.
+    """
+    import Hybrid_Search1_OpenSource as hybrid
+
+    embeddings_model = hybrid.build_embedding_service()
+    snapshot = hybrid.load_or_build_snapshot(embeddings_model)
+    return hybrid.build_rag_pipeline(snapshot, embeddings_model, verbose=verbose)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Async hybrid search / RAG server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-concurrency", type=int, default=64)
+    parser.add_argument("--max-pending", type=int, default=1024)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--search-workers", type=int, default=4)
+    parser.add_argument("--max-top-k", type=int, default=MAX_TOP_K, help="largest top_k a request may ask for")
+    parser.add_argument("--max-candidate-factor", type=int, default=MAX_CANDIDATE_FACTOR,
+                        help="largest candidate_factor a request may ask for")
+    parser.add_argument("--local", action="store_true", help="use offline stand-in backends")
+    parser.add_argument("--local-pages", type=int, default=5000, help="synthetic pages for --local")
+    parser.add_argument("--pdf-dir", help="with --local, ingest the PDFs in this directory instead")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="stand-in embedding latency (s)")
+    parser.add_argument("--embed-deadline-ms", type=float, default=0.0,
+                        help="with --local, BM25-only results past this query embedding time (0 = wait)")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="stand-in LLM first-token latency (s)")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="stand-in LLM per-token latency (s)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.local:
+        pipeline = build_local_pipeline(
+            pages=args.local_pages, pdf_dir=args.pdf_dir, embed_latency=args.embed_latency,
+            llm_first_token_latency=args.llm_latency, llm_token_latency=args.llm_token_latency,
+            embed_deadline=args.embed_deadline_ms / 1000 if args.embed_deadline_ms > 0 else None,
+        )
+    else:
+        pipeline = build_azure_pipeline()
+    server = RagServer(
+        pipeline,
+        max_concurrency=args.max_concurrency,
+        max_pending=args.max_pending,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        search_workers=args.search_workers,
+        max_top_k=args.max_top_k,
+        max_candidate_factor=args.max_candidate_factor,
+    )
+    print(f"🚀 Serving on http://{args.host}:{args.port}")
+    web.run_app(server.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
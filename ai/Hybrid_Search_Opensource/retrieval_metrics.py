@@ -0,0 +1,106 @@
+"""
+retrieval_metrics.py
+
+Vectorised retrieval quality metrics for a whole labeled query set.
+
+Takes the ranked doc ids of every query as one (Q, k) array (-1 = empty
+slot) and the graded relevance labels as padded (Q, L) arrays, and scores
+all queries in a handful of array operations. The metrics follow the
+definitions of azure.ai.evaluation.DocumentRetrievalEvaluator, so local
+tuning runs line up with the Azure evaluation:
+
+    ndcg@k      DCG of the ranking / DCG of the ideal ranking, gain 2^rel - 1
+    xdcg@k      0-100; relevance of the top k, discounted by 0.6 per rank
+    fidelity    share of the labeled gain (2^rel - 1) that was retrieved
+    recall@k    share of the relevant labeled docs that were retrieved
+    mrr         1 / rank of the first relevant doc (0 if none)
+    top1_relevance, top3_max_relevance, holes (share of retrieved docs
+                without a label)
+
+rel is the label minus label_min; a doc counts as relevant from
+relevant_label upwards. Unlabeled docs score label_min.
+"""
+
+import numpy as np
+
+
+XDCG_DISCOUNT = 0.6
+
+
+def label_arrays(labels):
+    """
+    (label_ids, label_values) padded to (Q, L) from per-query {doc_id: label} dicts.
+    """
+    width = max((len(query_labels) for query_labels in labels), default=0)
+    label_ids = np.full((len(labels), max(width, 1)), -1, dtype=np.int64)
+    label_values = np.zeros(label_ids.shape, dtype=np.float64)
+    for i, query_labels in enumerate(labels):
+        label_ids[i, :len(query_labels)] = list(query_labels.keys())
+        label_values[i, :len(query_labels)] = list(query_labels.values())
+    return label_ids, label_values
+
+
+def retrieved_labels(retrieved_ids, label_ids, label_values, label_min=0):
+    """
+    (Q, k) labels of the retrieved docs and a mask of which ones are labeled.
+    """
+    retrieved_ids = np.asarray(retrieved_ids, dtype=np.int64)
+    match = (retrieved_ids[:, :, None] == label_ids[:, None, :]) & (retrieved_ids[:, :, None] >= 0)
+    labeled = match.any(axis=2)
+    grades = np.where(match, label_values[:, None, :], -np.inf).max(axis=2, initial=-np.inf)
+    return np.where(labeled, grades, label_min), labeled
+
+
+def retrieval_metrics(retrieved_ids, label_ids, label_values, label_min=0, label_max=4, relevant_label=None):
+    """
+    {metric name: (Q,) array} for the ranked ids of every query.
+
+    Queries without any relevant label get NaN for ndcg, recall and
+    fidelity, so nanmean skips them.
+    """
+    retrieved_ids = np.asarray(retrieved_ids, dtype=np.int64)
+    k = retrieved_ids.shape[1]
+    relevant_label = label_min + 1 if relevant_label is None else relevant_label
+    grades, labeled = retrieved_labels(retrieved_ids, label_ids, label_values, label_min)
+    filled = retrieved_ids >= 0
+    rel = np.maximum(grades - label_min, 0.0)
+    label_rel = np.where(label_ids >= 0, np.maximum(label_values - label_min, 0.0), 0.0)
+
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    dcg = ((2.0 ** rel - 1.0) * discounts).sum(axis=1)
+    ideal = -np.sort(-label_rel, axis=1)[:, :k]
+    idcg = ((2.0 ** ideal - 1.0) * discounts[:ideal.shape[1]]).sum(axis=1)
+
+    xdcg_weights = XDCG_DISCOUNT ** np.arange(k)
+    xdcg = 100.0 * (rel / max(label_max - label_min, 1e-9) * xdcg_weights).sum(axis=1) / xdcg_weights.sum()
+
+    labeled_gain = (2.0 ** label_rel - 1.0).sum(axis=1)
+    retrieved_gain = (2.0 ** rel - 1.0).sum(axis=1)
+
+    relevant = (grades >= relevant_label) & labeled
+    n_relevant = ((label_values >= relevant_label) & (label_ids >= 0)).sum(axis=1)
+    first = np.argmax(relevant, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            f"ndcg@{k}": np.where(idcg > 0, dcg / idcg, np.nan),
+            f"xdcg@{k}": xdcg,
+            "fidelity": np.where(labeled_gain > 0, retrieved_gain / labeled_gain, np.nan),
+            f"recall@{k}": np.where(n_relevant > 0, relevant.sum(axis=1) / n_relevant, np.nan),
+            "mrr": np.where(relevant.any(axis=1), 1.0 / (first + 1), 0.0),
+            "top1_relevance": grades[:, 0] if k else np.zeros(len(grades)),
+            "top3_max_relevance": grades[:, :3].max(axis=1) if k else np.zeros(len(grades)),
+            "holes": np.where(filled.any(axis=1),
+                              (filled & ~labeled).sum(axis=1) / np.maximum(filled.sum(axis=1), 1), 0.0),
+        }
+
+
+def summarize(metrics):
+    """
+    Mean of every metric over the queries it is defined for.
+    """
+    summary = {}
+    for name, values in metrics.items():
+        defined = values[~np.isnan(values)]
+        summary[name] = round(float(defined.mean()), 4) if len(defined) else None
+    return summary
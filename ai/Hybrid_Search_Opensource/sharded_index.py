@@ -0,0 +1,524 @@
+"""
+sharded_index.py
+
+Hybrid index partitioned into shards, searched by worker processes (scatter-gather).
+
+Layout of a sharded snapshot directory:
+
+    shards.json          format, shard count, partitioning, embedding model, doc count
+    bm25_stats/          CollectionStats of the whole corpus (see bm25_index.py)
+    shard_000/ ...       one regular index snapshot per shard (index_snapshot.py)
+    blobs.json           per-blob fingerprints, written by delta_sync.py
+    delta_0001/ ...      shards appended by delta_sync.py, with *.deleted-*.npy
+                         tombstones (deleted row ids) for rows of older shards
+
+Rows are assigned to shards by source document (all chunks of a PDF stay
+together) or by hash of the row. Every shard's BM25 is built with the
+corpus-wide CollectionStats, so BM25 scores from different shards are the
+same numbers a single index would produce, and cosine similarities are
+comparable as they are. Merging the per-shard top-n lists therefore gives
+the global top-n, which is then fused once, with one normalisation over
+the merged lists, exactly as in HybridRetriever.
+
+Each shard is served by its own process (one core, one FAISS thread) that
+memory-maps only its own postings and vectors; the coordinator sends a batch
+of query vectors and tokens to every shard at once and gathers the results.
+Chunk text is read from the shards' memory-mapped DocStores on demand, so
+the coordinator holds no per-document data. Tombstoned rows are skipped
+inside the shard's searches (a FAISS ID selector and a BM25 live-row mask),
+so a query still gets n live candidates without fetching any extra.
+
+    build_sharded_snapshot("index_snapshot", docs, vectors, n_shards=4, embedding_model="...")
+    with ShardedIndex("index_snapshot") as index:
+        retriever = ShardedRetriever(index, embeddings_model)
+"""
+
+import os
+import json
+import time
+import uuid
+import zlib
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+import numpy as np
+
+from bm25_index import BM25Index, CollectionStats, tokenize
+from hybrid_retriever import HybridRetriever, empty_candidates, lexical_top_n
+from doc_store import DocStore
+from index_snapshot import load_snapshot, read_manifest, save_snapshot
+from metrics import metrics
+
+
+SHARDS_FILE = "shards.json"
+STATS_DIR = "bm25_stats"
+BLOBS_FILE = "blobs.json"
+# ShardSearcher methods a worker process answers
+SHARD_METHODS = ("search", "reconstruct")
+SHARDED_FORMAT_VERSION = 1
+PARTITIONS = ("source", "hash")
+
+
+def is_sharded(snapshot_dir):
+    return os.path.exists(os.path.join(snapshot_dir, SHARDS_FILE))
+
+
+def read_shards_manifest(snapshot_dir):
+    with open(os.path.join(snapshot_dir, SHARDS_FILE), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != SHARDED_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported sharded snapshot format {manifest.get('format_version')} "
+            f"(expected {SHARDED_FORMAT_VERSION})"
+        )
+    return manifest
+
+
+def current_snapshot_id(snapshot_dir):
+    """
+    snapshot_id of the (sharded or single) snapshot now on disk; changes with every build, sync and compaction.
+    """
+    if is_sharded(snapshot_dir):
+        return read_shards_manifest(snapshot_dir)["snapshot_id"]
+    manifest = read_manifest(snapshot_dir)
+    return manifest.get("snapshot_id", manifest["created_at"])
+
+
+def write_shards_manifest(snapshot_dir, manifest):
+    """
+    Replace shards.json atomically; readers see the old or the new shard list, never a mix.
+    """
+    path = os.path.join(snapshot_dir, SHARDS_FILE)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def shard_assignments(docs, n_shards, partition="source"):
+    """
+    Shard number of every row: by crc32 of the source name, or of source#page#chunk.
+    """
+    if partition not in PARTITIONS:
+        raise ValueError(f"partition must be one of {PARTITIONS}, not {partition!r}")
+    assignments = np.empty(len(docs), dtype=np.int32)
+    for i in range(len(docs)):
+        metadata = docs.metadata(i)
+        key = metadata["source"]
+        if partition == "hash":
+            key = f"{key}#{metadata['page']}#{metadata['chunk']}"
+        assignments[i] = zlib.crc32(key.encode("utf-8")) % n_shards
+    return assignments
+
+
+def build_sharded_snapshot(snapshot_dir, docs, vectors, n_shards, embedding_model, partition="source",
+                           embedding_deployment=None, vector_index_type="flat", blobs=None, **vector_params):
+    """
+    Partition a DocStore and its embeddings into n_shards shard snapshots under snapshot_dir.
+
+    Like save_snapshot, the directory is assembled next to the target and
+    swapped in at the end. `blobs` (delta_sync fingerprints) is stored with it.
+    """
+    from vector_index import build_vector_index
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) != len(docs):
+        raise ValueError(f"{len(vectors)} vectors for {len(docs)} docs")
+    snapshot_dir = os.path.abspath(snapshot_dir)
+    tmp_dir = f"{snapshot_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    with metrics.span("bm25_stats"):
+        stats = CollectionStats.build(tokenize(text) for text in docs.texts())
+    stats.save(os.path.join(tmp_dir, STATS_DIR))
+    assignments = shard_assignments(docs, n_shards, partition)
+    shards = []
+    for shard in range(n_shards):
+        rows = np.flatnonzero(assignments == shard)
+        if not len(rows):
+            continue
+        name = f"shard_{shard:03d}"
+        shard_docs = docs.take(rows)
+        with metrics.span("bm25_build"):
+            bm25 = BM25Index.build((tokenize(text) for text in shard_docs.texts()), stats=stats)
+        with metrics.span("vector_index_build"):
+            faiss_index, vector_config = build_vector_index(vectors[rows], vector_index_type, **vector_params)
+        save_snapshot(
+            os.path.join(tmp_dir, name), shard_docs, bm25, faiss_index, embedding_model,
+            embedding_deployment=embedding_deployment, vector_index_config=vector_config,
+        )
+        shards.append({"name": name, "doc_count": len(rows), "deleted": 0, "tombstones": None})
+
+    manifest = {
+        "format_version": SHARDED_FORMAT_VERSION,
+        "snapshot_id": uuid.uuid4().hex,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "embedding_model": embedding_model,
+        "embedding_deployment": embedding_deployment or embedding_model,
+        "embedding_dim": int(vectors.shape[1]),
+        "partition": partition,
+        "n_shards": n_shards,
+        "doc_count": len(docs),
+        "stats": STATS_DIR,
+        "vector_index": {"type": vector_index_type, **vector_params},
+        "shards": shards,
+    }
+    if blobs is not None:
+        with open(os.path.join(tmp_dir, BLOBS_FILE), "w", encoding="utf-8") as f:
+            json.dump(blobs, f)
+    write_shards_manifest(tmp_dir, manifest)
+
+    old_dir = f"{snapshot_dir}.old-{os.getpid()}"
+    if os.path.exists(snapshot_dir):
+        os.replace(snapshot_dir, old_dir)
+    os.replace(tmp_dir, snapshot_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"💾 Saved sharded index ({len(docs)} docs in {len(shards)} shards) to: {snapshot_dir}")
+    return manifest
+
+
+class ShardSearcher:
+    """
+    One shard's BM25 and FAISS index, searched in the current process.
+
+    `tombstones` is an .npy file of deleted row ids, which are never returned:
+    FAISS skips them through an ID selector and BM25 scoring through a
+    live-row mask, so a search costs the same however many rows are dead.
+    """
+
+    def __init__(self, shard_dir, nprobe=None, ef_search=None, tombstones=None):
+        from vector_index import exclude_selector
+
+        snapshot = load_snapshot(shard_dir, nprobe=nprobe, ef_search=ef_search)
+        self.bm25 = snapshot.bm25
+        self.faiss_index = snapshot.faiss_index
+        self.deleted = np.load(tombstones) if tombstones else np.zeros(0, dtype=np.int64)
+        self.live = None
+        self.selector = None
+        if len(self.deleted):
+            self.live = np.ones(self.bm25.corpus_size, dtype=bool)
+            self.live[self.deleted] = False
+            self.selector = exclude_selector(self.deleted)
+
+    def search(self, query_vectors, token_lists, n):
+        """
+        Shard-local (vec_ids, vec_scores, lex_ids, lex_scores), each (Q, n).
+
+        Either input may be None to search one side only (the other is empty).
+        """
+        from vector_index import search_similarities
+
+        n_queries = len(query_vectors) if query_vectors is not None else len(token_lists)
+        if query_vectors is not None:
+            vec_ids, vec_scores = search_similarities(self.faiss_index, query_vectors, n, selector=self.selector)
+        else:
+            vec_ids, vec_scores = empty_candidates(n_queries, n)
+        if token_lists is not None:
+            lex_ids, lex_scores, _ = lexical_top_n(self.bm25, token_lists, n, live=self.live)
+        else:
+            lex_ids, lex_scores = empty_candidates(n_queries, n)
+        return vec_ids, vec_scores, lex_ids, lex_scores
+
+    def reconstruct(self, ids):
+        """
+        Stored vectors of shard-local ids.
+        """
+        from vector_index import reconstruct_vectors
+
+        return reconstruct_vectors(self.faiss_index, ids)
+
+    def submit(self, query_vectors, token_lists, n):
+        return self.call("search", query_vectors, token_lists, n)
+
+    def call(self, method, *args):
+        future = Future()
+        try:
+            future.set_result(getattr(self, method)(*args))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+    def close(self):
+        pass
+
+
+def _serve_shard(shard_dir, conn, nprobe, ef_search, threads, tombstones):
+    # Worker process main loop: one request at a time, answered in order
+    import faiss
+
+    faiss.omp_set_num_threads(threads)
+    try:
+        searcher = ShardSearcher(shard_dir, nprobe=nprobe, ef_search=ef_search, tombstones=tombstones)
+    except Exception as ex:
+        conn.send((None, False, f"{type(ex).__name__}: {ex}"))
+        return
+    conn.send((None, True, None))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        request_id, method, args = message
+        try:
+            if method not in SHARD_METHODS:
+                raise ValueError(f"unknown shard method {method!r}")
+            conn.send((request_id, True, getattr(searcher, method)(*args)))
+        except Exception as ex:
+            conn.send((request_id, False, f"{type(ex).__name__}: {ex}"))
+
+
+class ShardProcess:
+    """
+    A shard served by a worker process; submit() / call() return Futures of ShardSearcher methods.
+
+    Requests are pipelined: several callers can have batches in flight, and a
+    reader thread resolves their futures as the worker answers.
+    """
+
+    def __init__(self, shard_dir, nprobe=None, ef_search=None, threads=1, tombstones=None, context=None):
+        context = context or multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_serve_shard, args=(shard_dir, child_conn, nprobe, ef_search, threads, tombstones), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        _, ok, error = self._conn.recv()
+        if not ok:
+            self.process.join()
+            raise RuntimeError(f"Shard {shard_dir} failed to load: {error}")
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read, name="shard-reader", daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                request_id, ok, payload = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._futures.pop(request_id)
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(RuntimeError(payload))
+        with self._lock:
+            futures, self._futures = list(self._futures.values()), {}
+        for future in futures:
+            future.set_exception(RuntimeError("shard worker exited"))
+
+    def submit(self, query_vectors, token_lists, n):
+        return self.call("search", query_vectors, token_lists, n)
+
+    def call(self, method, *args):
+        """
+        Future of ShardSearcher.<method>(*args) in the worker (one of SHARD_METHODS).
+        """
+        future = Future()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._futures[request_id] = future
+            self._conn.send((request_id, method, args))
+        return future
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+        self._conn.close()
+
+
+def merge_top_n(ids_list, scores_list, n):
+    """
+    Global top-n (ids, scores) from per-shard lists already mapped to global ids.
+    """
+    ids = np.concatenate(ids_list, axis=1)
+    scores = np.concatenate(scores_list, axis=1).astype(np.float64)
+    scores = np.where(ids >= 0, scores, -np.inf)
+    top = np.argsort(-scores, axis=1, kind="stable")[:, :n]
+    ids = np.take_along_axis(ids, top, axis=1)
+    scores = np.take_along_axis(scores, top, axis=1)
+    scores[ids < 0] = 0.0
+    return ids, scores
+
+
+class ShardedDocs:
+    """
+    Read-only concatenation of the shards' DocStores; row i of the index is row i here.
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.offsets = np.zeros(len(stores) + 1, dtype=np.int64)
+        np.cumsum([len(store) for store in stores], out=self.offsets[1:])
+
+    def _locate(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return self.stores[shard], i - int(self.offsets[shard])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        store, local = self._locate(i)
+        return store[local]
+
+    def __iter__(self):
+        for store in self.stores:
+            yield from store
+
+    def text(self, i):
+        store, local = self._locate(i)
+        return store.text(local)
+
+    def metadata(self, i):
+        store, local = self._locate(i)
+        return store.metadata(local)
+
+    def texts(self):
+        for store in self.stores:
+            yield from store.texts()
+
+
+class ShardedIndex:
+    """
+    Coordinator of a sharded snapshot: scatters query batches to the shards and merges their top-n lists.
+
+    `workers=False` searches the shards in this process, one after another
+    (same results, no parallelism); useful for tests and tiny corpora.
+    """
+
+    def __init__(self, snapshot_dir, expected_embedding_model=None, workers=True, nprobe=None, ef_search=None,
+                 threads_per_shard=1):
+        self.snapshot_dir = snapshot_dir
+        self.manifest = read_shards_manifest(snapshot_dir)
+        if expected_embedding_model and self.manifest["embedding_model"] != expected_embedding_model:
+            raise ValueError(
+                f"Snapshot was built with {self.manifest['embedding_model']}, not {expected_embedding_model}"
+            )
+        self.stats = CollectionStats.load(os.path.join(snapshot_dir, self.manifest.get("stats", STATS_DIR)))
+        shard_dirs = [os.path.join(snapshot_dir, shard["name"]) for shard in self.manifest["shards"]]
+        self.docs = ShardedDocs([DocStore.open(d, read_manifest(d)["sources"]) for d in shard_dirs])
+        self.offsets = self.docs.offsets
+        self.shards = []
+        try:
+            for shard, shard_dir in zip(self.manifest["shards"], shard_dirs):
+                tombstones = shard.get("tombstones")
+                tombstones = os.path.join(snapshot_dir, tombstones) if tombstones else None
+                if workers:
+                    self.shards.append(ShardProcess(
+                        shard_dir, nprobe, ef_search, threads=threads_per_shard, tombstones=tombstones
+                    ))
+                else:
+                    self.shards.append(ShardSearcher(shard_dir, nprobe=nprobe, ef_search=ef_search,
+                                                     tombstones=tombstones))
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def snapshot_id(self):
+        return self.manifest["snapshot_id"]
+
+    @property
+    def bm25(self):
+        # Corpus-wide term statistics, for ContextPacker idf weights
+        return self.stats
+
+    def candidates(self, query_vectors, token_lists, n):
+        """
+        Global top-n (vec_ids, vec_scores, lex_ids, lex_scores) per query, from every shard.
+
+        Either input may be None to search one side only (see ShardSearcher.search).
+        """
+        with metrics.span("shard_scatter_gather"):
+            futures = [shard.submit(query_vectors, token_lists, n) for shard in self.shards]
+            results = [future.result() for future in futures]
+        vec_ids, vec_scores, lex_ids, lex_scores = [], [], [], []
+        for offset, (v_ids, v_scores, l_ids, l_scores) in zip(self.offsets, results):
+            vec_ids.append(np.where(v_ids >= 0, v_ids + offset, -1))
+            vec_scores.append(v_scores)
+            lex_ids.append(np.where(l_ids >= 0, l_ids + offset, -1))
+            lex_scores.append(l_scores)
+        with metrics.span("shard_merge"):
+            vec_ids, vec_scores = merge_top_n(vec_ids, vec_scores, n)
+            lex_ids, lex_scores = merge_top_n(lex_ids, lex_scores, n)
+        return vec_ids, vec_scores, lex_ids, lex_scores
+
+    def reconstruct(self, ids):
+        """
+        Stored vectors of global row ids, gathered from the shards that hold them.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        shard_of = np.searchsorted(self.offsets, ids, side="right") - 1
+        futures = {}
+        for shard in np.unique(shard_of).tolist():
+            rows = np.flatnonzero(shard_of == shard)
+            futures[shard] = (rows, self.shards[shard].call("reconstruct", ids[rows] - self.offsets[shard]))
+        vectors = np.zeros((len(ids), self.manifest["embedding_dim"]), dtype=np.float32)
+        for rows, future in futures.values():
+            vectors[rows] = future.result()
+        return vectors
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardedRetriever(HybridRetriever):
+    """
+    HybridRetriever whose candidates come from a ShardedIndex; fusion is unchanged.
+    """
+
+    def __init__(self, index, embeddings_model, tokenizer=tokenize, embed_deadline=None):
+        super().__init__(index.docs, index.stats, None, embeddings_model, tokenizer=tokenizer,
+                         embed_deadline=embed_deadline)
+        self.index = index
+
+    def candidate_vectors(self, ids):
+        return self.index.reconstruct(ids)
+
+    def vector_candidates(self, query_vectors, n):
+        vec_ids, vec_scores, _, _ = self.index.candidates(query_vectors, None, n)
+        return vec_ids, vec_scores
+
+    def lexical_candidates(self, token_lists, n):
+        _, _, lex_ids, lex_scores = self.index.candidates(None, token_lists, n)
+        # BM25 scores are never negative (see BM25Index.top_n_batch)
+        return lex_ids, lex_scores, np.zeros(len(token_lists))
+
+    def candidates(self, queries, n, query_vectors=None):
+        if query_vectors is None or isinstance(query_vectors, Future):
+            # The shards score BM25 while the query embedding is in flight, then search vectors
+            return super().candidates(queries, n, query_vectors=query_vectors)
+        # Vectors at hand: both sides in one round trip
+        vec_ids, vec_scores, lex_ids, lex_scores = self.index.candidates(
+            query_vectors, [self.tokenizer(q) for q in queries], n
+        )
+        return vec_ids, vec_scores, lex_ids, lex_scores, np.zeros(len(queries))
@@ -0,0 +1,41 @@
+"""
+test_startup.py
+
+Import-time budget for the CLI and the query path (see `cli.py bench startup`).
+
+Both checks run in fresh interpreters, so they measure a cold start rather
+than this test process. STARTUP_BUDGET_MS raises the budget on slow runners.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import subprocess
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_MS = int(os.getenv("STARTUP_BUDGET_MS", "1000"))
+
+sys.path.insert(0, HERE)
+from cli import HEAVY_MODULES  # noqa: E402
+
+
+def test_check_startup_within_budget():
+    proc = subprocess.run(
+        [sys.executable, "cli.py", "bench", "startup", "--budget-ms", str(BUDGET_MS)],
+        cwd=HERE, capture_output=True, text=True, encoding="utf-8",
+    )
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+
+
+def test_query_help_loads_no_heavy_module():
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "cli.py", "query", "--help"],
+        cwd=HERE, capture_output=True, text=True, encoding="utf-8",
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    modules = {
+        line.split("|")[-1].strip().split(".")[0]
+        for line in proc.stderr.splitlines() if line.startswith("import time:") and "|" in line
+    }
+    assert not modules & set(HEAVY_MODULES)
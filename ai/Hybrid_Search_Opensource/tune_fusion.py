@@ -0,0 +1,202 @@
+"""
+tune_fusion.py
+
+Grid search over the hybrid search settings (fusion method, alpha,
+candidate_factor) against a labeled query set, scored locally with
+retrieval_metrics instead of one DocumentRetrievalEvaluator call per query.
+
+Candidates are retrieved once, at the largest candidate_factor: one batched
+embedding call, one FAISS search and one BM25 top-n pass for all queries.
+Every grid point then re-fuses those cached lists (a smaller
+candidate_factor is a prefix of the same ranked lists, up to the order of
+tied scores) and scores all queries at once, so the whole sweep costs a
+single retrieval pass.
+
+Labels are JSONL in the DocumentRetrievalEvaluator ground truth shape;
+document_id is a chunk's row id in the snapshot or "source#page#chunk":
+
+    {"query": "...", "relevance_labels": [{"document_id": 12, "query_relevance_label": 3}]}
+
+    python tune_fusion.py --labels labels.jsonl
+    python tune_fusion.py --local --alphas 0 0.25 0.5 0.75 1 --candidate-factors 1 2 4 8
+
+The best setting is printed as HYBRID_* environment variables for
+Hybrid_Search1_OpenSource.py.
+"""
+
+import json
+import time
+import argparse
+
+import numpy as np
+
+from bm25_index import tokenize
+from fusion import FUSION_METHODS, fuse
+from retrieval_metrics import label_arrays, retrieval_metrics, summarize
+
+
+def doc_key(doc):
+    return f"{doc.metadata['source']}#{doc.metadata['page']}#{doc.metadata.get('chunk', 0)}"
+
+
+def load_labeled_queries(path, docs):
+    """
+    (queries, labels) with labels as one {row id: label} dict per query.
+    """
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rows.append(json.loads(line))
+
+    keys = None
+    queries, labels = [], []
+    for row in rows:
+        query_labels = {}
+        for label in row["relevance_labels"]:
+            doc_id = label["document_id"]
+            if isinstance(doc_id, str) and not doc_id.isdigit():
+                if keys is None:
+                    keys = {doc_key(doc): i for i, doc in enumerate(docs)}
+                if doc_id not in keys:
+                    print(f"⚠️  Unknown document_id {doc_id!r}, skipping")
+                    continue
+                doc_id = keys[doc_id]
+            query_labels[int(doc_id)] = float(label["query_relevance_label"])
+        queries.append(row["query"])
+        labels.append(query_labels)
+    return queries, labels
+
+
+def synthetic_labeled_queries(docs, n_queries, seed=0):
+    """
+    3-5 word queries drawn from random chunks; the source chunk is labeled 4
+    and the other chunks of its page 2.
+    """
+    rng = np.random.default_rng(seed)
+    by_page = {}
+    for i, doc in enumerate(docs):
+        by_page.setdefault((doc.metadata["source"], doc.metadata["page"]), []).append(i)
+    queries, labels = [], []
+    for i in rng.integers(0, len(docs), n_queries):
+        words = tokenize(docs[i].page_content)
+        picks = rng.choice(len(words), size=min(int(rng.integers(3, 6)), len(words)), replace=False)
+        queries.append(" ".join(words[j] for j in picks))
+        page = by_page[(docs[i].metadata["source"], docs[i].metadata["page"])]
+        labels.append({**{j: 2.0 for j in page}, int(i): 4.0})
+    return queries, labels
+
+
+def collect_candidates(retriever, queries, n):
+    """
+    Top-n vector and BM25 candidate lists of every query, retrieved once.
+    """
+    vec_ids, vec_scores, lex_ids, lex_scores, lex_floors = retriever.candidates(queries, n)
+    return {
+        "vec_ids": vec_ids, "vec_scores": vec_scores,
+        "lex_ids": lex_ids, "lex_scores": lex_scores, "lex_floors": lex_floors,
+    }
+
+
+def sweep(candidates, label_ids, label_values, top_k, fusions, alphas, candidate_factors, **metric_params):
+    """
+    One {fusion, alpha, candidate_factor, <metric means>} row per grid point.
+    """
+    results = []
+    for fusion in fusions:
+        params = {"lex_floor": candidates["lex_floors"]} if fusion == "minmax" else {}
+        for candidate_factor in candidate_factors:
+            n = top_k * candidate_factor
+            for alpha in alphas:
+                ids, _ = fuse(
+                    candidates["vec_ids"][:, :n], candidates["vec_scores"][:, :n],
+                    candidates["lex_ids"][:, :n], candidates["lex_scores"][:, :n],
+                    top_k, method=fusion, alpha=alpha, **params,
+                )
+                scores = summarize(retrieval_metrics(ids, label_ids, label_values, **metric_params))
+                results.append({"fusion": fusion, "alpha": alpha, "candidate_factor": candidate_factor, **scores})
+    return results
+
+
+def build_local_retriever(pages, seed=0):
+    from bm25_index import BM25Index
+    from chunking import chunk_store
+    from hybrid_retriever import HybridRetriever
+    from local_backends import HashingEmbedder, synthetic_pages
+    from vector_index import build_vector_index
+
+    docs = chunk_store(synthetic_pages(pages, seed=seed))
+    embedder = HashingEmbedder()
+    bm25 = BM25Index.build(tokenize(text) for text in docs.texts())
+    faiss_index, _ = build_vector_index(embedder.embed_documents(list(docs.texts())))
+    print(f"✅ Local index: {len(docs)} chunks")
+    return HybridRetriever(docs, bm25, faiss_index, embedder)
+
+
+def build_snapshot_retriever():
+    import Hybrid_Search1_OpenSource as hybrid
+
+    embeddings_model = hybrid.build_embedding_service()
+    snapshot = hybrid.load_or_build_snapshot(embeddings_model)
+    return hybrid.build_retriever(snapshot, embeddings_model)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep hybrid fusion settings against labeled queries")
+    parser.add_argument("--labels", help="JSONL of queries with relevance labels")
+    parser.add_argument("--local", action="store_true", help="synthetic corpus and queries (offline)")
+    parser.add_argument("--local-pages", type=int, default=2000)
+    parser.add_argument("--local-queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--fusions", nargs="+", default=sorted(FUSION_METHODS), choices=sorted(FUSION_METHODS))
+    parser.add_argument("--alphas", type=float, nargs="+", default=[round(a, 2) for a in np.linspace(0, 1, 11)])
+    parser.add_argument("--candidate-factors", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--label-min", type=float, default=0)
+    parser.add_argument("--label-max", type=float, default=4)
+    parser.add_argument("--objective", help="metric to rank settings by (default ndcg@<top-k>)")
+    parser.add_argument("--show", type=int, default=10, help="number of best settings to print")
+    parser.add_argument("--json", help="write every grid point to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.local:
+        retriever = build_local_retriever(args.local_pages)
+        queries, labels = synthetic_labeled_queries(retriever.docs, args.local_queries)
+    elif args.labels:
+        retriever = build_snapshot_retriever()
+        queries, labels = load_labeled_queries(args.labels, retriever.docs)
+    else:
+        raise SystemExit("Pass --labels <file.jsonl> or --local")
+
+    start = time.perf_counter()
+    candidates = collect_candidates(retriever, queries, args.top_k * max(args.candidate_factors))
+    retrieval_seconds = time.perf_counter() - start
+    label_ids, label_values = label_arrays(labels)
+    start = time.perf_counter()
+    results = sweep(
+        candidates, label_ids, label_values, args.top_k, args.fusions, args.alphas, args.candidate_factors,
+        label_min=args.label_min, label_max=args.label_max,
+    )
+    sweep_seconds = time.perf_counter() - start
+    print(f"⏱️  {len(queries)} queries: retrieval {retrieval_seconds:.2f}s, "
+          f"{len(results)} settings scored in {sweep_seconds:.2f}s")
+
+    objective = args.objective or f"ndcg@{args.top_k}"
+    results.sort(key=lambda row: -np.inf if row.get(objective) is None else row[objective], reverse=True)
+    for row in results[:args.show]:
+        print("  " + "  ".join(f"{k}={v}" for k, v in row.items()))
+    best = results[0]
+    print(f"🏆 Best by {objective}: HYBRID_FUSION={best['fusion']} HYBRID_ALPHA={best['alpha']} "
+          f"HYBRID_CANDIDATE_FACTOR={best['candidate_factor']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"queries": len(queries), "objective": objective, "results": results}, f, indent=2)
+        print(f"💾 Wrote results to: {args.json}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+vector_index.py
+
+Configurable FAISS vector index for the semantic side of hybrid search.
+
+All index types use inner product over L2-normalised vectors, so the
+semantic score is cosine similarity. Types:
+
+    flat   exact search (IndexFlatIP), the recall baseline
+    hnsw   graph index; tune with ef_search
+    ivf    inverted lists of full vectors; tune with nprobe
+    ivfpq  inverted lists of product-quantised codes (m bytes per vector)
+    ivfsq  inverted lists of 8-bit scalar-quantised vectors (d bytes per vector)
+
+IVF types are trained on (a sample of) the vectors before they are added.
+"""
+
+import threading
+
+import numpy as np
+import faiss
+
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq", "ivfsq")
+DEFAULT_PARAMS = {
+    "hnsw_m": 32,
+    "ef_construction": 200,
+    "ef_search": 64,
+    "nlist": None,        # default: ~4 * sqrt(n)
+    "nprobe": 16,
+    "pq_m": 64,           # sub-quantizers; must divide the dimension
+    "pq_nbits": 8,
+    "max_train_points": 100_000,
+}
+
+
+def normalize(vectors):
+    """
+    Float32, C-contiguous, L2-normalised copy of vectors.
+    """
+    vectors = np.array(vectors, dtype=np.float32, order="C", copy=True)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _factory_string(index_type, dim, n_vectors, params):
+    nlist = params["nlist"] or max(1, min(int(4 * np.sqrt(max(n_vectors, 1))), n_vectors // 39 or 1))
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{params['hnsw_m']},Flat"
+    if index_type == "ivf":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivfpq":
+        if dim % params["pq_m"]:
+            raise ValueError(f"pq_m={params['pq_m']} must divide the embedding dimension {dim}")
+        return f"IVF{nlist},PQ{params['pq_m']}x{params['pq_nbits']}"
+    if index_type == "ivfsq":
+        return f"IVF{nlist},SQ8"
+    raise ValueError(f"Unknown vector index type {index_type!r}; choose from {INDEX_TYPES}")
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """
+    Apply query-time knobs; settings that do not apply to the index are ignored.
+    """
+    if nprobe is not None:
+        try:
+            faiss.extract_index_ivf(index).nprobe = int(nprobe)
+        except RuntimeError:
+            pass
+    if ef_search is not None and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = int(ef_search)
+
+
+def build_vector_index(vectors, index_type="flat", **params):
+    """
+    Build, train and fill an inner-product index over normalised vectors.
+
+    Returns (index, config) where config records the type and parameters,
+    for the snapshot manifest and set_search_params at load time.
+    """
+    params = {**DEFAULT_PARAMS, **{k: v for k, v in params.items() if v is not None}}
+    vectors = normalize(vectors)
+    n_vectors, dim = vectors.shape
+    factory = _factory_string(index_type, dim, n_vectors, params)
+    index = faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT)
+
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = params["ef_construction"]
+    if not index.is_trained:
+        train = vectors
+        if n_vectors > params["max_train_points"]:
+            sample = np.random.default_rng(0).choice(n_vectors, params["max_train_points"], replace=False)
+            train = vectors[np.sort(sample)]
+        index.train(train)
+    index.add(vectors)
+
+    config = {
+        "type": index_type,
+        "factory": factory,
+        "metric": "inner_product",
+        "nprobe": params["nprobe"],
+        "ef_search": params["ef_search"],
+    }
+    set_search_params(index, nprobe=config["nprobe"], ef_search=config["ef_search"])
+    return index, config
+
+
+_direct_map_lock = threading.Lock()
+
+
+def reconstruct_vectors(index, ids):
+    """
+    Stored vectors of the given ids, one row each (approximate for PQ / SQ codes).
+
+    IVF indexes get a direct id -> list map on first use.
+    """
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        with _direct_map_lock:
+            if ivf.direct_map.type == faiss.DirectMap.NoMap:
+                ivf.make_direct_map()
+    if not len(ids):
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_batch(ids)
+
+
+def index_memory_bytes(index):
+    """
+    Serialised size of the index, a close proxy for its resident memory.
+    """
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def exclude_selector(ids):
+    """
+    FAISS selector that skips the given ids (for search_similarities).
+    """
+    return faiss.IDSelectorNot(faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype=np.int64)))
+
+
+def _search_parameters(index, selector):
+    # Per-call parameters replace the index's own, so carry its nprobe / efSearch over
+    if hasattr(index, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return faiss.SearchParameters(sel=selector)
+    return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+
+
+def search_similarities(index, query_vectors, k, selector=None):
+    """
+    (ids, similarities) for the k nearest vectors; -1 ids for empty slots.
+
+    Every index is inner product over normalised vectors (build_vector_index),
+    so the scores are cosine similarities. With a `selector`
+    (exclude_selector), filtered-out ids are skipped inside the search.
+    """
+    params = _search_parameters(index, selector) if selector is not None else None
+    similarities, ids = index.search(normalize(query_vectors), k, params=params)
+    return ids, similarities
@@ -0,0 +1,434 @@
+"""
+batch_evaluation.py
+
+Dataset-driven version of Evaluators-1.py for regression runs over many queries.
+
+Every case in the dataset is retrieved, answered and judged like the single
+query in Evaluators-1.py, but cases run concurrently: blocking Azure calls go
+to a thread pool, at most --concurrency at a time, and LLM calls (answers and
+judges) are spaced by a shared --rps rate limit. The judges of one case run in
+parallel instead of one after another.
+
+Judge outputs are cached in SQLite keyed on (judge version, query, context,
+response, ground truth), so a case whose retrieval and answer did not change is
+never re-judged. Answers are cached the same way on (model, prompt), so an
+unchanged retrieval also skips generation (--fresh-answers regenerates).
+Set JUDGE_VERSION to force every case to be judged again.
+
+Dataset (JSONL), one case per line; ground_truth and relevance_labels are optional:
+
+    {"id": "q1", "query": "...", "ground_truth": "...",
+     "relevance_labels": [{"document_id": "<chunk id>", "query_relevance_label": 4}]}
+
+    python batch_evaluation.py --dataset eval_set.jsonl --output results.parquet
+
+One row per case goes to --output (Parquet, or CSV for a .csv path) and the
+aggregate scores to <output>.summary.json.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Masked credentials: Set these as environment variables for security
+AZURE_SEARCH_SERVICE = os.environ.get("AZURE_SEARCH_SERVICE")
+AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX", "multimodal-rag-1755860404874")
+AZURE_OPENAI_ACCOUNT = os.environ.get("AZURE_OPENAI_ACCOUNT")
+AZURE_DEPLOYMENT_MODEL = os.environ.get("AZURE_DEPLOYMENT_MODEL", "gpt-4o")
+AZURE_OPENAI_API_KEY = os.environ.get("AZURE_OPENAI_API_KEY")
+AZURE_SEARCH_KEY = os.environ.get("AZURE_SEARCH_KEY")
+AZURE_OPENAI_API_VERSION = "2024-06-01"
+
+# Bump to invalidate every cached judge result (e.g. after a prompt change)
+JUDGE_VERSION = os.environ.get("JUDGE_VERSION", "1")
+
+GROUNDED_PROMPT = """
+You are a friendly assistant that answers technical queries about masked business processes.
+Answer the query using only the sources provided below in a friendly and concise bulleted manner.
+Answer ONLY with the facts listed in the list of sources below.
+If there isn't enough information below, say you don't know.
+Do not generate answers that don't use the sources below.
+Query: {query}
+Sources:
+{sources}
+"""
+
+SOURCE_FIELDS = ["id", "document_name", "chunk_index", "chunk_type", "word_count", "character_count", "content"]
+
+RETRIEVAL_THRESHOLDS = {
+    "ground_truth_label_min": 0,
+    "ground_truth_label_max": 4,
+    "ndcg_threshold": 0.3,
+    "xdcg_threshold": 30.0,
+    "fidelity_threshold": 0.3,
+    "top1_relevance_threshold": 2,
+    "top3_max_relevance_threshold": 3,
+    "total_retrieved_documents_threshold": 5,
+    "total_ground_truth_documents_threshold": 5,
+}
+
+
+def format_source(x):
+    return (
+        f"ID: {x['id']}, Document: MASKED_DOCUMENT, Chunk: {x['chunk_index']}, Type: {x['chunk_type']}, "
+        f"Words: {x['word_count']}, Chars: {x['character_count']}, Content: {x['content']}"
+    )
+
+
+def load_cases(path):
+    """
+    Cases from a JSONL file; a missing id becomes the line number.
+    """
+    cases = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            case = json.loads(line)
+            if not case.get("query"):
+                raise ValueError(f"{path}:{line_no}: case has no query")
+            case.setdefault("id", str(line_no))
+            cases.append(case)
+    return cases
+
+
+class JudgeCache:
+    """
+    SQLite store of judge (and answer) outputs keyed on a hash of their inputs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(name, version, **inputs):
+        payload = json.dumps([name, version, inputs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, json.dumps(value), time.time())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RateLimiter:
+    """
+    Spaces acquire() calls at least 1/rate seconds apart (rate <= 0 disables it).
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class Judge:
+    """
+    One LLM-judged evaluator plus the case fields it takes as arguments.
+
+    inputs maps evaluator argument -> case field (query, context, response,
+    ground_truth); the judge is skipped for cases missing any of them.
+    """
+
+    def __init__(self, name, evaluator, inputs, version):
+        self.name = name
+        self.evaluator = evaluator
+        self.inputs = inputs
+        self.version = version
+
+    def arguments(self, fields):
+        if any(not fields.get(field) for field in self.inputs.values()):
+            return None
+        return {arg: fields[field] for arg, field in self.inputs.items()}
+
+
+class BatchEvaluator:
+    """
+    Retrieves, answers and judges dataset cases concurrently.
+    """
+
+    def __init__(self, search_client, openai_client, judges, cache, retrieval_evaluator=None,
+                 deployment=AZURE_DEPLOYMENT_MODEL, top=5, concurrency=8, requests_per_second=5.0,
+                 fresh_answers=False):
+        self.search_client = search_client
+        self.openai_client = openai_client
+        self.judges = judges
+        self.cache = cache
+        self.retrieval_evaluator = retrieval_evaluator
+        self.deployment = deployment
+        self.top = top
+        self.fresh_answers = fresh_answers
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._llm_rate = RateLimiter(requests_per_second)
+
+    async def _call(self, fn, *args, rate_limited=False, **kwargs):
+        async with self._slots:
+            if rate_limited:
+                await self._llm_rate.acquire()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def retrieve(self, query):
+        """
+        Up to `top` unique chunks that carry every source field, in result order.
+        """
+        unique_chunks = {}
+        for x in self.search_client.search(search_text=query, top=self.top):
+            if all(k in x for k in SOURCE_FIELDS) and x["id"] not in unique_chunks:
+                unique_chunks[x["id"]] = x
+                if len(unique_chunks) == self.top:
+                    break
+        return list(unique_chunks.values())
+
+    def generate(self, prompt):
+        completion = self.openai_client.chat.completions.create(
+            model=self.deployment,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt},
+            ],
+            max_tokens=512,
+            temperature=0.2,
+        )
+        return completion.choices[0].message.content
+
+    async def _answer(self, prompt):
+        key = JudgeCache.key("answer", self.deployment, prompt=prompt)
+        if not self.fresh_answers:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached, True
+        response = await self._call(self.generate, prompt, rate_limited=True)
+        self.cache.put(key, response)
+        return response, False
+
+    async def _judge(self, judge, fields):
+        arguments = judge.arguments(fields)
+        if arguments is None:
+            return {}
+        key = JudgeCache.key(judge.name, judge.version, **arguments)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return {**cached, f"{judge.name}_cached": True}
+        try:
+            result = await self._call(judge.evaluator, rate_limited=True, **arguments)
+        except Exception as exc:
+            return {f"{judge.name}_error": f"{type(exc).__name__}: {exc}"}
+        self.cache.put(key, result)
+        return {**result, f"{judge.name}_cached": False}
+
+    def _retrieval_scores(self, case, chunks):
+        if self.retrieval_evaluator is None or not case.get("relevance_labels"):
+            return {}
+        retrieved = [
+            {"document_id": str(x["id"]), "relevance_score": float(x.get("@search.score") or 0.0)}
+            for x in chunks
+        ]
+        return self.retrieval_evaluator(retrieval_ground_truth=case["relevance_labels"], retrieved_documents=retrieved)
+
+    async def evaluate_case(self, case):
+        start = time.perf_counter()
+        row = {"id": case["id"], "query": case["query"]}
+        try:
+            chunks = await self._call(self.retrieve, case["query"])
+            context = "\n".join(format_source(x) for x in chunks)
+            response, answer_cached = await self._answer(GROUNDED_PROMPT.format(query=case["query"], sources=context))
+        except Exception as exc:
+            row["error"] = f"{type(exc).__name__}: {exc}"
+            row["seconds"] = round(time.perf_counter() - start, 3)
+            return row
+
+        fields = {
+            "query": case["query"],
+            "context": context,
+            "response": response,
+            "ground_truth": case.get("ground_truth"),
+        }
+        judged = await asyncio.gather(*(self._judge(judge, fields) for judge in self.judges))
+        row.update({
+            "retrieved_ids": json.dumps([x["id"] for x in chunks]),
+            "response": response,
+            "answer_cached": answer_cached,
+        })
+        row.update(self._retrieval_scores(case, chunks))
+        for result in judged:
+            row.update(result)
+        row["seconds"] = round(time.perf_counter() - start, 3)
+        return row
+
+    async def run(self, cases):
+        rows = []
+        done = 0
+        for next_row in asyncio.as_completed([self.evaluate_case(case) for case in cases]):
+            rows.append(await next_row)
+            done += 1
+            if done % 50 == 0 or done == len(cases):
+                print(f"✅ Evaluated {done}/{len(cases)} cases (judge cache hits: {self.cache.hits})")
+        order = {case["id"]: i for i, case in enumerate(cases)}
+        rows.sort(key=lambda row: order[row["id"]])
+        return rows
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def summarize(df):
+    """
+    Means of numeric score columns and pass rates of *_result columns.
+    """
+    summary = {"cases": int(len(df))}
+    if "error" in df:
+        summary["errors"] = int(df["error"].notna().sum())
+    for column in df.columns:
+        values = df[column].dropna()
+        if not len(values):
+            continue
+        if column.endswith("_result"):
+            summary[f"{column[:-len('_result')]}_pass_rate"] = round(float((values == "pass").mean()), 4)
+        elif column.endswith("_cached"):
+            summary[f"{column}_rate"] = round(float(values.astype(bool).mean()), 4)
+        elif df[column].dtype.kind in "if" and not column.endswith("_threshold"):
+            summary[f"{column}_mean"] = round(float(values.mean()), 4)
+    return summary
+
+
+def write_results(rows, path):
+    import pandas as pd
+
+    df = pd.DataFrame(rows)
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False)
+    else:
+        df.to_parquet(path, index=False)
+    summary = summarize(df)
+    with open(f"{os.path.splitext(path)[0]}.summary.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def build_azure_evaluator(args, cache):
+    if not all([AZURE_SEARCH_SERVICE, AZURE_OPENAI_ACCOUNT, AZURE_OPENAI_API_KEY, AZURE_SEARCH_KEY]):
+        raise ValueError("Please set all required Azure credentials as environment variables.")
+
+    from importlib.metadata import version
+    from azure.search.documents import SearchClient
+    from azure.core.credentials import AzureKeyCredential
+    from azure.ai.evaluation import (
+        DocumentRetrievalEvaluator, GroundednessEvaluator, ResponseCompletenessEvaluator
+    )
+    from openai import AzureOpenAI
+
+    openai_client = AzureOpenAI(
+        api_key=AZURE_OPENAI_API_KEY,
+        api_version=AZURE_OPENAI_API_VERSION,
+        azure_endpoint=AZURE_OPENAI_ACCOUNT,
+    )
+    search_client = SearchClient(
+        endpoint=AZURE_SEARCH_SERVICE,
+        index_name=AZURE_SEARCH_INDEX,
+        credential=AzureKeyCredential(AZURE_SEARCH_KEY),
+    )
+    model_config = {
+        "azure_endpoint": AZURE_OPENAI_ACCOUNT,
+        "azure_deployment": AZURE_DEPLOYMENT_MODEL,
+        "api_key": AZURE_OPENAI_API_KEY,
+        "api_version": AZURE_OPENAI_API_VERSION,
+    }
+    # A new SDK, judge model or threshold changes the version, so old results are not reused
+    base_version = f"{version('azure-ai-evaluation')}/{AZURE_DEPLOYMENT_MODEL}/{JUDGE_VERSION}"
+    judges = [
+        Judge(
+            "groundedness",
+            GroundednessEvaluator(model_config=model_config, threshold=4),
+            {"query": "query", "context": "context", "response": "response"},
+            f"{base_version}/threshold=4",
+        ),
+        Judge(
+            "response_completeness",
+            ResponseCompletenessEvaluator(model_config=model_config, threshold=2),
+            {"response": "response", "ground_truth": "ground_truth"},
+            f"{base_version}/threshold=2",
+        ),
+    ]
+    return BatchEvaluator(
+        search_client,
+        openai_client,
+        judges,
+        cache,
+        retrieval_evaluator=DocumentRetrievalEvaluator(**RETRIEVAL_THRESHOLDS),
+        top=args.top,
+        concurrency=args.concurrency,
+        requests_per_second=args.rps,
+        fresh_answers=args.fresh_answers,
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch RAG evaluation over a JSONL dataset")
+    parser.add_argument("--dataset", required=True, help="JSONL file of evaluation cases")
+    parser.add_argument("--output", default="eval_results.parquet", help=".parquet or .csv results file")
+    parser.add_argument("--cache", default="judge_cache.sqlite", help="SQLite file for cached judge outputs")
+    parser.add_argument("--concurrency", type=int, default=8, help="Azure calls in flight at once")
+    parser.add_argument("--rps", type=float, default=5.0, help="max LLM requests per second (0 = unlimited)")
+    parser.add_argument("--top", type=int, default=5, help="chunks retrieved per query")
+    parser.add_argument("--limit", type=int, help="evaluate only the first N cases")
+    parser.add_argument("--fresh-answers", action="store_true", help="regenerate answers instead of reusing them")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cases = load_cases(args.dataset)[:args.limit]
+    cache = JudgeCache(args.cache)
+    evaluator = build_azure_evaluator(args, cache)
+    start = time.perf_counter()
+    try:
+        rows = asyncio.run(evaluator.run(cases))
+    finally:
+        evaluator.close()
+        cache.close()
+    summary = write_results(rows, args.output)
+    print(f"⏱️  {len(cases)} cases in {time.perf_counter() - start:.1f}s")
+    print(f"💾 Wrote results to: {args.output}")
+    print("📊 Summary:", json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
 import os
+import asyncio
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from azure.search.documents import SearchClient
 from openai import AzureOpenAI
-from azure.core.credentials import AzureKeyCredential
+from async_search import LexicalSearch, format_source
 
 # Masked credentials and endpoints
 AZURE_SEARCH_SERVICE = os.getenv("AZURE_SEARCH_SERVICE", "<YOUR_AZURE_SEARCH_SERVICE_ENDPOINT>")
@@ -10,6 +10,7 @@ AZURE_OPENAI_ACCOUNT = os.getenv("AZURE_OPENAI_ACCOUNT", "<YOUR_AZURE_OPENAI_ACC
 AZURE_DEPLOYMENT_MODEL = os.getenv("AZURE_DEPLOYMENT_MODEL", "gpt-4o")
 AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY", "<YOUR_AZURE_SEARCH_KEY>")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "<YOUR_OPENAI_API_KEY>")
+AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "multimodal-rag-1755860404874")
 
 # Set up credentials and clients for standard Azure cloud
 credential = DefaultAzureCredential()
@@ -22,11 +23,11 @@ openai_client = AzureOpenAI(
     # azure_ad_token_provider=token_provider
 )
 
-search_client = SearchClient(
+# Pooled async search client; fetches only the fields used below
+search = LexicalSearch(
     endpoint=AZURE_SEARCH_SERVICE,
-    index_name="multimodal-rag-1755860404874",
-    # credential=credential,
-    credential=AzureKeyCredential(AZURE_SEARCH_KEY)  # Masked
+    index_name=AZURE_SEARCH_INDEX,
+    key=AZURE_SEARCH_KEY,  # Masked
 )
 
 GROUNDED_PROMPT = """
@@ -42,16 +43,15 @@ Sources:
 """
 
 query = "What is the process for authenticating with the Listener Messenger API?"
-search_results = search_client.search(
-    search_text=query,  # plain keyword match
-    top=5  # get top 5 results
-)
-# Collect unique chunk IDs and filter sources to only unique chunks (up to top=5)
-unique_chunks = {}
-for x in search_results:
-    if all(k in x for k in ['id','document_name','chunk_index','chunk_type','word_count','character_count','content']):
-        if x['id'] not in unique_chunks and len(unique_chunks) < 5:
-            unique_chunks[x['id']] = x
+
+
+async def retrieve(queries):
+    # Plain keyword match, top 5 unique chunks per query; queries run concurrently
+    async with search:
+        return await search.search_many(queries, top=5)
+
+
+unique_chunks = {x['id']: x for x in asyncio.run(retrieve([query]))[0]}
 
 unique_chunk_ids = list(unique_chunks.keys())
 print("Unique chunk IDs:", unique_chunk_ids)
@@ -59,16 +59,10 @@ print("Number of unique chunk IDs:", len(unique_chunk_ids))
 
 # Print only unique, up-to-5 results from unique_chunks.values()
 for x in unique_chunks.values():
-    print(
-        f"ID: {x['id']}, Document: {x['document_name']}, Chunk: {x['chunk_index']}, "
-        f"Type: {x['chunk_type']}, Words: {x['word_count']}, Chars: {x['character_count']}, Content: {x['content']}"
-    )
+    print(format_source(x))
 
 # Print only unique, up-to-5 results
-sources_formatted_unique = "\n".join([
-    f"ID: {x['id']}, Document: {x['document_name']}, Chunk: {x['chunk_index']}, Type: {x['chunk_type']}, Words: {x['word_count']}, Chars: {x['character_count']}, Content: {x['content']}"
-    for x in unique_chunks.values()
-])
+sources_formatted_unique = "\n".join(format_source(x) for x in unique_chunks.values())
 
 print("Sources used (unique):")
-print(sources_formatted_unique)
\ No newline at end of file
+print(sources_formatted_unique)
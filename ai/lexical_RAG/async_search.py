@@ -0,0 +1,119 @@
+"""
+async_search.py
+
+Reusable async keyword search over the Azure AI Search index used by Lexical(RAG).py.
+
+One azure.search.documents.aio.SearchClient is shared by every query and
+sends its requests over a single pooled aiohttp session, so repeated and
+concurrent queries reuse open HTTPS connections. Requests `select` only the
+fields the prompt needs, and results are de-duplicated by chunk id while
+they stream in.
+
+    async with LexicalSearch(endpoint, index_name, key) as search:
+        chunks = await search.search("How do I authenticate?")
+        batch = await search.search_many(queries)     # concurrent fan-out
+
+The endpoint may be plain http, e.g. local_search_service.py for offline runs.
+"""
+
+import time
+import asyncio
+
+import aiohttp
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.search.documents.aio import SearchClient
+
+
+# Fields used to build the prompt sources; nothing else is transferred
+SOURCE_FIELDS = ["id", "document_name", "chunk_index", "chunk_type", "word_count", "character_count", "content"]
+
+
+def format_source(x):
+    return (
+        f"ID: {x['id']}, Document: {x['document_name']}, Chunk: {x['chunk_index']}, Type: {x['chunk_type']}, "
+        f"Words: {x['word_count']}, Chars: {x['character_count']}, Content: {x['content']}"
+    )
+
+
+class LexicalSearch:
+    """
+    Pooled async SearchClient returning unique, field-projected chunks.
+    """
+
+    def __init__(self, endpoint, index_name, key, fields=SOURCE_FIELDS, max_connections=32,
+                 max_concurrency=16, timeout=30):
+        self.endpoint = endpoint
+        self.index_name = index_name
+        self.key = key
+        self.fields = list(fields)
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.latencies = []
+        self._session = None
+        self._client = None
+        self._slots = None
+
+    async def open(self):
+        if self._client is not None:
+            return self
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self._client = SearchClient(
+            endpoint=self.endpoint,
+            index_name=self.index_name,
+            credential=AzureKeyCredential(self.key),
+            transport=AioHttpTransport(session=self._session, session_owner=False),
+        )
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            await self._session.close()
+            self._client = self._session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def search(self, query, top=5, **search_params):
+        """
+        Up to `top` unique chunks for query, best first, with every source field set.
+        """
+        await self.open()
+        async with self._slots:
+            start = time.perf_counter()
+            results = await self._client.search(search_text=query, top=top, select=self.fields, **search_params)
+            unique_chunks = {}
+            async for x in results:
+                if x.get("id") in unique_chunks or any(x.get(k) is None for k in self.fields):
+                    continue
+                unique_chunks[x["id"]] = x
+                if len(unique_chunks) == top:
+                    break
+            self.latencies.append(time.perf_counter() - start)
+        return list(unique_chunks.values())
+
+    async def search_many(self, queries, top=5, **search_params):
+        """
+        search() for every query concurrently (at most max_concurrency in flight), in input order.
+        """
+        return await asyncio.gather(*(self.search(query, top=top, **search_params) for query in queries))
+
+
+def search_batch(endpoint, index_name, key, queries, top=5, **options):
+    """
+    Blocking helper: unique chunks for every query, searched concurrently.
+    """
+    async def run():
+        async with LexicalSearch(endpoint, index_name, key, **options) as search:
+            return await search.search_many(queries, top=top)
+
+    return asyncio.run(run())
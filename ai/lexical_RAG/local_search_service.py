@@ -0,0 +1,103 @@
+"""
+local_search_service.py
+
+Local HTTP stand-in for the Azure AI Search query endpoint, for running
+async_search.py and Lexical(RAG).py without a search service.
+
+Serves POST /indexes('<index>')/docs/search.post.search as the SDK calls
+it, over chunks loaded from a JSONL file (one document per line, same fields
+as the real index). Documents are scored by query term frequency and the
+response honours `top`, `skip` and `select`, so the payload saved by field
+projection is visible here too. `--latency` adds a fixed delay per request.
+
+    python local_search_service.py --chunks chunks.jsonl --port 8081
+    AZURE_SEARCH_SERVICE=http://127.0.0.1:8081 AZURE_SEARCH_KEY=local python "Lexical(RAG).py"
+"""
+
+import re
+import json
+import asyncio
+import argparse
+from collections import Counter
+
+from aiohttp import web
+
+
+def tokenize(text):
+    return re.findall(r"\w+", str(text).lower())
+
+
+class LocalSearchService:
+    """
+    In-memory keyword search answering the Azure AI Search REST search call.
+    """
+
+    def __init__(self, documents, latency=0.0):
+        self.documents = documents
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._terms = [Counter(tokenize(doc.get("content", ""))) for doc in documents]
+
+    def search(self, search_text, top=50, skip=0, select=None):
+        terms = set(tokenize(search_text or ""))
+        scored = []
+        for i, counts in enumerate(self._terms):
+            score = sum(counts[t] for t in terms) if terms else 1.0
+            if score:
+                scored.append((score, i))
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        fields = [f.strip() for f in select.split(",")] if select else None
+        results = []
+        for score, i in scored[skip:skip + top]:
+            doc = self.documents[i]
+            if fields is not None:
+                doc = {f: doc.get(f) for f in fields}
+            results.append({"@search.score": float(score), **doc})
+        return results
+
+    async def handle_search(self, request):
+        body = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.requests += 1
+        value = self.search(
+            body.get("search"), top=body.get("top") or 50, skip=body.get("skip") or 0, select=body.get("select")
+        )
+        payload = json.dumps({"value": value}).encode("utf-8")
+        self.bytes_sent += len(payload)
+        return web.Response(body=payload, content_type="application/json")
+
+    async def handle_stats(self, request):
+        return web.json_response({"requests": self.requests, "bytes_sent": self.bytes_sent})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/indexes('{index}')/docs/search.post.search", self.handle_search)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def load_documents(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Azure AI Search query endpoint")
+    parser.add_argument("--chunks", required=True, help="JSONL file of index documents")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="delay per request (s)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    service = LocalSearchService(load_documents(args.chunks), latency=args.latency)
+    print(f"🚀 Local search service on http://{args.host}:{args.port} ({len(service.documents)} documents)")
+    web.run_app(service.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+fake_chat_service.py
+
+Local stand-in for an Azure OpenAI chat deployment, to check KernelExecutor
+without credentials or quota.
+
+FakeChatService is a Semantic Kernel chat completion service that answers
+after a fixed latency and enforces a deployment quota like Azure does:
+tokens and requests per minute over a sliding window. A call over quota
+fails with an HTTP 429-style error carrying Retry-After, wrapped the way
+the real connector wraps it.
+
+Run:
+    python fake_chat_service.py --prompts 300 --tpm 20000 --rpm 120 --period 2
+
+runs the batch twice, unthrottled (plain asyncio.gather) and through
+KernelExecutor. It prints the 429 counts, the wall time, the share of the
+quota used and whether the results came back in input order. `--period`
+shortens the quota "minute" to that many seconds so the demo finishes
+quickly.
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+from collections import deque
+from typing import Any, Optional
+
+from semantic_kernel import Kernel
+from semantic_kernel.connectors.ai.chat_completion_client_base import ChatCompletionClientBase
+from semantic_kernel.connectors.ai.completion_usage import CompletionUsage
+from semantic_kernel.contents import ChatMessageContent
+from semantic_kernel.contents.utils.author_role import AuthorRole
+from semantic_kernel.exceptions import ServiceResponseException
+
+from kernel_executor import CHARS_PER_TOKEN, KernelExecutor
+
+
+class FakeRateLimitError(Exception):
+    """
+    The parts of openai.RateLimitError that callers look at: status_code and retry_after.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.status_code = 429
+        self.retry_after = retry_after
+
+
+class FakeChatService(ChatCompletionClientBase):
+    """
+    Chat completion service with a per-period token / request quota (see module docstring).
+    """
+
+    tokens_per_minute: float = 20_000
+    requests_per_minute: float = 120
+    period: float = 60.0
+    latency: float = 0.05
+    completion_tokens: int = 20
+    calls: int = 0
+    throttled: int = 0
+    window: Any = None
+
+    def _admit(self, tokens: int) -> Optional[float]:
+        # Seconds until the call would fit in the window, or None (and it is recorded)
+        now = time.monotonic()
+        if self.window is None:
+            self.window = deque()
+        while self.window and self.window[0][0] <= now - self.period:
+            self.window.popleft()
+        used = sum(t for _, t in self.window)
+        if len(self.window) + 1 > self.requests_per_minute or used + tokens > self.tokens_per_minute:
+            return self.window[0][0] + self.period - now if self.window else self.period
+        self.window.append((now, tokens))
+        return None
+
+    async def _inner_get_chat_message_contents(self, chat_history, settings) -> list:
+        self.calls += 1
+        prompt = " ".join(str(message.content or "") for message in chat_history.messages)
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN + 1
+        wait = self._admit(prompt_tokens + self.completion_tokens)
+        if wait is not None:
+            self.throttled += 1
+            error = FakeRateLimitError("Rate limit is exceeded", retry_after=round(wait, 3))
+            raise ServiceResponseException(f"{type(self)} service failed to complete the prompt", error) from error
+        await asyncio.sleep(self.latency)
+        words = prompt.split()
+        return [ChatMessageContent(
+            role=AuthorRole.ASSISTANT,
+            content=" ".join(words[-self.completion_tokens:]),
+            ai_model_id=self.ai_model_id,
+            metadata={"usage": CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=self.completion_tokens)},
+        )]
+
+
+def build_kernel(args) -> Kernel:
+    kernel = Kernel()
+    kernel.add_service(FakeChatService(
+        service_id="fake", ai_model_id="fake-gpt", tokens_per_minute=args.tpm, requests_per_minute=args.rpm,
+        period=args.period, latency=args.latency,
+    ))
+    return kernel
+
+
+def make_prompts(n: int) -> list:
+    return [f"Request {i}: summarise the following notes. " + "lorem ipsum " * (10 + i % 40) for i in range(n)]
+
+
+async def run_unthrottled(kernel: Kernel, prompts: list) -> dict:
+    start = time.perf_counter()
+    results = await asyncio.gather(*(kernel.invoke_prompt(p) for p in prompts), return_exceptions=True)
+    failed = sum(isinstance(r, Exception) for r in results)
+    return {"seconds": round(time.perf_counter() - start, 2), "failed": failed}
+
+
+async def run_executor(kernel: Kernel, prompts: list, args) -> dict:
+    # The budget is the quota itself; the token bucket keeps every window under it
+    executor = KernelExecutor(kernel, tokens_per_minute=args.tpm, requests_per_minute=args.rpm,
+                              max_concurrency=args.concurrency, period=args.period)
+    start = time.perf_counter()
+    results = await executor.run([executor.prompt(p, max_tokens=20) for p in prompts], return_exceptions=True)
+    seconds = time.perf_counter() - start
+    in_order = all(
+        not isinstance(r, Exception) and str(r).split()[-1] == p.split()[-1] for r, p in zip(results, prompts)
+    )
+    stats = dict(executor.stats, wait_seconds=round(executor.stats["wait_seconds"], 1))
+    return {"seconds": round(seconds, 2), "in_order": in_order, **stats}
+
+
+async def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="KernelExecutor against a fake rate-limited chat deployment")
+    parser.add_argument("--prompts", type=int, default=300)
+    parser.add_argument("--tpm", type=float, default=20_000, help="fake deployment tokens per period")
+    parser.add_argument("--rpm", type=float, default=120, help="fake deployment requests per period")
+    parser.add_argument("--period", type=float, default=2.0, help="length of the quota 'minute' in seconds")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake completion latency (s)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args(argv)
+    prompts = make_prompts(args.prompts)
+    tokens = sum(len(p) // CHARS_PER_TOKEN + 1 + 20 for p in prompts)
+    # Time the batch needs at full quota (the binding limit of tokens and requests)
+    ideal = max(tokens / args.tpm, len(prompts) / args.rpm) * args.period
+    print(f"Batch: {len(prompts)} prompts, ~{tokens} tokens; at full quota ~{ideal:.1f}s")
+
+    kernel = build_kernel(args)
+    unthrottled = await run_unthrottled(kernel, prompts)
+    service = kernel.get_service("fake")
+    print(f"asyncio.gather: {unthrottled}, 429s: {service.throttled}")
+
+    kernel = build_kernel(args)
+    result = await run_executor(kernel, prompts, args)
+    service = kernel.get_service("fake")
+    print(f"KernelExecutor: {result}, 429s: {service.throttled}, quota use: {ideal / result['seconds']:.0%}")
+
+
+if __name__ == "__main__":
+    import logging
+    logging.disable(logging.ERROR)   # the connector logs every failed call
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,266 @@
+"""
+kernel_executor.py
+
+Rate-limited concurrent execution of Semantic Kernel calls.
+
+KernelExecutor runs a batch of independent invocations (prompts, kernel
+functions, chat completions) concurrently and returns their results in
+input order. Every call first takes its share of two token buckets, one
+for requests per minute and one for (estimated) tokens per minute, so a
+batch runs as fast as the deployment quota allows without tripping Azure
+OpenAI throttling. A 429 that gets through anyway pauses the buckets for
+the Retry-After time (or an exponential backoff with full jitter) and
+the call is retried.
+
+Token estimates are prompt characters / 4 plus the completion budget
+(max_tokens); when the response reports its usage, the difference is
+given back to (or taken from) the token bucket.
+
+Usage:
+    executor = KernelExecutor(kernel, tokens_per_minute=30_000, requests_per_minute=180)
+    results = await executor.run([
+        executor.prompt("Summarise {{$text}}", arguments=KernelArguments(text=doc)),
+        executor.chat(history, settings, service_id="chat-gpt"),
+    ])
+"""
+
+import time
+import random
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+
+CHARS_PER_TOKEN = 4
+DEFAULT_MAX_TOKENS = 256
+
+
+class TokenBucket:
+    """
+    Async token bucket holding at most `burst` of a per-period budget.
+
+    It refills at (1 - burst) x rate per period, so no window of one period
+    ever sees more than `rate` (the quota is a sliding per-minute window).
+    """
+
+    def __init__(self, rate: float, period: float = 60.0, burst: float = 0.1):
+        self.rate = float(rate)
+        self.period = period
+        self.capacity = max(self.rate * burst, 1.0)
+        refill = self.rate - self.capacity if self.rate > self.capacity else self.rate
+        self.refill_per_second = refill / period
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """
+        Wait until `amount` tokens (at most the capacity) are available and take them; returns the seconds waited.
+        """
+        amount = min(amount, self.capacity)
+        start = time.monotonic()
+        # The lock makes waiters queue up in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0 and self.tokens >= amount:
+                    self.tokens -= amount
+                    return now - start
+                wait = max(wait, (amount - self.tokens) / self.refill_per_second)
+                await asyncio.sleep(wait)
+
+    def adjust(self, amount: float) -> None:
+        """
+        Give back (positive) or take (negative) tokens after the fact; the balance may go negative.
+        """
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hand out nothing for `seconds` and start again from an empty bucket.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+def _error_chain(ex: BaseException):
+    # Semantic Kernel wraps the SDK error (KernelInvokeException -> ... -> openai.RateLimitError)
+    seen = set()
+    while ex is not None and id(ex) not in seen:
+        seen.add(id(ex))
+        yield ex
+        ex = ex.__cause__ or ex.__context__
+
+
+def is_throttled(ex: BaseException) -> bool:
+    """
+    True if the error (or one it wraps) is an HTTP 429.
+    """
+    for error in _error_chain(ex):
+        if getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError":
+            return True
+    return False
+
+
+def retry_after(ex: BaseException) -> Optional[float]:
+    """
+    Seconds from a Retry-After(-ms) header (or `retry_after` attribute) in the error chain, if any.
+    """
+    for error in _error_chain(ex):
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except (TypeError, ValueError):
+            pass
+        if getattr(error, "retry_after", None) is not None:
+            return float(error.retry_after)
+    return None
+
+
+def estimate_tokens(text: str, max_tokens: Optional[int] = None) -> int:
+    """
+    Rough token cost of a call: prompt characters / 4 plus the completion budget.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1 + (max_tokens or DEFAULT_MAX_TOKENS)
+
+
+def usage_tokens(result: Any) -> Optional[int]:
+    """
+    prompt + completion tokens reported by a FunctionResult or ChatMessageContent, if any.
+    """
+    items = [result, getattr(result, "value", None)]
+    metadata = getattr(result, "metadata", None) or {}
+    items.extend(metadata.get("metadata", []) if isinstance(metadata, dict) else [])
+    total = 0
+    found = False
+    for item in items:
+        for value in (item if isinstance(item, list) else [item]):
+            meta = value if isinstance(value, dict) else getattr(value, "metadata", None)
+            usage = meta.get("usage") if isinstance(meta, dict) else None
+            if usage is not None:
+                total += (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+                found = True
+        if found:
+            return total
+    return None
+
+
+def _max_tokens(settings: Any) -> Optional[int]:
+    return getattr(settings, "max_tokens", None) or getattr(settings, "max_completion_tokens", None)
+
+
+class Invocation:
+    """
+    One call for KernelExecutor: a factory for its coroutine (called again on retry) and its token estimate.
+    """
+
+    def __init__(self, factory: Callable[[], Awaitable[Any]], tokens: int, label: str = ""):
+        self.factory = factory
+        self.tokens = tokens
+        self.label = label
+
+
+class KernelExecutor:
+    """
+    Runs batches of Kernel invocations concurrently within a token / request budget (see module docstring).
+    """
+
+    def __init__(self, kernel: Any, tokens_per_minute: float = 30_000, requests_per_minute: float = 180,
+                 max_concurrency: int = 16, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0,
+                 period: float = 60.0, burst: float = 0.1):
+        self.kernel = kernel
+        self.tokens = TokenBucket(tokens_per_minute, period=period, burst=burst)
+        self.requests = TokenBucket(requests_per_minute, period=period, burst=burst)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "failed": 0, "wait_seconds": 0.0}
+
+    # -- invocation builders ---------------------------------------------
+
+    def prompt(self, prompt: str, arguments: Any = None, max_tokens: Optional[int] = None, **kwargs) -> Invocation:
+        """
+        kernel.invoke_prompt(prompt, arguments=arguments, **kwargs).
+        """
+        settings = getattr(arguments, "execution_settings", None) or {}
+        max_tokens = max_tokens or next((_max_tokens(s) for s in settings.values() if _max_tokens(s)), None)
+        text = prompt + " ".join(str(value) for value in (arguments or {}).values())
+        return Invocation(
+            lambda: self.kernel.invoke_prompt(prompt, arguments=arguments, **kwargs),
+            estimate_tokens(text, max_tokens), label=prompt[:40],
+        )
+
+    def function(self, function: Any, arguments: Any = None, tokens: Optional[int] = None, **kwargs) -> Invocation:
+        """
+        kernel.invoke(function, arguments=arguments, **kwargs); pass `tokens` if the default estimate is off.
+        """
+        text = " ".join(str(value) for value in (arguments or {}).values())
+        return Invocation(
+            lambda: self.kernel.invoke(function, arguments=arguments, **kwargs),
+            tokens or estimate_tokens(text), label=getattr(function, "name", ""),
+        )
+
+    def chat(self, chat_history: Any, settings: Any, service_id: Optional[str] = None) -> Invocation:
+        """
+        get_chat_message_content of a chat service registered on the kernel.
+        """
+        service = self.kernel.get_service(service_id) if service_id else self.kernel.get_service()
+        text = " ".join(str(message.content or "") for message in chat_history.messages)
+        return Invocation(
+            lambda: service.get_chat_message_content(chat_history=chat_history, settings=settings, kernel=self.kernel),
+            estimate_tokens(text, _max_tokens(settings)), label="chat",
+        )
+
+    # -- execution -------------------------------------------------------
+
+    async def _call(self, invocation: Invocation, semaphore: asyncio.Semaphore) -> Any:
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                waited = await self.requests.acquire(1)
+                waited += await self.tokens.acquire(invocation.tokens)
+                self.stats["wait_seconds"] += waited
+                self.stats["calls"] += 1
+                try:
+                    result = await invocation.factory()
+                except Exception as ex:
+                    if not is_throttled(ex) or attempt == self.max_retries:
+                        self.stats["failed"] += 1
+                        raise
+                    self.stats["throttled"] += 1
+                    self.stats["retries"] += 1
+                    delay = retry_after(ex)
+                    if delay is None:
+                        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    # Everyone backs off, not just this call
+                    self.requests.pause(delay)
+                    self.tokens.pause(delay)
+                    continue
+                used = usage_tokens(result)
+                if used is not None:
+                    self.tokens.adjust(invocation.tokens - used)
+                return result
+
+    async def run(self, invocations: list, return_exceptions: bool = False) -> list:
+        """
+        Results of all invocations in input order (like asyncio.gather).
+
+        With return_exceptions, a failed call leaves its exception in its slot
+        instead of cancelling the batch.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.gather(
+            *(self._call(invocation, semaphore) for invocation in invocations), return_exceptions=return_exceptions
+        )
@@ -8,6 +8,9 @@ Before running (bash):
     export AZURE_OPENAI_ENDPOINT="https://<your-azure-openai-endpoint>/"
     export AZURE_OPENAI_API_KEY="<YOUR_AZURE_OPENAI_API_KEY>"
     export AZURE_OPENAI_DEPLOYMENT="gpt-4o-mini"
+    # optional: deployment quota the calls are paced to (see kernel_executor.py)
+    export AZURE_OPENAI_TPM="30000"
+    export AZURE_OPENAI_RPM="180"
 
 Run:
     python step2_chat_completion_plugin.py
@@ -35,6 +38,8 @@ except Exception as ex:
     print("Import error:", ex)
     sys.exit(1)
 
+from kernel_executor import KernelExecutor
+
 
 def get_env(name: str) -> str:
     v = os.getenv(name)
@@ -48,6 +53,8 @@ def get_env(name: str) -> str:
 AZURE_OPENAI_ENDPOINT = get_env("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_API_KEY = get_env("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o-mini")
+AZURE_OPENAI_TPM = float(os.getenv("AZURE_OPENAI_TPM", "30000"))
+AZURE_OPENAI_RPM = float(os.getenv("AZURE_OPENAI_RPM", "180"))
 
 
 # Kernel setup
@@ -86,16 +93,6 @@ history.add_message({"role": "user", "content": "What is the current time?"})
 
 async def main() -> None:
     # 1) Call the TimePlugin via the chat service
-    try:
-        plugin_result = await kernel.services["chat-gpt"].get_chat_message_content(
-            chat_history=history,
-            settings=execution_settings,
-            kernel=kernel,
-        )
-        print("Plugin Output:", plugin_result)
-    except Exception as ex:
-        print("Plugin call failed:", ex)
-
     # 2) Invoke a prompt (TLDR example)
     prompt = (
         """
@@ -107,11 +104,22 @@ Give me the TLDR in exactly {{$num_words}} words. Only output {{$num_words}} wor
 """
     )
 
-    try:
-        prompt_result = await kernel.invoke_prompt(prompt, arguments=KernelArguments(num_words=5))
+    # The two calls are independent: run them concurrently, paced to the deployment quota
+    executor = KernelExecutor(kernel, tokens_per_minute=AZURE_OPENAI_TPM, requests_per_minute=AZURE_OPENAI_RPM)
+    plugin_result, prompt_result = await executor.run([
+        executor.chat(history, execution_settings, service_id="chat-gpt"),
+        executor.prompt(prompt, arguments=KernelArguments(num_words=5)),
+    ], return_exceptions=True)
+
+    if isinstance(plugin_result, Exception):
+        print("Plugin call failed:", plugin_result)
+    else:
+        print("Plugin Output:", plugin_result)
+
+    if isinstance(prompt_result, Exception):
+        print("Prompt invocation failed:", prompt_result)
+    else:
         print("Prompt Output:", " ".join(str(prompt_result).split()[:5]))
-    except Exception as ex:
-        print("Prompt invocation failed:", ex)
 
     # No memory demo in this script. Remove Azure Cognitive Search / SemanticTextMemory usage.
 